@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+# Benchmarks the backup flow end to end without root, a NAS or a LUKS
+# device.  The commands in bench/fake stand in for mount, mount.cifs,
+# cryptsetup, mkfs.btrfs and btrfs, backed by plain directories, while
+# rsync runs for real.  Timings come from the run report spans.
+#
+#   bench/bench.py run [options]            writes bench-<commit>.json
+#   bench/bench.py compare OLD.json NEW.json
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.dirname(HERE))
+
+from mnemosyne.backup import Backup
+from mnemosyne.report import Report
+
+# Mount points used by mnemosyne, which the fakes turn into symlinks
+MOUNTS = [ "/tmp/mnemosyne-remote", "/tmp/mnemosyne-volume" ]
+
+# Files per directory in a generated tree
+FANOUT = 32
+
+def git(*args):
+    try:
+        return subprocess.run(
+            [ "git", "-C", HERE ] + list(args), capture_output=True,
+            text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+def check_mounts():
+
+    with open("/proc/mounts") as f:
+        mounted = [ line.split()[1] for line in f ]
+
+    for mnt in MOUNTS:
+        if mnt in mounted:
+            raise RuntimeError(f"{mnt} is a real mount, not benchmarking")
+
+def size(rng, median, sigma, largest):
+
+    # Log-normal, which is roughly what real trees look like: lots of
+    # small files and a long tail of big ones
+    return min(int(rng.lognormvariate(0, sigma) * median), largest)
+
+def path_for(root, i):
+
+    # Spread files over a tree FANOUT wide
+    parts = []
+    n = i // FANOUT
+    while n:
+        parts.append(f"d{n % FANOUT}")
+        n //= FANOUT
+    return os.path.join(root, *reversed(parts), f"f{i}")
+
+def write(path, length, rng):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(rng.randbytes(length))
+
+def generate(root, files, args, rng):
+    for i in range(files):
+        write(
+            path_for(root, i), size(rng, args.median, args.sigma, args.largest),
+            rng
+        )
+
+def churn(root, files, args, rng):
+
+    # Rewrites a fraction of the files, deletes a few and adds as many,
+    # so every cycle has something to transfer
+    count = max(int(files * args.churn), 1)
+
+    for i in rng.sample(range(files), count):
+        path = path_for(root, i)
+        if rng.random() < 0.1:
+            if os.path.exists(path):
+                os.remove(path)
+        else:
+            write(path, size(rng, args.median, args.sigma, args.largest), rng)
+
+def configure(work, directories, stages, args):
+
+    key = os.path.join(work, "key")
+    with open(key, "w") as f:
+        f.write("bench")
+
+    config = {
+        "remote": {
+            "type": "cifs", "volume": "//bench/backup", "username": "bench",
+            "password": "bench"
+        },
+        "store": { "name": "store", "size": 1, "keyfile": key },
+        "strategy": {
+            "stages": stages,
+            "rotate": args.rotate,
+            "parallelism": args.parallelism,
+            "layout": args.layout,
+            "state": os.path.join(work, "state"),
+            "output": "quiet",
+            "progress": 3600,
+        },
+        "local": {
+            "directories": [
+                {
+                    "key": direc, "directory": os.path.join(work, "src", direc),
+                    "engine": args.engine, "shards": args.shards
+                }
+                for direc in directories
+            ]
+        }
+    }
+
+    path = os.path.join(work, "config.json")
+    with open(path, "w") as f:
+        json.dump(config, f, indent=4)
+
+    return path
+
+def cycle(backup):
+
+    start = time.time()
+    backup.backup()
+    total = time.time() - start
+
+    return {
+        "total": round(total, 3),
+        "phases": {
+            name: round(t, 3) for name, t in Report.phases(Report.root).items()
+        }
+    }
+
+def mean(cycles):
+
+    names = sorted({ name for c in cycles for name in c["phases"] })
+
+    return {
+        "total": round(statistics.mean(c["total"] for c in cycles), 3),
+        "phases": {
+            name: round(
+                statistics.mean(c["phases"].get(name, 0) for c in cycles), 3
+            )
+            for name in names
+        }
+    }
+
+def scenario(name, directories, stages, cycles, args):
+
+    # The first cycle is the initial full copy.  With stages N, it takes
+    # N cycles before rotation runs against a full set of snapshots, so
+    # only the cycles after that are measured.
+    work = tempfile.mkdtemp(prefix="mnemosyne-bench-", dir=args.work)
+    rng = random.Random(args.seed)
+
+    env = dict(os.environ)
+
+    try:
+
+        os.environ["MNEMOSYNE_BENCH"] = os.path.join(work, "backing")
+        os.environ["PATH"] = os.path.join(HERE, "fake") + ":" + env["PATH"]
+
+        keys = [ f"dir{i}" for i in range(directories) ]
+
+        for key in keys:
+            generate(os.path.join(work, "src", key), args.files, args, rng)
+
+        backup = Backup(config=configure(work, keys, stages, args))
+
+        results = []
+
+        for i in range(cycles):
+            if i:
+                for key in keys:
+                    churn(os.path.join(work, "src", key), args.files, args, rng)
+            results.append(cycle(backup))
+
+        measured = results[stages:] or results[-1:]
+
+        result = {
+            "scenario": name, "directories": directories, "stages": stages,
+            "initial": results[0], "mean": mean(measured),
+            "cycles": results,
+        }
+
+        print(
+            f"{name:>12} directories={directories:<3} stages={stages:<3} "
+            f"initial {results[0]['total']:8.2f}s  "
+            f"mean {result['mean']['total']:8.2f}s  "
+            f"rotate {result['mean']['phases'].get('rotate', 0):8.3f}s"
+        )
+
+        return result
+
+    finally:
+        os.environ.clear()
+        os.environ.update(env)
+        shutil.rmtree(work, ignore_errors=True)
+
+def run(args):
+
+    check_mounts()
+
+    if not shutil.which("rsync"):
+        raise RuntimeError("rsync is needed")
+
+    logging.getLogger("mnemosyne").setLevel(
+        logging.INFO if args.verbose else logging.WARNING
+    )
+
+    results = []
+
+    # Rotation cost as stages grows, with one directory
+    for stages in args.stages:
+        results.append(
+            scenario("stages", 1, stages, stages + args.cycles, args)
+        )
+
+    # Cost as the number of directories grows
+    for directories in args.directories:
+        results.append(scenario(
+            "directories", directories, args.base_stages,
+            args.base_stages + args.cycles, args
+        ))
+
+    commit = git("rev-parse", "HEAD")
+
+    report = {
+        "commit": commit,
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "time": int(time.time()),
+        "python": sys.version.split()[0],
+        "parameters": {
+            k: v for k, v in vars(args).items() if k not in [ "fn", "output" ]
+        },
+        "results": results,
+    }
+
+    output = args.output or f"bench-{(commit or 'unknown')[:12]}.json"
+
+    with open(output, "w") as f:
+        json.dump(report, f, indent=4)
+
+    print(f"Written to {output}")
+
+def compare(args):
+
+    old = json.load(open(args.old))
+    new = json.load(open(args.new))
+
+    if old["parameters"] != new["parameters"]:
+        print("Warning: the runs used different parameters")
+
+    def index(report):
+        return {
+            (r["scenario"], r["directories"], r["stages"]): r["mean"]
+            for r in report["results"]
+        }
+
+    old_results = index(old)
+    new_results = index(new)
+
+    print(f"{(old['commit'] or '?')[:12]} -> {(new['commit'] or '?')[:12]}")
+
+    regressions = 0
+
+    for ident in sorted(old_results.keys() & new_results.keys()):
+
+        a = old_results[ident]
+        b = new_results[ident]
+
+        print(f"{ident[0]} directories={ident[1]} stages={ident[2]}")
+
+        rows = [ ("total", a["total"], b["total"]) ] + [
+            (name, a["phases"].get(name, 0), b["phases"].get(name, 0))
+            for name in sorted(a["phases"].keys() | b["phases"].keys())
+        ]
+
+        for name, x, y in rows:
+
+            change = (y - x) / x if x else 0.0
+
+            flag = ""
+            if change > args.threshold and y - x > args.min_seconds:
+                flag = "  REGRESSION"
+                regressions += 1
+
+            print(f"    {name:<20} {x:9.3f}s {y:9.3f}s {change:+8.1%}{flag}")
+
+    if regressions:
+        print(f"{regressions} regressions")
+        sys.exit(1)
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        prog="bench", description="Benchmark mnemosyne with fake backends"
+    )
+
+    sub = parser.add_subparsers(required=True)
+
+    p = sub.add_parser("run", help="Run the benchmark")
+    p.set_defaults(fn=run)
+
+    def ints(value):
+        return [ int(v) for v in value.split(",") ]
+
+    p.add_argument("--files", type=int, default=2000,
+                   help="Files per directory (default 2000)")
+    p.add_argument("--median", type=int, default=16384,
+                   help="Median file size in bytes (default 16384)")
+    p.add_argument("--sigma", type=float, default=1.5,
+                   help="Spread of the log-normal size distribution")
+    p.add_argument("--largest", type=int, default=64 * 1024 * 1024,
+                   help="Largest file size in bytes")
+    p.add_argument("--churn", type=float, default=0.01,
+                   help="Fraction of files changed between cycles")
+    p.add_argument("--stages", type=ints, default=[ 2, 4, 8 ],
+                   help="Stage counts for the rotation scenario")
+    p.add_argument("--directories", type=ints, default=[ 1, 2, 4 ],
+                   help="Directory counts for the scaling scenario")
+    p.add_argument("--base-stages", type=int, default=2,
+                   help="Stages used in the directory scenario")
+    p.add_argument("--cycles", type=int, default=3,
+                   help="Measured cycles per scenario")
+    p.add_argument("--rotate", type=int, default=0,
+                   help="strategy.rotate, default 0 rotates every cycle")
+    p.add_argument("--layout", default="chain")
+    p.add_argument("--engine", default="rsync")
+    p.add_argument("--shards", type=int, default=1)
+    p.add_argument("--parallelism", type=int, default=1)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--work", default=None,
+                   help="Directory for the trees, default the temp directory")
+    p.add_argument("--output", "-o", default=None)
+    p.add_argument("--verbose", "-v", action="store_true")
+
+    p = sub.add_parser("compare", help="Compare two benchmark outputs")
+    p.set_defaults(fn=compare)
+    p.add_argument("old")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=0.1,
+                   help="Relative slowdown flagged as a regression")
+    p.add_argument("--min-seconds", type=float, default=0.05,
+                   help="Ignore slowdowns smaller than this")
+
+    args = parser.parse_args()
+
+    try:
+        args.fn(args)
+    except RuntimeError as e:
+        print("Error:", e)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
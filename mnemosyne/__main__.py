@@ -6,6 +6,7 @@ import signal
 import os
 
 from .backup import Backup
+from .daemon import Daemon
 
 logging.basicConfig(level=logging.INFO)
 
@@ -23,6 +24,10 @@ def run():
                         action="store_const", dest='action', const='init-store',
                         help="Initialise encrypted backup store")
 
+    parser.add_argument("--tune-store", 
+                        action="store_const", dest='action', const='tune-store',
+                        help="Apply the store performance settings to an existing store")
+
     parser.add_argument("--init-key", 
                         action="store_const", dest='action', const='init-key',
                         help="Initialise secure backup key")
@@ -31,14 +36,133 @@ def run():
                         action="store_const", dest='action', const='backup',
                         help="Run a backup cycle")
 
+    parser.add_argument("--daemon", 
+                        action="store_const", dest='action', const='daemon',
+                        help="Run backups on a schedule, keeping the store attached")
+
     parser.add_argument("--mount", 
                         action="store_const", dest='action', const='mount',
                         help="Mount backup target")
 
+    parser.add_argument("--watch", 
+                        action="store_const", dest='action', const='watch',
+                        help="Record changes to journalled directories")
+
+    parser.add_argument("--migrate-layout", 
+                        action="store_const", dest='action', const='migrate',
+                        help="Convert key.N snapshots to the timestamp layout")
+
+    parser.add_argument("--report", 
+                        action="store_const", dest='action', const='report',
+                        help="Show recent runs and flag regressions")
+
+    parser.add_argument("--probe-compression", 
+                        action="store_const", dest='action', const='probe-compression',
+                        help="Measure write speed and compression of sample data")
+
+    parser.add_argument("--probe-remote", 
+                        action="store_const", dest='action', const='probe-remote',
+                        help="Measure throughput and latency to the remote store")
+
+    parser.add_argument("--verify-backup", 
+                        action="store_const", dest='action', const='verify-backup',
+                        help="Check the backup is readable against its checksums")
+
     parser.add_argument("--verify-environment", 
                         action="store_const", dest='action', const='verify',
                         help="Verify environment")
 
+    parser.add_argument(
+        "--restore", metavar="KEY",
+        help="Restore files backed up under KEY, needs --to"
+    )
+
+    parser.add_argument(
+        "--search", metavar="PATTERN",
+        help="Find versions of files in the catalog, by path, name or glob"
+    )
+
+    parser.add_argument(
+        "--key", default=None,
+        help="With --search, only this key"
+    )
+
+    parser.add_argument(
+        "--stage", type=int, default=None,
+        help="With --restore, the stage to restore from (default 0, latest)"
+    )
+
+    parser.add_argument(
+        "--at", metavar="TIME", default=None,
+        help="With --restore, restore the newest copy no newer than TIME, "
+        "e.g. 2024-05-01T12:00"
+    )
+
+    parser.add_argument(
+        "--path", metavar="GLOB", action="append", default=[],
+        help="With --restore, only paths matching GLOB, relative to the "
+        "backed up directory.  Can be repeated"
+    )
+
+    parser.add_argument(
+        "--to", metavar="DIR", default=None,
+        help="With --restore, directory to restore into"
+    )
+
+    parser.add_argument(
+        "--threads", type=int, default=16,
+        help="With --restore, copy threads; with --verify-backup, hashing "
+        "threads"
+    )
+
+    parser.add_argument(
+        "--full", action="store_true",
+        help="With --verify-backup, re-read every file of every stage"
+    )
+
+    parser.add_argument(
+        "--scrub", action="store_true",
+        help="With --verify-backup, also run a btrfs scrub of the volume"
+    )
+
+    parser.add_argument(
+        "--measure-cache", action="store_true",
+        help="With --backup, log page cache residency before and after"
+    )
+
+    parser.add_argument(
+        "--cache-path", metavar="PATH", action="append", default=[],
+        help="With --measure-cache, a file or directory to measure instead "
+        "of a sample of the backed up directories.  Can be repeated"
+    )
+
+    parser.add_argument(
+        "--days", type=float, default=30,
+        help="With --report, how many days of history to show"
+    )
+
+    parser.add_argument(
+        "--threshold", type=float, default=0.5,
+        help="With --report, slowdown flagged as a regression (0.5 = 50%%)"
+    )
+
+    parser.add_argument(
+        "--settings", default="none,lzo,zstd:1,zstd:3,zstd:9",
+        help="With --probe-compression, the compression settings to try"
+    )
+
+    parser.add_argument(
+        "--sample", type=int, default=256,
+        help="With --probe-compression, megabytes of source data to sample; "
+        "with --probe-remote, megabytes to read and write"
+    )
+
+    parser.add_argument(
+        "--target", metavar="NAME", default=None,
+        help="With several targets, the one to work on for commands other "
+        "than --backup and --daemon (default the first)"
+    )
+
     parser.add_argument(
         "--config", '-c', default="/usr/local/etc/mnemosyne/config.json",
         action="store", 
@@ -52,17 +176,42 @@ def run():
         args = parser.parse_args()
 
         backup = Backup(config=args.config)
+        backup.select(args.target)
+
+        if args.restore:
+            if not args.to:
+                raise RuntimeError("--restore needs --to")
+            logger.info(f"Restoring {args.restore}...")
+            backup.restore(
+                args.restore, args.to, args.stage, args.at, args.path,
+                args.threads
+            )
+            sys.exit(0)
+
+        if args.search:
+            backup.search(args.search, args.key)
+            sys.exit(0)
 
         if args.action == "verify":
             logger.info("Verifying environment...")
             backup.verify()
             sys.exit(0)
 
+        if args.action == "verify-backup":
+            logger.info("Verifying backup...")
+            backup.verify_backup(args.full, args.scrub, args.threads)
+            sys.exit(0)
+
         if args.action == "init-store":
             logger.info("Initialising backup store...")
             backup.init_store()
             sys.exit(0)
 
+        if args.action == "tune-store":
+            logger.info("Tuning backup store...")
+            backup.tune_store()
+            sys.exit(0)
+
         if args.action == "init-key":
             logger.info("Initialising secure key...")
             backup.init_key()
@@ -70,7 +219,14 @@ def run():
 
         if args.action == "backup":
             logger.info("Running backup...")
-            backup.backup()
+            backup.backup(args.cache_path if args.measure_cache else None)
+            sys.exit(0)
+
+        if args.action == "daemon":
+            logger.info("Running as daemon...")
+            daemon = Daemon(backup)
+            stop_on_signal(daemon)
+            daemon.run()
             sys.exit(0)
 
         if args.action == "mount":
@@ -78,6 +234,32 @@ def run():
             backup.mount()
             sys.exit(0)
 
+        if args.action == "watch":
+            logger.info("Watching for changes...")
+            backup.watch()
+            sys.exit(0)
+
+        if args.action == "migrate":
+            logger.info("Migrating snapshot layout...")
+            backup.migrate_layout()
+            sys.exit(0)
+
+        if args.action == "probe-compression":
+            logger.info("Probing compression...")
+            backup.probe_compression(
+                args.settings.split(","), args.sample * 1024 * 1024
+            )
+            sys.exit(0)
+
+        if args.action == "probe-remote":
+            logger.info("Probing remote filesystem...")
+            backup.probe_remote(args.sample * 1024 * 1024)
+            sys.exit(0)
+
+        if args.action == "report":
+            backup.report(args.days, args.threshold)
+            sys.exit(0)
+
         logger.error("You need to specify an action to take")
         sys.exit(1)
 
@@ -90,6 +272,19 @@ def shutdown_handler(signal, frame):
     logger.info("Exiting.")
     sys.exit(0)
 
+def stop_on_signal(daemon):
+
+    # The first signal lets running work finish and unmounts cleanly, a
+    # second one exits straight away
+    def handler(sig, frame):
+        logger.info("Signal received, stopping after current work...")
+        daemon.stop()
+        signal.signal(signal.SIGTERM, shutdown_handler)
+        signal.signal(signal.SIGINT, shutdown_handler)
+
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+
 
 signal.signal(signal.SIGTERM, shutdown_handler)
 signal.signal(signal.SIGINT, shutdown_handler)
@@ -5,12 +5,27 @@ import time
 import logging
 import shutil
 import secrets
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from .types import *
 from .remote import RemoteFS
 from .store import EncryptedStore
 from .volume import Volume
+from .sync import SharedScan
+from .governor import Governor
+from .cache import PageCache
+from .profiles import PROFILES
+from .space import SpaceMonitor
 from .directory import DirectoryBackup
+from .journal import Watcher
+from .report import Report
+from .history import RunHistory
+from .probe import CompressionProbe, RemoteProbe
+from .restore import Restore
+from .catalog import Catalog
+from .verify import Verifier
 
 logger = logging.getLogger("mnemosyne")
 
@@ -24,20 +39,53 @@ class Backup:
         except Exception as e:
             raise RuntimeError("Parsing config file: " + str(e))
 
+        if "targets" in self.config:
+
+            try:
+                self.targets = [
+                    Target.parse(t) for t in self.config["targets"]
+                ]
+            except Exception as e:
+                raise RuntimeError("Parsing 'targets' config: " + str(e))
+
+            names = [ target.name for target in self.targets ]
+
+            if not names or not all(names) or len(names) != len(set(names)):
+                raise RuntimeError(
+                    "Parsing 'targets' config: targets need distinct names"
+                )
+
+        else:
+
+            try:
+                remote = Remote.parse(self.config["remote"])
+            except Exception as e:
+                raise RuntimeError("Parsing 'remote' config: " + str(e))
+
+            try:
+                store = Store(**self.config["store"])
+            except Exception as e:
+                raise RuntimeError("Parsing 'store' config: " + str(e))
+
+            self.targets = [ Target(None, remote, store) ]
+
         try:
-            self.remote = Remote.parse(self.config["remote"])
+            self.strategy = Strategy(**self.config["strategy"])
         except Exception as e:
-            raise RuntimeError("Parsing 'remote' config: " + str(e))
+            raise RuntimeError("Parsing 'strategy' config: " + str(e))
 
         try:
-            self.store = Store(**self.config["store"])
+            self.reporting = Reporting(**self.config.get("report", {}))
         except Exception as e:
-            raise RuntimeError("Parsing 'store' config: " + str(e))
+            raise RuntimeError("Parsing 'report' config: " + str(e))
 
         try:
-            self.strategy = Strategy(**self.config["strategy"])
+            if "limits" in self.config:
+                self.limits = Limits(**self.config["limits"])
+            else:
+                self.limits = None
         except Exception as e:
-            raise RuntimeError("Parsing 'strategy' config: " + str(e))
+            raise RuntimeError("Parsing 'limits' config: " + str(e))
 
         try:
             self.directories = [
@@ -46,7 +94,77 @@ class Backup:
             ]
         except Exception as e:
             raise RuntimeError("Parsing 'local' config: " + str(e))
-            
+
+        for target in self.targets:
+
+            remote = target.remote
+
+            if remote.type == "block" and remote.mode not in [
+                    "filesystem", "raw"
+            ]:
+                raise RuntimeError(
+                    "Parsing 'remote' config: mode must be filesystem or raw"
+                )
+
+            if remote.type == "cifs" and not (
+                    remote.credentials or
+                    (remote.username and remote.password is not None)
+            ):
+                raise RuntimeError(
+                    "Parsing 'remote' config: needs credentials, or username "
+                    "and password"
+                )
+
+        self.select()
+
+        keys = [direc.key for direc in self.directories]
+        if len(keys) != len(set(keys)):
+            raise RuntimeError("Parsing 'local' config: duplicate key")
+
+        for direc in self.directories:
+            if direc.engine not in [ "rsync", "native", "send" ]:
+                raise RuntimeError(
+                    f"Parsing 'local' config: unknown engine {direc.engine}"
+                )
+
+            if direc.journal and direc.engine != "rsync":
+                raise RuntimeError(
+                    "Parsing 'local' config: journal needs the rsync engine"
+                )
+
+            if direc.profile is not None and direc.engine != "rsync":
+                raise RuntimeError(
+                    "Parsing 'local' config: profile needs the rsync engine"
+                )
+
+            if isinstance(direc.profile, dict):
+                try:
+                    Profile(**direc.profile)
+                except Exception as e:
+                    raise RuntimeError(
+                        f"Parsing 'local' config: profile of {direc.key}: {e}"
+                    )
+            elif direc.profile not in list(PROFILES) + [ None, "auto" ]:
+                raise RuntimeError(
+                    f"Parsing 'local' config: unknown profile {direc.profile}"
+                )
+
+        if self.strategy.parallelism < 1:
+            raise RuntimeError("Parsing 'strategy' config: parallelism < 1")
+
+        # Directories being backed up at once, across every target
+        self.slots = threading.BoundedSemaphore(self.strategy.parallelism)
+
+        if self.strategy.layout not in [ "chain", "timestamp" ]:
+            raise RuntimeError(
+                "Parsing 'strategy' config: layout must be chain or timestamp"
+            )
+
+        if self.strategy.output not in [ "verbose", "quiet" ]:
+            raise RuntimeError(
+                "Parsing 'strategy' config: output must be verbose or quiet"
+            )
+
     def verify(self):
 
         failed = False
@@ -107,64 +225,416 @@ class Backup:
 
         logger.info(f"Key initialiased and written to {self.store.keyfile}")
 
+    def select(self, name=None):
+
+        # Commands other than --backup and --daemon work on one target, the
+        # first unless another is named
+        for target in self.targets:
+            if name is None or target.name == name:
+                self.target = target
+                self.remote = target.remote
+                self.store = target.store
+                return
+
+        raise RuntimeError(f"No target named '{name}'")
+
+    def raw(self, target=None):
+        remote = (target or self.target).remote
+        return remote.type == "block" and remote.mode == "raw"
+
+    @contextmanager
+    def store_path(self, target=None):
+
+        target = target or self.target
+
+        # In raw mode LUKS is directly on the device, otherwise it's an
+        # image file on the remote filesystem
+        if self.raw(target):
+            yield target.remote.device
+            return
+
+        with RemoteFS.init(target.remote, target.name) as fs:
+            yield fs.mount_point() + "/" + target.store.name
+
     def init_store(self):
 
-        with RemoteFS.init(self.remote) as fs:
+        with self.store_path() as encrypted_store:
+
+            if self.raw():
 
-            encrypted_store = fs.mount_point() + "/" + self.store.name
+                if EncryptedStore.in_use(encrypted_store):
+                    logger.error(f"Device '{encrypted_store}' is in use!")
+                    logger.error(f"Refusing to initialise store")
+                    raise RuntimeError(
+                        "Device already holds LUKS or a filesystem"
+                    )
 
-            if os.path.exists(encrypted_store):
+            elif os.path.exists(encrypted_store):
 
                 logger.error(f"Store '{encrypted_store}' exists!")
                 logger.error(f"Refusing to initialise store")
                 raise RuntimeError("Store file already exists on remote disk")
 
             EncryptedStore.init(
-                encrypted_store, self.store.size, self.store.keyfile
+                encrypted_store, None if self.raw() else self.store.size,
+                self.store.keyfile,
+                cipher=self.store.cipher, key_size=self.store.key_size,
+                sector_size=self.store.sector_size, pbkdf=self.store.pbkdf,
+                pbkdf_iterations=self.store.pbkdf_iterations
             )
 
-            with EncryptedStore(encrypted_store, self.store.keyfile) as s:
+            with EncryptedStore(
+                    encrypted_store, self.store.keyfile,
+                    self.store.no_workqueue, name=self.target.name
+            ) as s:
 
                 Volume.init(s.device_path())
 
         logger.info("Initialisation completed successfully.")
 
-    def backup(self):
+    def tune_store(self):
 
-        with RemoteFS.init(self.remote) as fs:
+        # Applies what can be changed on an existing store.  The cipher and
+        # sector size are fixed until the store is re-encrypted.
+        with self.store_path() as encrypted_store:
 
-            encrypted_store = fs.mount_point() + "/" + self.store.name
+            EncryptedStore.convert_key(
+                encrypted_store, self.store.keyfile, self.store.pbkdf,
+                self.store.pbkdf_iterations
+            )
 
-            with EncryptedStore(encrypted_store, self.store.keyfile) as s:
+            with EncryptedStore(
+                    encrypted_store, self.store.keyfile,
+                    self.store.no_workqueue, self.store.discard,
+                    self.target.name
+            ) as s:
+                s.refresh()
 
-                with Volume(s.device_path()) as vol:
+        logger.info("Store tuned successfully.")
 
-                    for direc in self.directories:
+    @contextmanager
+    def attach(self, target=None):
 
-                        DirectoryBackup.run(
-                            direc.key, direc.directory, vol.mount_point(),
-                            self.strategy
-                        )
+        target = target or self.target
+        store = target.store
+
+        with self.store_path(target) as encrypted_store:
+
+            with EncryptedStore(
+                    encrypted_store, store.keyfile, store.no_workqueue,
+                    store.discard, target.name
+            ) as s:
+
+                with Volume(
+                        s.device_path(), self.strategy.cleanup_timeout,
+                        Volume.mount_options(store), store.discard,
+                        target.name
+                ) as vol:
+
+                    with SpaceMonitor(
+                            s, vol, store.grow_free, store.grow_step,
+                            store.grow_max
+                    ):
+                        yield vol
+
+    def backup(self, cache_paths=None):
+
+        Report.begin("backup")
+
+        try:
+            with self.measure_cache(cache_paths), \
+                 Governor(self.limits, self.directories):
+                self.fan_out(self.backup_target)
+        except Exception as e:
+            self.finish(e)
+            raise
+
+        self.finish()
 
         logger.info("Backup cycle completed successfully.")
 
-    def mount(self):
+    @contextmanager
+    def measure_cache(self, paths):
 
-        logger.info("Mounting backup target...")
+        # Page cache residency of the given files, or of a sample of the
+        # source directories, before and after the run
+        if paths is None:
+            yield
+            return
+
+        files = PageCache.sample(
+            paths or [ direc.directory for direc in self.directories ]
+        )
+
+        PageCache.measure(files, "before")
+
+        try:
+            yield
+        finally:
+            PageCache.measure(files, "after")
+
+    def fan_out(self, fn):
+
+        # fn(target, scans) for every target at once, each with its own
+        # store, so a slow remote doesn't hold back the others.  Sources
+        # scanned for one target are shared with the rest.
+        if len(self.targets) == 1:
+            fn(self.targets[0], None)
+            return
+
+        scans = SharedScan()
+        failed = []
+
+        with ThreadPoolExecutor(max_workers=len(self.targets)) as ex:
+
+            futures = {
+                ex.submit(
+                    Report.propagate(self.run_target), fn, target, scans
+                ): target.name
+                for target in self.targets
+            }
+
+            for future in as_completed(futures):
+
+                name = futures[future]
+
+                try:
+                    future.result()
+                    logger.info(f" \u2713 target {name}")
+                except Exception as e:
+                    logger.error(f" \u274c target {name}: {e}")
+                    failed.append(name)
+
+        if failed:
+            raise RuntimeError(
+                "Backup failed for targets: " + ", ".join(failed)
+            )
+
+    def run_target(self, fn, target, scans):
+        with Report.span("target", target=target.name):
+            fn(target, scans)
+
+    def backup_target(self, target, scans):
+
+        with self.attach(target) as vol:
+            self.backup_directories(
+                vol.mount_point(), vol.cleaner, target=target, scans=scans
+            )
+
+    def backup_directories(self, mnt, cleaner=None, directories=None,
+                           stop=None, target=None, scans=None):
+
+        target = target or self.target
+
+        if directories is None:
+            directories = self.directories
+
+        # Longest first, using durations from the run history, so the big
+        # trees don't start last and leave a long tail
+        history = RunHistory(self.strategy.state)
+
+        directories = sorted(
+            directories,
+            key=lambda direc: history.cost(direc.key, target.name),
+            reverse=True
+        )
+
+        failed = []
 
-        with RemoteFS.init(self.remote) as fs:
+        # Each key is handled start to finish by a single worker, so a key's
+        # rotation never overlaps with its own rsync
+        with ThreadPoolExecutor(max_workers=self.strategy.parallelism) as ex:
 
-            encrypted_store = fs.mount_point() + "/" + self.store.name
+            futures = {
+                ex.submit(
+                    Report.propagate(self.backup_directory), direc, mnt,
+                    cleaner, stop, target, scans
+                ): direc.key
+                for direc in directories
+            }
 
-            with EncryptedStore(encrypted_store, self.store.keyfile) as s:
+            for future in as_completed(futures):
+
+                key = futures[future]
+
+                if target.name:
+                    key = target.name + "/" + key
+
+                try:
+                    future.result()
+                    logger.info(f" \u2713 {key}")
+                except Exception as e:
+                    logger.error(f" \u274c {key}: {e}")
+                    failed.append(key)
+
+        # A local copy, so searches don't need the store
+        if self.strategy.catalog:
+            Catalog.on(mnt).export(self.catalog_path(target))
+
+        if failed:
+            raise RuntimeError("Backup failed for: " + ", ".join(failed))
+
+    def finish(self, error=None):
+
+        # End of a run: reports written, and results kept in the history
+        Report.finish(self.reporting, error)
+        RunHistory(self.strategy.state).record(Report.root)
+
+    def probe_compression(self, settings, size):
+
+        with self.attach() as vol:
+            CompressionProbe.run(vol, self.directories, settings, size)
+
+    def probe_remote(self, size):
+
+        if self.raw():
+            raise RuntimeError("No remote filesystem to probe in raw mode")
+
+        if EncryptedStore(None, None, name=self.target.name).is_open():
+            raise RuntimeError("The store is in use, not probing")
+
+        with RemoteFS.init(self.remote, self.target.name) as fs:
+            RemoteProbe.run(fs.mount_point(), self.store.name, size)
+
+    def report(self, days=30, threshold=0.5):
+        RunHistory(self.strategy.state).report(days, threshold)
+
+    def backup_directory(self, direc, mnt, cleaner, stop, target=None,
+                         scans=None):
+
+        # Work not yet started is dropped on shutdown
+        if stop and stop.is_set():
+            logger.info(f"Shutting down, skipping {direc.key}")
+            return
+
+        with self.slots:
+            DirectoryBackup.run(
+                direc, mnt, self.strategy, cleaner, target and target.name,
+                scans
+            )
+
+    def catalog_path(self, target):
+
+        name = target.name
+
+        return self.strategy.state + "/catalog" + (
+            "." + name if name else ""
+        ) + ".db"
+
+    def search(self, pattern, key=None):
+
+        local = self.catalog_path(self.target)
+
+        if os.path.exists(local):
+            results = Catalog(local).search(pattern, key)
+        else:
+            with self.attach() as vol:
+                results = Catalog.on(vol.mount_point()).search(pattern, key)
+
+        for r in results:
+
+            stages = str(r["newest"])
+            if r["oldest"] != r["newest"]:
+                stages += "-" + str(r["oldest"])
+
+            mtime = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(r["mtime"] / 1e9)
+            )
+
+            print(
+                f"{r['key']:<12} {stages:<7} {r['size']:>12} {mtime}  "
+                f"{r['path']}"
+            )
+
+        logger.info(f"{len(results)} versions found")
+
+    def restore(self, key, to, stage=None, at=None, paths=[], threads=16):
+
+        if key not in [ direc.key for direc in self.directories ]:
+            raise RuntimeError(f"No directory with key '{key}'")
+
+        if stage is not None and at is not None:
+            raise RuntimeError("Give a stage or a time, not both")
+
+        with self.attach() as vol:
+
+            src = Restore.source(
+                key, vol.mount_point(), self.strategy, stage, at
+            )
+
+            logger.info(f"Restoring from {os.path.basename(src)} to {to}")
+
+            with Report.span(
+                    "restore", key=key, source=os.path.basename(src)
+            ):
+                Restore.run(src, to, paths, threads)
+
+        logger.info("Restore completed successfully.")
+
+    def verify_backup(self, full=False, scrub=False, threads=16):
+
+        failed = []
+
+        with self.attach() as vol:
+
+            for direc in self.directories:
+
+                with Report.span("verify", key=direc.key, full=full):
+                    failed += [
+                        f"{direc.key}.{stage}: {rel}"
+                        for stage, rel in Verifier.run(
+                            direc.key, vol.mount_point(), self.strategy, full,
+                            threads, self.strategy.verify_rate
+                        )
+                    ]
+
+            if scrub:
+                vol.scrub()
+
+        if failed:
+            raise RuntimeError(
+                f"{len(failed)} files failed verification: " +
+                ", ".join(failed[:10]) + (", ..." if len(failed) > 10 else "")
+            )
+
+        logger.info("Verification completed successfully.")
+
+    def migrate_layout(self):
+
+        if self.strategy.layout != "timestamp":
+            raise RuntimeError("Set strategy.layout to timestamp to migrate")
+
+        with self.attach() as vol:
+
+            for direc in self.directories:
+                DirectoryBackup.migrate(
+                    direc.key, vol.mount_point(), self.strategy
+                )
+
+        logger.info("Migration completed successfully.")
+
+    def watch(self):
+
+        directories = [
+            direc for direc in self.directories if direc.journal
+        ]
+
+        if not directories:
+            raise RuntimeError("No directories have journal enabled")
+
+        Watcher.run(directories, self.strategy.state)
+
+    def mount(self):
+
+        logger.info("Mounting backup target...")
 
-                with Volume(s.device_path()) as vol:
+        with self.attach() as vol:
 
-                    print("*** Backup target is mounted on", vol.mount_point())
-                    print("*** Press Ctrl-C to unmount")
+            print("*** Backup target is mounted on", vol.mount_point())
+            print("*** Press Ctrl-C to unmount")
 
-                    while True:
-                        time.sleep(10)
+            while True:
+                time.sleep(10)
 
         logger.info("Unmounted")
 
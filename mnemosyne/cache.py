@@ -0,0 +1,149 @@
+
+import logging
+import os
+import stat
+import mmap
+import ctypes
+
+from .report import Report
+
+logger = logging.getLogger("mnemosyne")
+
+libc = ctypes.CDLL(None, use_errno=True)
+
+PAGE = mmap.PAGESIZE
+
+# Files looked at per path when measuring residency
+SAMPLE = 1000
+
+class PageCache:
+
+    @staticmethod
+    def resident(fd):
+
+        # Pages of a file in the page cache, and its size in pages.  A
+        # private mapping doesn't read anything in, and mincore reports on
+        # the file's pages.
+        size = os.fstat(fd).st_size
+
+        if size == 0:
+            return 0, 0
+
+        pages = (size + PAGE - 1) // PAGE
+
+        m = mmap.mmap(fd, size, access=mmap.ACCESS_COPY)
+
+        try:
+            buf = ctypes.c_char.from_buffer(m)
+            vec = (ctypes.c_ubyte * pages)()
+            ret = libc.mincore(
+                ctypes.c_void_p(ctypes.addressof(buf)), ctypes.c_size_t(size),
+                vec
+            )
+            del buf
+            if ret != 0:
+                raise OSError(ctypes.get_errno(), "mincore")
+        finally:
+            m.close()
+
+        return sum(v & 1 for v in vec), pages
+
+    @staticmethod
+    def drop(fd, offset=0, length=0):
+
+        # Dirty pages are only dropped once written, but this starts that
+        try:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+    @staticmethod
+    def meminfo():
+
+        # In MB
+        info = {}
+
+        with open("/proc/meminfo") as f:
+            for line in f:
+                name, value = line.split(":")
+                if name in [
+                        "Cached", "Buffers", "Dirty", "Active(file)",
+                        "Inactive(file)"
+                ]:
+                    info[name] = int(value.split()[0]) / 1024
+
+        return info
+
+    @staticmethod
+    def sample(paths):
+
+        # Files to measure: the files given, and the first of each
+        # directory in walk order
+        files = []
+
+        for path in paths:
+
+            if not os.path.isdir(path):
+                files.append(path)
+                continue
+
+            count = 0
+
+            for top, dirs, names in os.walk(path):
+
+                dirs.sort()
+
+                for name in sorted(names):
+                    files.append(os.path.join(top, name))
+                    count += 1
+                    if count >= SAMPLE:
+                        break
+
+                if count >= SAMPLE:
+                    break
+
+        return files
+
+    @staticmethod
+    def measure(files, when):
+
+        resident = 0
+        pages = 0
+
+        for path in files:
+
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+            except OSError:
+                continue
+
+            try:
+                if stat.S_ISREG(os.fstat(fd).st_mode):
+                    r, p = PageCache.resident(fd)
+                    resident += r
+                    pages += p
+            except OSError:
+                pass
+            finally:
+                os.close(fd)
+
+        info = PageCache.meminfo()
+
+        result = {
+            "files": len(files),
+            "resident_mb": round(resident * PAGE / 1e6, 1),
+            "total_mb": round(pages * PAGE / 1e6, 1),
+            "cached_mb": round(info.get("Cached", 0), 1),
+            "dirty_mb": round(info.get("Dirty", 0), 1),
+        }
+
+        logger.info(
+            f"Page cache {when}: {result['resident_mb']} of "
+            f"{result['total_mb']} MB of sampled files resident, "
+            f"{result['cached_mb']} MB cached in total, "
+            f"{result['dirty_mb']} MB dirty"
+        )
+
+        Report.event("cache.residency", when=when, **result)
+
+        return result
@@ -0,0 +1,482 @@
+
+import logging
+import os
+import stat
+import gzip
+import bisect
+import sqlite3
+
+from .sync import NativeSync, SIZE, MTIME, MODE
+from .subvolume import Subvolume
+from .report import Report
+
+logger = logging.getLogger("mnemosyne")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+    key TEXT PRIMARY KEY,
+    epoch INTEGER,
+    dirty INTEGER,
+    generation INTEGER
+);
+CREATE TABLE IF NOT EXISTS versions (
+    key TEXT,
+    path TEXT,
+    size INTEGER,
+    mtime INTEGER,
+    first INTEGER,
+    last INTEGER
+);
+CREATE TABLE IF NOT EXISTS dirs (
+    key TEXT,
+    path TEXT,
+    ctime INTEGER,
+    PRIMARY KEY (key, path)
+);
+CREATE INDEX IF NOT EXISTS versions_path ON versions(path, key);
+CREATE INDEX IF NOT EXISTS versions_open ON versions(key, last);
+"""
+
+class Catalog:
+
+    # Every version of every file and symlink across the stages of each
+    # key.  Each rotation starts a new epoch, so with a key at epoch E,
+    # key.N is epoch E-N, and a version held from epoch `first` to `last`
+    # (NULL while it's still in key.0) is in stages E-last to E-first.
+    #
+    # Keys backed up in parallel share the database.  The trees are read
+    # outside any transaction, and SQLite serializes the short writes
+    # which follow.
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def on(mnt):
+        return Catalog(mnt + "/.catalog.db")
+
+    def connect(self):
+
+        db = sqlite3.connect(self.path, timeout=600)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode = WAL")
+        db.executescript(SCHEMA)
+
+        return db
+
+    def epoch(self, db, key):
+
+        row = db.execute(
+            "SELECT epoch FROM keys WHERE key = ?", (key,)
+        ).fetchone()
+
+        return None if row is None else row["epoch"]
+
+    def open_versions(self, db, key):
+        return {
+            row["path"]: (row["size"], row["mtime"])
+            for row in db.execute(
+                "SELECT path, size, mtime FROM versions "
+                "WHERE key = ? AND last IS NULL",
+                (key,)
+            )
+        }
+
+    @staticmethod
+    def close(db, key, path, epoch):
+
+        # A version which was never in a snapshot has nothing to find
+        db.execute(
+            "DELETE FROM versions "
+            "WHERE key = ? AND path = ? AND last IS NULL AND first = ?",
+            (key, path, epoch)
+        )
+        db.execute(
+            "UPDATE versions SET last = ? "
+            "WHERE key = ? AND path = ? AND last IS NULL",
+            (epoch - 1, key, path)
+        )
+
+    @staticmethod
+    def add(db, key, path, cur, epoch):
+        db.execute(
+            "INSERT INTO versions (key, path, size, mtime, first, last) "
+            "VALUES (?, ?, ?, ?, ?, NULL)",
+            (key, path, cur[SIZE], cur[MTIME], epoch)
+        )
+
+    @staticmethod
+    def scan(path):
+
+        # Files and symlinks, the things anyone searches for
+        return {
+            rel: cur for rel, cur in NativeSync.scan(path).items()
+            if not stat.S_ISDIR(cur[MODE])
+        }
+
+    @staticmethod
+    def directories(root, known):
+
+        # The ctime of every directory under root, which changes whenever
+        # an entry is added, removed or renamed, and for those whose ctime
+        # isn't the known one, the names of their subdirectories and of
+        # everything else in them.  Only directories are stat'ed.
+        ctimes = {}
+        listings = {}
+
+        def walk(path, rel, ctime):
+
+            ctimes[rel] = ctime
+            prefix = rel + "/" if rel else ""
+            dirs = []
+            files = set()
+
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry)
+                    else:
+                        files.add(entry.name)
+
+            if known.get(rel) != ctime:
+                listings[rel] = (set(entry.name for entry in dirs), files)
+
+            for entry in dirs:
+                try:
+                    walk(
+                        entry.path, prefix + entry.name,
+                        entry.stat(follow_symlinks=False).st_ctime_ns
+                    )
+                except OSError:
+                    continue
+
+        walk(root, "", os.lstat(root).st_ctime_ns)
+
+        return ctimes, listings
+
+    def apply_scan(self, db, key, entries, epoch):
+
+        current = self.open_versions(db, key)
+
+        for path, cur in entries.items():
+            if current.get(path) != (cur[SIZE], cur[MTIME]):
+                if path in current:
+                    Catalog.close(db, key, path, epoch)
+                Catalog.add(db, key, path, cur, epoch)
+
+        for path in current.keys() - entries.keys():
+            Catalog.close(db, key, path, epoch)
+
+    def apply(self, db, key, current, changes, epoch):
+
+        # changes is a list of (path, entry), with None for a path which
+        # has gone, and everything under it if it was a directory
+        names = sorted(current)
+        count = 0
+
+        for path, cur in changes:
+
+            if cur is None:
+
+                lo = bisect.bisect_left(names, path + "/")
+                hi = bisect.bisect_left(names, path + "0")
+
+                for p in [ path ] + names[lo:hi]:
+                    if p in current:
+                        Catalog.close(db, key, p, epoch)
+                        del current[p]
+                        count += 1
+
+                continue
+
+            if current.get(path) != (cur[SIZE], cur[MTIME]):
+                if path in current:
+                    Catalog.close(db, key, path, epoch)
+                else:
+                    bisect.insort(names, path)
+                Catalog.add(db, key, path, cur, epoch)
+                current[path] = (cur[SIZE], cur[MTIME])
+                count += 1
+
+        return count
+
+    @Report.timed("catalog.start")
+    def start(self, key, stages):
+
+        # stages is every copy of the key, oldest first, ending with key.0.
+        # A key new to the catalog is built from them; one whose last
+        # update didn't finish is brought up to date from key.0.
+        db = self.connect()
+
+        try:
+
+            epoch = self.epoch(db, key)
+
+            if epoch is None:
+
+                logger.info(f"Building catalog for {key}...")
+
+                # Anything left by a build which didn't finish
+                with db:
+                    db.execute("DELETE FROM versions WHERE key = ?", (key,))
+                    db.execute("DELETE FROM dirs WHERE key = ?", (key,))
+
+                for epoch, path in enumerate(stages):
+                    entries = Catalog.scan(path)
+                    with db:
+                        self.apply_scan(db, key, entries, epoch)
+
+                with db:
+                    db.execute(
+                        "INSERT INTO keys VALUES (?, ?, 1, NULL)",
+                        (key, max(len(stages) - 1, 0))
+                    )
+
+                return
+
+            row = db.execute(
+                "SELECT dirty FROM keys WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row["dirty"] and stages:
+                logger.info(f"Reconciling catalog for {key}...")
+                entries = Catalog.scan(stages[-1])
+                with db:
+                    self.apply_scan(db, key, entries, epoch)
+
+            with db:
+                db.execute("UPDATE keys SET dirty = 1 WHERE key = ?", (key,))
+
+        finally:
+            db.close()
+
+    def rotate(self, key, stages):
+
+        db = self.connect()
+
+        try:
+            with db:
+
+                epoch = self.epoch(db, key) + 1
+
+                db.execute(
+                    "UPDATE keys SET epoch = ? WHERE key = ?", (epoch, key)
+                )
+
+                # Versions which have dropped out of the last stage, and the
+                # rest held no further back than it
+                oldest = epoch - (stages - 1)
+
+                db.execute(
+                    "DELETE FROM versions "
+                    "WHERE key = ? AND last IS NOT NULL AND last < ?",
+                    (key, oldest)
+                )
+                db.execute(
+                    "UPDATE versions SET first = ? "
+                    "WHERE key = ? AND first < ?",
+                    (oldest, key, oldest)
+                )
+        finally:
+            db.close()
+
+    @Report.timed("catalog.update")
+    def update(self, key, target, changes=None):
+
+        # From the itemized change list of the transfer, checking each
+        # changed path in key.0.  Without one, from what btrfs has written
+        # to key.0 since the last update.
+        db = self.connect()
+
+        try:
+
+            epoch = self.epoch(db, key)
+
+            if changes is None:
+                self.apply_generation(db, key, target, epoch)
+            else:
+                self.apply_changes(db, key, target, changes, epoch)
+
+        finally:
+            db.close()
+
+    @staticmethod
+    def lstat(target, name):
+        try:
+            return NativeSync.entry(os.lstat(os.path.join(target, name)))
+        except FileNotFoundError:
+            return None
+
+    def apply_changes(self, db, key, target, changes, epoch):
+
+        found = []
+
+        with gzip.open(changes, "rt") as f:
+
+            for line in f:
+
+                item, name = line[:11], line[12:].rstrip("\n")
+
+                # A directory takes everything under it
+                if item.startswith("*deleting"):
+                    found.append((name.rstrip("/"), None))
+                    continue
+
+                if item[1] == "d":
+                    continue
+
+                if item[1] == "L":
+                    name = name.split(" -> ")[0]
+                elif item[0] == "h":
+                    name = name.split(" => ")[0]
+
+                cur = Catalog.lstat(target, name)
+
+                # The send engine lists directories like anything else
+                if cur is not None and not stat.S_ISDIR(cur[MODE]):
+                    found.append((name, cur))
+
+        with db:
+            count = self.apply(
+                db, key, self.open_versions(db, key), found, epoch
+            )
+            db.execute("UPDATE keys SET dirty = 0 WHERE key = ?", (key,))
+
+        logger.info(f"Catalog for {key}: {count} versions updated")
+
+    def apply_generation(self, db, key, target, epoch):
+
+        row = db.execute(
+            "SELECT generation FROM keys WHERE key = ?", (key,)
+        ).fetchone()
+
+        known = {
+            r["path"]: r["ctime"]
+            for r in db.execute(
+                "SELECT path, ctime FROM dirs WHERE key = ?", (key,)
+            )
+        }
+
+        # The generation is read first, so anything written after it is
+        # picked up next time
+        if row["generation"] is None:
+            paths, generation = Subvolume.find_new(target)
+            entries = Catalog.scan(target)
+            known = {}
+        else:
+            paths, generation = Subvolume.find_new(target, row["generation"])
+            entries = None
+
+        ctimes, listings = Catalog.directories(target, known)
+
+        found = []
+
+        if entries is None:
+
+            current = self.open_versions(db, key)
+
+            # find-new only lists files with new data.  Anything removed,
+            # renamed or linked shows in its directory's ctime, so only
+            # those directories are compared with the catalog.
+            children = {}
+            for path in current:
+                parent, _, name = path.rpartition("/")
+                children.setdefault(parent, set()).add(name)
+
+            subdirs = {}
+            for path in known:
+                if path:
+                    parent, _, name = path.rpartition("/")
+                    subdirs.setdefault(parent, set()).add(name)
+
+            listed = set()
+
+            for rel, (dirs, files) in listings.items():
+
+                prefix = rel + "/" if rel else ""
+
+                for name in children.get(rel, set()) - files:
+                    found.append((prefix + name, None))
+
+                for name in subdirs.get(rel, set()) - dirs:
+                    found.append((prefix + name, None))
+
+                for name in files:
+                    listed.add(prefix + name)
+                    cur = Catalog.lstat(target, prefix + name)
+                    if cur is not None:
+                        found.append((prefix + name, cur))
+
+            for name in paths - listed:
+                cur = Catalog.lstat(target, name)
+                if cur is not None and not stat.S_ISDIR(cur[MODE]):
+                    found.append((name, cur))
+
+        with db:
+
+            if entries is None:
+                count = self.apply(db, key, current, found, epoch)
+            else:
+                self.apply_scan(db, key, entries, epoch)
+                db.execute("DELETE FROM dirs WHERE key = ?", (key,))
+                count = len(entries)
+
+            db.executemany(
+                "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)",
+                ((key, rel, ctimes[rel]) for rel in listings)
+            )
+            db.executemany(
+                "DELETE FROM dirs WHERE key = ? AND path = ?",
+                ((key, rel) for rel in known.keys() - ctimes.keys())
+            )
+
+            db.execute(
+                "UPDATE keys SET generation = ?, dirty = 0 WHERE key = ?",
+                (generation, key)
+            )
+
+        logger.info(f"Catalog for {key}: {count} versions updated")
+
+    def export(self, path):
+
+        # A copy to search without attaching the store
+        tmp = path + ".tmp"
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        src = self.connect()
+        dst = sqlite3.connect(tmp)
+        src.backup(dst)
+        dst.close()
+        src.close()
+
+        os.replace(tmp, path)
+
+    def search(self, pattern, key=None):
+
+        # A glob, or else an exact path or file name
+        db = self.connect()
+
+        if any(c in pattern for c in "*?["):
+            where = "v.path GLOB ?"
+            args = [ pattern ]
+        else:
+            where = "(v.path = ? OR v.path GLOB ?)"
+            args = [ pattern.strip("/"), "*/" + pattern.strip("/") ]
+
+        if key:
+            where += " AND v.key = ?"
+            args.append(key)
+
+        rows = db.execute(
+            "SELECT v.key, v.path, v.size, v.mtime, "
+            "k.epoch - COALESCE(v.last, k.epoch) AS newest, "
+            "k.epoch - v.first AS oldest "
+            "FROM versions v JOIN keys k ON k.key = v.key "
+            f"WHERE {where} ORDER BY v.key, v.path, v.first DESC",
+            args
+        ).fetchall()
+
+        db.close()
+
+        return [ dict(row) for row in rows ]
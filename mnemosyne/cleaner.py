@@ -0,0 +1,169 @@
+
+import logging
+import subprocess
+import os
+import shutil
+import threading
+import time
+
+from .report import Report
+
+logger = logging.getLogger("mnemosyne")
+
+class SubvolumeCleaner:
+
+    def __init__(self, mnt, batch=32, delay=10):
+        self.mnt = mnt
+        self.trash = mnt + "/.trash"
+        self.batch = batch
+        self.delay = delay
+        self.queue = []
+        self.busy = 0
+        self.stopping = False
+        self.draining = False
+        self.count = 0
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def start(self):
+
+        os.makedirs(self.trash, exist_ok=True)
+
+        # Deletions queued by an earlier run which didn't drain in time
+        self.queue = [
+            self.trash + "/" + name for name in sorted(os.listdir(self.trash))
+        ]
+
+        if self.queue:
+            logger.info(f"Resuming {len(self.queue)} subvolume deletions")
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def delete(self, subvol):
+
+        # Renamed out of the way straight away, so the caller can re-use
+        # the name; the actual delete happens later
+        with self.cond:
+            self.count += 1
+            dest = (
+                self.trash + "/" + os.path.basename(subvol) + "." +
+                str(int(time.time())) + "." + str(self.count)
+            )
+
+        os.rename(subvol, dest)
+
+        with self.cond:
+            self.queue.append(dest)
+            self.cond.notify_all()
+
+    def pending(self):
+        with self.cond:
+            return len(self.queue) + self.busy
+
+    def run(self):
+
+        while True:
+
+            with self.cond:
+
+                while not self.queue and not self.stopping:
+                    self.cond.wait()
+
+                if self.stopping:
+                    return
+
+                # Give rotation a moment to queue the rest of its deletions
+                # so that they go as one batch, unless someone is waiting.
+                # Each arrival wakes us, so wait out the whole window.
+                deadline = time.time() + self.delay
+
+                while (
+                        not self.draining and not self.stopping and
+                        len(self.queue) < self.batch
+                ):
+                    left = deadline - time.time()
+                    if left <= 0:
+                        break
+                    self.cond.wait(left)
+
+                if self.stopping:
+                    return
+
+                paths = self.queue[:self.batch]
+                self.queue = self.queue[self.batch:]
+                self.busy = len(paths)
+
+            try:
+                SubvolumeCleaner.delete_subvolumes(paths)
+            except Exception as e:
+                # Left in the trash directory, picked up on the next start
+                logger.error(f"Subvolume cleanup failed: {e}")
+
+            with self.cond:
+                self.busy = 0
+                self.cond.notify_all()
+
+    @staticmethod
+    @Report.timed("subvolume.delete")
+    def delete_subvolumes(paths):
+
+        logger.info(f"Deleting {len(paths)} subvolumes...")
+
+        # One multi-path delete, and no --commit-after, so btrfs commits in
+        # its own time.  Idle I/O class keeps the backup ahead of us.
+        cmd = [ "btrfs", "subvolume", "delete" ] + paths
+
+        if shutil.which("ionice"):
+            cmd = [ "ionice", "-c", "3" ] + cmd
+
+        proc = subprocess.run(cmd)
+
+        if proc.returncode != 0:
+            raise RuntimeError(
+                "Removal of subvolume"
+            )
+
+    def drain(self, timeout=600, report=10):
+
+        start = time.time()
+
+        with self.cond:
+
+            self.draining = True
+            self.cond.notify_all()
+
+            while self.queue or self.busy:
+
+                elapsed = time.time() - start
+
+                if elapsed >= timeout:
+                    break
+
+                logger.info(
+                    f"Waiting for {len(self.queue) + self.busy} "
+                    "subvolume deletions..."
+                )
+
+                self.cond.wait(min(report, timeout - elapsed))
+
+            # Stop taking new batches.  A running one is waited for while
+            # time remains, since the volume can't unmount under it.
+            self.stopping = True
+            self.cond.notify_all()
+
+            left = len(self.queue)
+
+        self.thread.join(max(timeout - (time.time() - start), 0))
+
+        if self.thread.is_alive():
+            logger.info(
+                "Cleanup timed out with a subvolume deletion still running"
+            )
+        elif left:
+            logger.info(
+                f"Cleanup timed out, {left} subvolume deletions deferred "
+                "to the next run"
+            )
+        else:
+            logger.info("Subvolume cleanup complete")
@@ -0,0 +1,210 @@
+
+import logging
+import os
+import time
+import threading
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+
+from .report import Report
+from .governor import Governor
+from .history import RunHistory
+
+logger = logging.getLogger("mnemosyne")
+
+# Delay before trying again when the store can't be attached
+ATTACH_RETRY = 300
+
+class Daemon:
+
+    def __init__(self, backup):
+        self.backup = backup
+        self.strategy = backup.strategy
+        self.stopping = threading.Event()
+        self.stacks = {}
+        self.vols = {}
+
+        # Picked up from the history, so a restart doesn't back everything
+        # up again straight away
+        history = RunHistory(self.strategy.state)
+        self.last = {
+            direc.key: history.last(direc.key)
+            for direc in backup.directories
+        }
+
+    def stop(self):
+        self.stopping.set()
+
+    def interval(self, direc):
+
+        # Hours, per directory or from the strategy
+        if direc.interval is not None:
+            return direc.interval * 3600
+
+        return self.strategy.interval * 3600
+
+    def due(self, now):
+        return [
+            direc for direc in self.backup.directories
+            if now - self.last.get(direc.key, 0) >= self.interval(direc)
+        ]
+
+    def next_due(self, now):
+        return min(
+            (
+                self.last.get(direc.key, 0) + self.interval(direc) - now
+                for direc in self.backup.directories
+            ),
+            default=self.strategy.interval * 3600
+        )
+
+    def attach(self):
+
+        # Any target not attached yet, in parallel.  Those which fail are
+        # tried again next cycle, and miss this one.
+        missing = [
+            target for target in self.backup.targets
+            if target.name not in self.stacks
+        ]
+
+        if not missing:
+            return
+
+        logger.info("Attaching backup store...")
+
+        def enter(target):
+
+            stack = ExitStack()
+
+            try:
+                vol = stack.enter_context(self.backup.attach(target))
+            except:
+                stack.close()
+                raise
+
+            return stack, vol
+
+        with ThreadPoolExecutor(max_workers=len(missing)) as ex:
+            futures = {
+                target.name: ex.submit(Report.propagate(enter), target)
+                for target in missing
+            }
+
+        errors = []
+
+        for name, future in futures.items():
+            try:
+                self.stacks[name], self.vols[name] = future.result()
+            except Exception as e:
+                if name:
+                    logger.error(f"Attach failed for target {name}: {e}")
+                errors.append(e)
+
+        if not self.stacks:
+            raise errors[0]
+
+    def detach(self, name=None):
+
+        names = list(self.stacks) if name is None else [ name ]
+
+        for name in names:
+
+            logger.info("Detaching backup store...")
+
+            try:
+                self.stacks[name].close()
+            except Exception as e:
+                logger.error(f"Detach failed: {e}")
+
+            del self.stacks[name]
+            del self.vols[name]
+
+    def healthy(self, vol):
+
+        try:
+            if not vol.is_mounted():
+                return False
+            os.statvfs(vol.mount_point())
+            os.listdir(vol.mount_point())
+            return True
+        except Exception as e:
+            logger.error(f"Health check failed: {e}")
+            return False
+
+    def cycle(self, target, scans, due):
+
+        vol = self.vols.get(target.name)
+
+        if vol is None:
+            raise RuntimeError("Backup store not attached")
+
+        self.backup.backup_directories(
+            vol.mount_point(), vol.cleaner, due, stop=self.stopping,
+            target=target, scans=scans
+        )
+
+    def run(self):
+
+        idle_since = time.time()
+
+        try:
+
+            while not self.stopping.is_set():
+
+                now = time.time()
+                due = self.due(now)
+
+                if due:
+
+                    Report.begin("cycle")
+
+                    for name, vol in list(self.vols.items()):
+                        if not self.healthy(vol):
+                            logger.info("Backup store unhealthy, re-attaching")
+                            self.detach(name)
+
+                    try:
+                        self.attach()
+                    except Exception as e:
+                        logger.error(f"Attach failed: {e}")
+                        self.backup.finish(e)
+                        self.stopping.wait(ATTACH_RETRY)
+                        continue
+
+                    for direc in due:
+                        self.last[direc.key] = now
+
+                    try:
+                        with Governor(
+                                self.backup.limits, self.backup.directories
+                        ):
+                            self.backup.fan_out(
+                                lambda target, scans:
+                                self.cycle(target, scans, due)
+                            )
+                        logger.info("Backup cycle completed successfully.")
+                        self.backup.finish()
+                    except Exception as e:
+                        logger.error(f"Backup cycle failed: {e}")
+                        self.backup.finish(e)
+
+                    idle_since = time.time()
+                    continue
+
+                wait = self.next_due(now)
+
+                # Stay attached while more work is close, otherwise let go
+                # of the NAS until it's needed
+                if self.stacks:
+                    idle = self.strategy.idle * 60
+                    if now - idle_since >= idle:
+                        self.detach()
+                    else:
+                        wait = min(wait, idle_since + idle - now)
+
+                self.stopping.wait(max(wait, 1))
+
+        finally:
+            self.detach()
+
+        logger.info("Daemon stopped")
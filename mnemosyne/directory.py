@@ -1,22 +1,95 @@
 
 import logging
-import subprocess
 import os
 import time
+from contextlib import contextmanager, nullcontext
+
+from .rsync import Rsync, RsyncStats, RsyncOutput, ChangeList
+from .shard import ShardedSync
+from .sync import NativeSync
+from .send import SendReceive
+from .journal import ChangeJournal
+from .report import Report
+from .subvolume import Subvolume
+from .catalog import Catalog
+from .profiles import TransferProfile
 
 logger = logging.getLogger("mnemosyne")
 
 class DirectoryBackup:
 
     @staticmethod
-    def run(key, directory, mnt, strategy):
+    def run(direc, mnt, strategy, cleaner=None, target=None, scans=None):
+
+        start = time.time()
+
+        attrs = { "key": direc.key }
+
+        if target:
+            attrs["target"] = target
+
+        with Report.span("directory", **attrs) as span:
+
+            profile = DirectoryBackup.backup(
+                direc, mnt, strategy, cleaner, target, scans
+            )
+
+            # Totals over every rsync for the key, e.g. across shards
+            stats = RsyncStats.total(span)
+
+            if stats.wall_time:
+                summary = stats.summary()
+                span.attrs.update(summary)
+                logger.info(
+                    f"{direc.key}: {stats.files} files scanned, "
+                    f"{stats.files_transferred} transferred, "
+                    f"{stats.literal + stats.matched} bytes, "
+                    f"scan {stats.scan_time:.1f}s, "
+                    f"transfer {summary['transfer_time']:.1f}s, "
+                    f"{summary['mb_per_sec']} MB/s, "
+                    f"{summary['files_per_sec']} files/s, "
+                    f"{summary['bound']}-bound"
+                )
+
+                if profile:
+                    TransferProfile.record(direc, mnt, profile, summary)
+
+        duration = time.time() - start
+
+        logger.info(
+            f"Backup of {direc.key}"
+            f"{' to ' + target if target else ''} took {duration:.1f}s"
+        )
+
+    @staticmethod
+    def last_rotation(key, mnt):
 
         last_path = mnt + "/" + key + ".last"
 
         if os.path.exists(last_path):
-            last_backup = int(open(last_path).read())
-        else:
-            last_backup = 0
+            return int(open(last_path).read())
+
+        return None
+
+    @staticmethod
+    def last_sync(key, mnt):
+
+        # When key.0 was last brought up to date.  Backups made before this
+        # was kept go by the last rotation instead.
+        synced_path = mnt + "/" + key + ".synced"
+
+        if os.path.exists(synced_path):
+            return int(open(synced_path).read())
+
+        return DirectoryBackup.last_rotation(key, mnt)
+
+    @staticmethod
+    def backup(direc, mnt, strategy, cleaner=None, target=None, scans=None):
+
+        key = direc.key
+
+        last_path = mnt + "/" + key + ".last"
+        last_backup = DirectoryBackup.last_rotation(key, mnt) or 0
 
         now = time.time()
         age = now - last_backup
@@ -29,110 +102,363 @@ class DirectoryBackup:
         else:
             rotate = False
 
-        if rotate:
+        # Read before the sync, so changes made during it are picked up by
+        # the next run
+        if direc.journal:
+            journal = ChangeJournal(strategy.state, key, target)
+            changes, journal_state = journal.pending(direc.full_scan)
+
+        if strategy.catalog:
+            catalog = Catalog.on(mnt)
+            catalog.start(key, DirectoryBackup.stages(key, mnt, strategy))
+
+        profile, options = TransferProfile.resolve(direc, mnt)
+
+        if profile:
+            Report.annotate(profile=profile)
+
+        with DirectoryBackup.output(direc, mnt, strategy) as output:
 
-            logger.info(f"Rotating backup directories for {key}...")
+            if rotate:
 
-            for stage in range(strategy.stages - 1, 0, -1):
+                logger.info(f"Rotating backup directories for {key}...")
 
-                cur_target = mnt + "/" + key + "." + str(stage - 1)
-                prior_target = mnt + "/" + key + "." + str(stage)
+                with Report.span("rotate"):
+                    if strategy.layout == "timestamp":
+                        DirectoryBackup.rotate_timestamped(
+                            key, mnt, strategy.stages, cleaner
+                        )
+                    else:
+                        DirectoryBackup.rotate_chain(
+                            key, mnt, strategy.stages, cleaner
+                        )
 
-                if os.path.exists(cur_target):
+                logger.info("Rotation successful")
 
-                    if os.path.exists(prior_target):
-                        DirectoryBackup.delete_subvolume(prior_target)
+                if strategy.catalog:
+                    catalog.rotate(key, strategy.stages)
 
-                    DirectoryBackup.snapshot(
-                        cur_target, prior_target
+                dest = mnt + "/" + key + "." + str(0)
+
+                if not os.path.exists(dest):
+                    logger.info("Creating new subvolume...")
+                    Subvolume.create(dest, direc.compression)
+
+                now = int(time.time())
+                with open(last_path, "w") as lf:
+                    lf.write(f"{now}")
+
+                # As it always has, a rotating run keeps files since
+                # removed from the source, and the runs after it drop them
+                DirectoryBackup.sync(
+                    direc, dest, mnt, False, cleaner, output, scans, options,
+                    target
+                )
+
+            else:
+
+                logger.info(f"Not rotating backup directories for {key}")
+
+                dest = mnt + "/" + key + "." + str(0)
+
+                if direc.journal and changes is not None:
+                    DirectoryBackup.remove_scan(mnt, key)
+                    Rsync.files(
+                        direc.directory, dest, changes, output, options,
+                        delete=True
+                    )
+                else:
+                    DirectoryBackup.sync(
+                        direc, dest, mnt, True, cleaner, output, scans,
+                        options, target
                     )
 
-            logger.info("Rotation successful")
+        # Taken after the sync, since key.0 can hold anything written up to
+        # the end of it
+        with open(mnt + "/" + key + ".synced", "w") as sf:
+            sf.write(f"{int(time.time())}")
+
+        # Without a complete change list, e.g. after a full send, the
+        # catalog goes by the btrfs generation instead
+        if strategy.catalog:
+            catalog.update(
+                key, dest,
+                output.changes.path
+                if output.changes and output.changes.complete else None
+            )
 
-            logger.info("Creating new subvolume...")
+        if direc.journal:
+            journal.commit(journal_state, full=rotate or changes is None)
 
-            target = mnt + "/" + key + "." + str(0)
+        return profile
 
-            if not os.path.exists(cur_target):
-                DirectoryBackup.create_subvolume(target)
+    @staticmethod
+    def output(direc, mnt, strategy):
 
-            now = int(time.time())
-            with open(last_path, "w") as lf:
-                lf.write(f"{now}")
+        # The rsync output settings for a key.  A requested change list only
+        # replaces the previous one when the transfer succeeds.
+        output = RsyncOutput(
+            quiet=strategy.output == "quiet", progress=strategy.progress
+        )
 
-            DirectoryBackup.rsync(directory, target, delete=True)
+        # The catalog is updated from the change list
+        if not (strategy.itemize or strategy.catalog):
+            return nullcontext(output)
 
-        else:
+        return DirectoryBackup.itemized(
+            output, mnt + "/" + direc.key + ".changes.gz"
+        )
 
-            logger.info(f"Not rotating backup directories for {key}")
+    @staticmethod
+    @contextmanager
+    def itemized(output, path):
+
+        output.changes = ChangeList(path)
 
-            target = mnt + "/" + key + "." + str(0)
+        try:
+            yield output
+        except:
+            output.changes.discard()
+            raise
 
-            DirectoryBackup.rsync(directory, target, delete=False)
+        output.changes.close()
 
     @staticmethod
-    def rsync(src, dest, delete=False):
+    def stages(key, mnt, strategy):
 
-        logger.info(f"Syncing directory {src}...")
+        # Copies of a key, oldest first, ending with key.0
+        paths = []
 
-        if delete:
-            proc = subprocess.run(
-                [
-                    "rsync", "-av", src + "/", dest + "/",
-                ]
-            )
-        else:
-            proc = subprocess.run(
-                [
-                    "rsync", "--delete", "-av", src + "/", dest + "/",
-                ]
-            )
+        for stage in range(strategy.stages):
+            path = mnt + "/" + key + "." + str(stage)
+            if not os.path.exists(path):
+                break
+            paths.insert(0, path)
 
-        if proc.returncode != 0:
-            raise RuntimeError(
-                "Directory sync failed"
-            )
+        return paths
 
-        logger.info("Sync complete")
+    @staticmethod
+    def rotate_chain(key, mnt, stages, cleaner=None):
+
+        for stage in range(stages - 1, 0, -1):
+
+            cur_target = mnt + "/" + key + "." + str(stage - 1)
+            prior_target = mnt + "/" + key + "." + str(stage)
+
+            if os.path.exists(cur_target):
+
+                if os.path.exists(prior_target):
+                    Subvolume.remove(prior_target, cleaner)
+
+                Subvolume.snapshot(
+                    cur_target, prior_target
+                )
 
     @staticmethod
-    def delete_subvolume(subvol):
+    def rotate_timestamped(key, mnt, stages, cleaner=None):
 
-        proc = subprocess.run(
-            [
-                "btrfs", "subvolume", "delete", subvol,
-            ]
-        )
+        # One read-only snapshot per rotation, and only the oldest one is
+        # dropped.  The key.N names are symlinks, which are cheap to move.
+        target = mnt + "/" + key + "." + str(0)
 
-        if proc.returncode != 0:
-            raise RuntimeError(
-                "Removal of subvolume"
-            )
+        # Checked before anything is snapshotted or removed, so a store
+        # still in the chain layout isn't left with stray snapshots
+        stage = 1
+        while os.path.lexists(mnt + "/" + key + "." + str(stage)):
+            link = mnt + "/" + key + "." + str(stage)
+            if not os.path.islink(link):
+                raise RuntimeError(
+                    f"{link} is not a symlink, run --migrate-layout first"
+                )
+            stage += 1
+
+        if os.path.exists(target):
+            name = key + ".@" + Subvolume.timestamp()
+            Subvolume.snapshot(target, mnt + "/" + name, readonly=True)
+
+        snapshots = DirectoryBackup.snapshots(key, mnt)
+
+        for name in snapshots[stages - 1:]:
+            Subvolume.remove(mnt + "/" + name, cleaner)
+
+        DirectoryBackup.link_stages(key, mnt, snapshots[:stages - 1])
 
     @staticmethod
-    def snapshot(src, dest):
+    def snapshots(key, mnt):
+
+        # Timestamped snapshots for a key, newest first
+        prefix = key + ".@"
 
-        proc = subprocess.run(
-            [
-                "btrfs", "subvolume", "snapshot", src, dest,
-            ]
+        return sorted(
+            [ name for name in os.listdir(mnt) if name.startswith(prefix) ],
+            reverse=True
         )
 
-        if proc.returncode != 0:
-            raise RuntimeError(
-                "Subvolume snapshot"
-            )
+    @staticmethod
+    def link_stages(key, mnt, snapshots):
+
+        stage = 1
+
+        for name in snapshots:
+
+            link = mnt + "/" + key + "." + str(stage)
+
+            if os.path.exists(link) and not os.path.islink(link):
+                raise RuntimeError(
+                    f"{link} is not a symlink, run --migrate-layout first"
+                )
+
+            tmp = link + ".tmp"
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            os.symlink(name, tmp)
+            os.replace(tmp, link)
+
+            stage += 1
+
+        # Stage links beyond the retained snapshots
+        while os.path.islink(mnt + "/" + key + "." + str(stage)):
+            os.remove(mnt + "/" + key + "." + str(stage))
+            stage += 1
 
     @staticmethod
-    def create_subvolume(subvol):
+    def migrate(key, mnt, strategy):
+
+        last_backup = DirectoryBackup.last_rotation(key, mnt)
+
+        if last_backup is None:
+            last_backup = int(time.time())
+
+        rotate_period = strategy.rotate * 3600
+
+        stage = 1
+
+        while True:
+
+            path = mnt + "/" + key + "." + str(stage)
+
+            if not os.path.exists(path) or os.path.islink(path):
+                break
+
+            # The chain re-snapshots every stage on each rotation, so
+            # creation times don't help.  Stage N was current N-1 rotation
+            # periods before the last one.
+            when = last_backup - (stage - 1) * rotate_period
+            name = key + ".@" + Subvolume.timestamp(when)
+
+            logger.info(f"Migrating {key}.{stage} to {name}...")
+
+            os.rename(path, mnt + "/" + name)
+            Subvolume.set_readonly(mnt + "/" + name)
 
-        proc = subprocess.run(
-            [
-                "btrfs", "subvolume", "create", subvol,
-            ]
+            stage += 1
+
+        DirectoryBackup.link_stages(
+            key, mnt, DirectoryBackup.snapshots(key, mnt)
         )
 
-        if proc.returncode != 0:
-            raise RuntimeError(
-                "Creation of subvolume"
+    @staticmethod
+    def sync(direc, target, mnt, delete=False, cleaner=None, output=None,
+             scans=None, options=[], name=None):
+
+        if direc.engine == "native":
+            NativeSync.run(
+                direc.key, direc.directory, target, mnt, delete=delete,
+                threads=direc.threads, output=output, scans=scans
+            )
+            return
+
+        NativeSync.remove_manifest(mnt, direc.key)
+
+        if scans and direc.engine == "rsync":
+            DirectoryBackup.sync_listed(
+                direc, target, mnt, delete, output, scans, options
+            )
+            return
+
+        DirectoryBackup.remove_scan(mnt, direc.key)
+
+        if direc.engine == "send":
+            SendReceive.run(
+                direc.key, direc.directory, target, mnt,
+                snapshots=direc.snapshots, cleaner=cleaner, target=name,
+                changes=output and output.changes
+            )
+            return
+
+        if direc.shards > 1:
+            ShardedSync.run(
+                direc.key, direc.directory, target, mnt, direc.shards,
+                delete=delete, output=output, options=options
+            )
+        else:
+            Rsync.run(
+                direc.directory, target, delete=delete, options=options,
+                output=output
             )
+
+    @staticmethod
+    def remove_scan(mnt, key):
+
+        # Only valid while every change to key.0 goes through sync_listed
+        scan_path = mnt + "/" + key + ".scan"
+
+        if os.path.exists(scan_path):
+            os.remove(scan_path)
+
+    @staticmethod
+    def sync_listed(direc, target, mnt, delete, output, scans, options):
+
+        # With several targets, the source is scanned once and each target
+        # is given the paths which differ from the scan it last synced,
+        # kept in key.scan, instead of rsync walking the tree every time.
+        # Removals are only listed by a deleting run, and until then stay
+        # in key.scan.
+        scan_path = mnt + "/" + direc.key + ".scan"
+        uuid = Subvolume.uuid(target)
+
+        try:
+            scan = scans.get(direc.key, direc.directory)
+        except OSError as e:
+            logger.error(f"Scan of {direc.key} failed: {e}")
+            scan = None
+
+        manifest = NativeSync.load(scan_path, uuid)
+
+        DirectoryBackup.remove_scan(mnt, direc.key)
+
+        if scan is None or manifest is None:
+
+            if scan is not None:
+                logger.info(f"No scan for {direc.key}, syncing everything")
+
+            if direc.shards > 1:
+                ShardedSync.run(
+                    direc.key, direc.directory, target, mnt, direc.shards,
+                    delete=delete, output=output, options=options
+                )
+            else:
+                Rsync.run(
+                    direc.directory, target, delete=delete, options=options,
+                    output=output
+                )
+
+        else:
+
+            paths = [ rel for rel in scan if manifest.get(rel) != scan[rel] ]
+            gone = manifest.keys() - scan.keys()
+
+            if delete:
+                paths += gone
+            else:
+                scan = { **scan, **{ rel: manifest[rel] for rel in gone } }
+
+            if paths:
+                Rsync.files(
+                    direc.directory, target, paths, output, options, delete
+                )
+            else:
+                logger.info(f"No changes in {direc.directory}")
+
+        if scan is not None:
+            NativeSync.save(scan_path, uuid, scan)
@@ -0,0 +1,378 @@
+
+import logging
+import os
+import shutil
+import threading
+
+from .report import Report
+
+logger = logging.getLogger("mnemosyne")
+
+CGROUP = "/sys/fs/cgroup"
+
+# cpu.max period, in microseconds
+CPU_PERIOD = 100000
+
+class Governor:
+
+    # Holds transfers back while the backup runs.  With cgroup v2 the
+    # whole process, and so every rsync it starts, is moved into a cgroup
+    # with io.max on the source disks and cpu.max; otherwise rsync runs
+    # under ionice and nice.  The cgroup limits are scaled down while the
+    # host is under pressure and back up as it eases.  rsync's --bwlimit is
+    # fixed when it starts, so only rsyncs started later see the change.
+
+    # The governor in force, which rsync commands pick their limits up from
+    active = None
+
+    def __init__(self, limits, directories):
+        self.limits = limits
+        self.directories = directories
+        self.factor = 1.0
+        self.devices = []
+        self.cgroup = None
+        self.leaf = None
+        self.enabled = None
+        self.original = None
+        self.niceness = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def disk(dev):
+
+        # major:minor of the whole disk holding a device, which is what
+        # io.max applies to
+        path = f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}"
+
+        if not os.path.exists(path):
+            return None
+
+        if os.path.exists(path + "/partition"):
+            path = os.path.dirname(os.path.realpath(path))
+
+        with open(path + "/dev") as f:
+            return f.read().strip()
+
+    @staticmethod
+    def device(path):
+
+        # The block device under the mount a path is on.  Filesystems such
+        # as btrfs have anonymous device numbers, so it's found by the
+        # mount's source.
+        path = os.path.realpath(path)
+        best = None
+
+        with open("/proc/self/mountinfo") as f:
+            for line in f:
+                fields, source = line.split(" - ")
+                mnt = fields.split()[4]
+                if (
+                        path == mnt or path.startswith(mnt.rstrip("/") + "/")
+                ) and (best is None or len(mnt) > len(best[0])):
+                    best = (mnt, source.split()[1])
+
+        if best is None or not best[1].startswith("/dev/"):
+            return None
+
+        try:
+            return Governor.disk(os.stat(best[1]).st_rdev)
+        except OSError:
+            return None
+
+    @staticmethod
+    def pressure(resource):
+
+        # The share of the last 10 seconds in which some task waited
+        try:
+            with open("/proc/pressure/" + resource) as f:
+                for line in f:
+                    if line.startswith("some "):
+                        return float(line.split()[1].split("=")[1])
+        except OSError:
+            pass
+
+        return None
+
+    @staticmethod
+    def own_cgroup():
+
+        with open("/proc/self/cgroup") as f:
+            for line in f:
+                if line.startswith("0::"):
+                    return CGROUP + line[3:].strip().rstrip("/")
+
+        return None
+
+    def rate(self):
+        if self.limits.rate:
+            return self.limits.rate * self.factor
+        return None
+
+    def bwlimit(self):
+        # rsync counts in units of 1024 bytes
+        return max(int(self.rate() * 1e6 / 1024), 1)
+
+    @staticmethod
+    def drop_behind():
+        gov = Governor.active
+        return gov is not None and gov.limits.drop_cache
+
+    @staticmethod
+    def command(cmd):
+
+        # An rsync command, capped at the current rate and, without a
+        # cgroup, at low priority
+        gov = Governor.active
+
+        if gov is None:
+            return cmd
+
+        if gov.limits.rate:
+            cmd = cmd[:1] + [ f"--bwlimit={gov.bwlimit()}" ] + cmd[1:]
+
+        # nocache drops what rsync reads and writes from the page cache,
+        # unless it was cached already
+        if gov.limits.drop_cache and shutil.which("nocache"):
+            cmd = [ "nocache" ] + cmd
+
+        if gov.cgroup is None:
+            if shutil.which("nice"):
+                cmd = [ "nice", "-n", str(gov.limits.nice) ] + cmd
+            if shutil.which("ionice"):
+                cmd = [ "ionice", "-c", str(gov.limits.ionice) ] + cmd
+
+        return cmd
+
+    def write(self, name, value):
+        with open(self.cgroup + "/" + name, "w") as f:
+            f.write(value)
+
+    def apply(self):
+
+        if self.cgroup is None:
+            return
+
+        if self.limits.cpu:
+            quota = int(CPU_PERIOD * self.limits.cpu / 100 * self.factor)
+            self.write("cpu.max", f"{max(quota, 1000)} {CPU_PERIOD}")
+
+        if self.limits.rate:
+            for dev in self.devices:
+                self.write("io.max", f"{dev} rbps={int(self.rate() * 1e6)}")
+
+        # Reclaim starts with the backup's own pages above this, rather
+        # than with everyone else's.  Not scaled, it isn't a rate.
+        if self.limits.memory_high:
+            self.write(
+                "memory.high", str(int(self.limits.memory_high * 1024 * 1024))
+            )
+
+    def join_cgroup(self):
+
+        # The cgroup goes under the one we're in, e.g. a systemd unit's,
+        # which needs Delegate=yes, or under the root when run from it.
+        # A cgroup with controllers enabled for its children can't hold
+        # processes itself, so anything else in ours moves to a leaf
+        # sibling, and back again afterwards.
+        self.original = Governor.own_cgroup()
+
+        if self.original is None:
+            logger.info("Not in a cgroup v2 hierarchy, using nice and ionice")
+            return
+
+        try:
+            with open(self.original + "/cgroup.controllers") as f:
+                controllers = f.read().split()
+        except OSError:
+            logger.info("No cgroup v2, using nice and ionice")
+            return
+
+        needed = [ "io", "cpu" ]
+
+        if self.limits.memory_high:
+            needed.append("memory")
+
+        if not all(c in controllers for c in needed):
+            logger.info(
+                "cgroup " + ", ".join(needed) + " controllers not delegated "
+                f"to {self.original}, using nice and ionice"
+            )
+            return
+
+        path = self.original + "/" + self.limits.slice
+        self.leaf = (
+            self.original + "/" + self.limits.slice + "-rest"
+            if self.original != CGROUP else None
+        )
+
+        try:
+
+            os.makedirs(path, exist_ok=True)
+
+            self.cgroup = path
+            self.write("cgroup.procs", str(os.getpid()))
+
+            if self.leaf:
+                os.makedirs(self.leaf, exist_ok=True)
+                Governor.move(self.original, self.leaf)
+
+            self.enable(needed)
+            self.enabled = needed
+            self.apply()
+
+        except OSError as e:
+            logger.error(
+                f"Can't use cgroup {path}: {e}; it needs root, or "
+                "Delegate=yes when run as a systemd service"
+            )
+            self.leave_cgroup()
+            return
+
+        logger.info(f"Transfers limited in cgroup {path}")
+
+    def enable(self, controllers, on=True):
+        with open(self.original + "/cgroup.subtree_control", "w") as f:
+            f.write(" ".join(("+" if on else "-") + c for c in controllers))
+
+    @staticmethod
+    def move(src, dest):
+
+        # Every process in one cgroup into another
+        with open(src + "/cgroup.procs") as f:
+            pids = f.read().split()
+
+        for pid in pids:
+            try:
+                with open(dest + "/cgroup.procs", "w") as f:
+                    f.write(pid)
+            except ProcessLookupError:
+                pass
+
+    def leave_cgroup(self):
+
+        try:
+
+            # Controllers off again below our own cgroup first, so that it
+            # can hold processes.  The root cgroup's are left as they are.
+            if self.enabled and self.leaf:
+                self.enable(self.enabled, on=False)
+
+            if self.original:
+                with open(self.original + "/cgroup.procs", "w") as f:
+                    f.write(str(os.getpid()))
+                if self.leaf and os.path.exists(self.leaf):
+                    Governor.move(self.leaf, self.original)
+
+            for path in [ self.cgroup, self.leaf ]:
+                if path and os.path.exists(path):
+                    os.rmdir(path)
+
+        except Exception as e:
+            logger.error(f"Leaving cgroup {self.cgroup}: {e}")
+
+        self.cgroup = None
+        self.leaf = None
+        self.enabled = None
+
+    def adjust(self):
+
+        io = Governor.pressure("io")
+        cpu = Governor.pressure("cpu")
+
+        levels = [ p for p in [ io, cpu ] if p is not None ]
+
+        if not levels:
+            return
+
+        level = max(levels)
+        factor = self.factor
+
+        if level >= self.limits.pressure_high:
+            factor = max(factor / 2, self.limits.floor)
+        elif level <= self.limits.pressure_low:
+            factor = min(factor * 1.5, 1.0)
+
+        if factor == self.factor:
+            return
+
+        self.factor = factor
+        self.apply()
+
+        logger.info(
+            f"Host pressure {level:.1f}%, transfer limits at {factor:.0%}"
+        )
+
+        Report.event(
+            "governor.throttle", io_pressure=io, cpu_pressure=cpu,
+            factor=round(factor, 3), rate=self.rate(),
+            cpu=self.limits.cpu * factor
+            if self.cgroup and self.limits.cpu else None
+        )
+
+    def run(self):
+
+        while not self.stopping.wait(self.limits.interval):
+            try:
+                self.adjust()
+            except Exception as e:
+                logger.error(f"Governor: {e}")
+
+    def __enter__(self):
+
+        if self.limits is None:
+            return self
+
+        self.devices = sorted(set(
+            dev for dev in (
+                Governor.device(direc.directory)
+                for direc in self.directories
+            ) if dev
+        ))
+
+        self.join_cgroup()
+
+        # Native transfers run in this process, in threads started from
+        # here on, which take on its priority
+        if self.cgroup is None:
+            self.niceness = os.getpriority(os.PRIO_PROCESS, 0)
+            os.setpriority(os.PRIO_PROCESS, 0, self.limits.nice)
+            if self.limits.rate:
+                logger.info(
+                    "Without cgroup v2, only rsync is held to the rate "
+                    "limit; native copies run at low priority but uncapped"
+                )
+
+        if self.limits.drop_cache and not shutil.which("nocache"):
+            logger.info(
+                "nocache not installed, rsync transfers will go through "
+                "the page cache; only native copies drop behind"
+            )
+
+        Report.event(
+            "governor.start", cgroup=self.cgroup, devices=self.devices,
+            rate=self.rate(), cpu=self.limits.cpu
+        )
+
+        Governor.active = self
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+        return self
+
+    def __exit__(self, *args):
+
+        if self.thread is None:
+            return
+
+        self.stopping.set()
+        self.thread.join()
+
+        Governor.active = None
+
+        if self.cgroup:
+            self.leave_cgroup()
+
+        if self.niceness is not None:
+            os.setpriority(os.PRIO_PROCESS, 0, self.niceness)
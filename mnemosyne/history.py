@@ -0,0 +1,255 @@
+
+import logging
+import os
+import time
+import sqlite3
+import statistics
+
+from .report import Report
+
+logger = logging.getLogger("mnemosyne")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    start REAL,
+    duration REAL,
+    status TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS directories (
+    run INTEGER REFERENCES runs(id),
+    key TEXT,
+    start REAL,
+    duration REAL,
+    status TEXT,
+    error TEXT,
+    rotated INTEGER,
+    retries INTEGER,
+    files INTEGER,
+    files_transferred INTEGER,
+    total_size INTEGER,
+    bytes INTEGER,
+    scan_time REAL,
+    transfer_time REAL,
+    target TEXT
+);
+CREATE INDEX IF NOT EXISTS directories_key ON directories(key, start);
+"""
+
+# Successful runs of a key used to estimate its cost
+COST_RUNS = 5
+
+class RunHistory:
+
+    # Per-key results of every run, kept locally in strategy.state so that
+    # it can be read without attaching the store
+
+    def __init__(self, state):
+        self.path = state + "/history.db"
+
+    def connect(self):
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        db = sqlite3.connect(self.path)
+        db.row_factory = sqlite3.Row
+        db.executescript(SCHEMA)
+
+        # Histories from before targets
+        columns = [
+            row["name"] for row in db.execute("PRAGMA table_info(directories)")
+        ]
+
+        if "target" not in columns:
+            db.execute("ALTER TABLE directories ADD COLUMN target TEXT")
+
+        return db
+
+    def record(self, root):
+
+        keys = [ s for s in root.walk() if s.name == "directory" ]
+
+        # Nothing happened, e.g. the daemon couldn't attach
+        if not keys and root.status == "ok":
+            return
+
+        try:
+
+            db = self.connect()
+
+            with db:
+
+                run = db.execute(
+                    "INSERT INTO runs (name, start, duration, status, error) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (
+                        root.name, root.start, root.duration(), root.status,
+                        root.error
+                    )
+                ).lastrowid
+
+                for s in keys:
+                    a = s.attrs
+                    db.execute(
+                        "INSERT INTO directories VALUES "
+                        "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            run, a["key"], s.start, s.duration(), s.status,
+                            s.error,
+                            int(any(c.name == "rotate" for c in s.walk())),
+                            Report.retries(s), a.get("files"),
+                            a.get("files_transferred"), a.get("total_size"),
+                            a.get("literal", 0) + a.get("matched", 0)
+                            if "literal" in a else None,
+                            a.get("scan_time"), a.get("transfer_time"),
+                            a.get("target"),
+                        )
+                    )
+
+            db.close()
+
+        except Exception as e:
+            logger.error(f"Recording run history failed: {e}")
+
+    def cost(self, key, target=None):
+
+        # Expected duration of a key in seconds on a target: the median of
+        # its recent successful runs there, 0 if it has none
+        try:
+            db = self.connect()
+            rows = db.execute(
+                "SELECT duration FROM directories "
+                "WHERE key = ? AND target IS ? AND status = 'ok' "
+                "ORDER BY start DESC LIMIT ?",
+                (key, target, COST_RUNS)
+            ).fetchall()
+            db.close()
+        except Exception as e:
+            logger.error(f"Reading run history failed: {e}")
+            return 0.0
+
+        if not rows:
+            return 0.0
+
+        return statistics.median(r["duration"] for r in rows)
+
+    def last(self, key):
+
+        # Start of the key's latest successful run, 0 if it has none
+        try:
+            db = self.connect()
+            row = db.execute(
+                "SELECT MAX(start) AS start FROM directories "
+                "WHERE key = ? AND status = 'ok'",
+                (key,)
+            ).fetchone()
+            db.close()
+        except Exception as e:
+            logger.error(f"Reading run history failed: {e}")
+            return 0
+
+        return row["start"] or 0
+
+    def runs(self, since):
+
+        db = self.connect()
+
+        rows = db.execute(
+            "SELECT * FROM directories WHERE start >= ? ORDER BY key, start",
+            (since,)
+        ).fetchall()
+
+        db.close()
+
+        # By key, and by target within a key, as target/key
+        history = {}
+        for row in rows:
+            name = row["key"]
+            if row["target"]:
+                name = row["target"] + "/" + name
+            history.setdefault(name, []).append(dict(row))
+
+        return history
+
+    @staticmethod
+    def regressions(runs, threshold):
+
+        # The latest successful run against the median of the earlier ones
+        ok = [ r for r in runs if r["status"] == "ok" ]
+
+        if len(ok) < 2:
+            return {}
+
+        latest = ok[-1]
+        flagged = {}
+
+        for field in [ "duration", "scan_time", "transfer_time" ]:
+
+            earlier = [ r[field] for r in ok[:-1] if r[field] is not None ]
+
+            if not earlier or latest[field] is None:
+                continue
+
+            baseline = statistics.median(earlier)
+
+            if baseline > 0 and latest[field] > baseline * (1 + threshold):
+                flagged[field] = (baseline, latest[field])
+
+        return flagged
+
+    def report(self, days=30, threshold=0.5):
+
+        history = self.runs(time.time() - days * 86400)
+
+        if not history:
+            print(f"No runs in the last {days} days")
+            return
+
+        print(
+            f"{'key':<20} {'runs':>5} {'failed':>6} {'last':>19} "
+            f"{'duration':>9} {'median':>9} {'scan':>8} {'transfer':>9} "
+            f"{'MB':>10}"
+        )
+
+        regressed = []
+
+        for key, runs in sorted(history.items()):
+
+            latest = runs[-1]
+            failed = sum(1 for r in runs if r["status"] != "ok")
+            median = statistics.median(r["duration"] for r in runs)
+
+            when = time.strftime(
+                "%Y-%m-%d %H:%M:%S", time.localtime(latest["start"])
+            )
+
+            def fmt(value, spec):
+                return "-" if value is None else format(value, spec)
+
+            print(
+                f"{key:<20} {len(runs):>5} {failed:>6} {when:>19} "
+                f"{latest['duration']:>8.1f}s {median:>8.1f}s "
+                f"{fmt(latest['scan_time'], '>7.1f')}s "
+                f"{fmt(latest['transfer_time'], '>8.1f')}s "
+                f"{fmt(latest['bytes'] and latest['bytes'] / 1e6, '>10.1f')}"
+            )
+
+            if latest["status"] != "ok":
+                print(f"    last run failed: {latest['error']}")
+
+            for field, (baseline, value) in RunHistory.regressions(
+                    runs, threshold
+            ).items():
+                print(
+                    f"    {field} regressed: {value:.1f}s against a median "
+                    f"of {baseline:.1f}s"
+                )
+                regressed.append(key)
+
+        if regressed:
+            print(
+                f"Regressions beyond {threshold:.0%}: "
+                + ", ".join(sorted(set(regressed)))
+            )
@@ -0,0 +1,449 @@
+
+import logging
+import os
+import json
+import time
+import uuid
+import fcntl
+import struct
+import ctypes
+import errno
+
+logger = logging.getLogger("mnemosyne")
+
+# Journals are restarted rather than left to grow without bound; the
+# consumer sees a new session and falls back to a full scan
+MAX_JOURNAL = 256 * 1024 * 1024
+
+# Durable list of paths changed under one directory, written by the watcher
+# and consumed by non-rotating backup runs.  Each line is a JSON list:
+# ["S", session] starts a session, ["P", path] is a changed path relative to
+# the directory and ["O"] records lost events.
+class ChangeJournal:
+
+    def __init__(self, state, key, target=None):
+
+        # One journal per key, read separately by each target
+        self.path = state + "/journal/" + key + ".journal"
+        self.state_path = state + "/journal/" + key + (
+            "." + target if target else ""
+        ) + ".state"
+        self.file = None
+
+    # Watcher side
+
+    def open(self):
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self.file = open(self.path, "a")
+
+        # Held for as long as the watcher runs, so the consumer can tell
+        # that nothing has been missed
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise RuntimeError(f"{self.path} is in use by another watcher")
+
+        self.restart()
+
+    def restart(self):
+
+        # Whatever was recorded before is no use to a consumer which hasn't
+        # seen this session, so start afresh
+        self.file.truncate(0)
+        self.session = str(uuid.uuid4())
+        self.write([ "S", self.session ])
+        self.flush()
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+
+    def record(self, path):
+        if path:
+            self.write([ "P", path ])
+
+    def overflow(self):
+        self.write([ "O" ])
+
+    def flush(self):
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        if self.file.tell() > MAX_JOURNAL:
+            self.restart()
+
+    # Consumer side
+
+    def watched(self):
+
+        try:
+            f = open(self.path)
+        except FileNotFoundError:
+            return False
+
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except OSError:
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+            return False
+
+    # Returns the set of paths changed since the last commit, or None if a
+    # full scan is needed, plus the state to commit once the sync is done.
+    # The full_scan period is in hours.
+    def pending(self, full_scan):
+
+        try:
+            state = json.load(open(self.state_path))
+        except:
+            state = { "session": None, "offset": 0, "full": 0 }
+
+        paths = set()
+        session = None
+        offset = 0
+        overflow = False
+
+        # Checked before reading, so a watcher which stops while we read
+        # can't leave a gap unnoticed
+        watched = self.watched()
+
+        try:
+            with open(self.path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Partial write, picked up next time
+                        break
+                    rec = json.loads(line)
+                    if rec[0] == "S":
+                        session = rec[1]
+                    elif offset >= state["offset"]:
+                        if rec[0] == "P":
+                            paths.add(rec[1])
+                        elif rec[0] == "O":
+                            overflow = True
+                    offset += len(line)
+        except FileNotFoundError:
+            pass
+
+        new_state = { "session": session, "offset": offset,
+                      "full": state["full"] }
+
+        if not watched:
+            logger.info("No watcher running, full scan needed")
+            return None, new_state
+
+        if session != state["session"]:
+            logger.info("Journal has restarted, full scan needed")
+            return None, new_state
+
+        if overflow:
+            logger.info("Journal overflowed, full scan needed")
+            return None, new_state
+
+        if time.time() - state["full"] >= full_scan * 3600:
+            logger.info("Periodic full scan due")
+            return None, new_state
+
+        return paths, new_state
+
+    def commit(self, state, full=False):
+
+        if full:
+            state["full"] = int(time.time())
+
+        tmp = self.state_path + ".tmp"
+
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+
+        os.replace(tmp, self.state_path)
+
+libc = ctypes.CDLL(None, use_errno=True)
+
+def check(ret):
+    if ret < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return ret
+
+class InotifyWatcher:
+
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_DONT_FOLLOW = 0x2000000
+    IN_ISDIR = 0x40000000
+
+    MASK = (
+        IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+        IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW
+    )
+
+    def __init__(self, roots):
+
+        self.fd = check(libc.inotify_init1(os.O_CLOEXEC))
+        self.watches = {}
+
+        for root in roots:
+            if not self.add(root):
+                raise RuntimeError("Out of inotify watches")
+
+    def add(self, top):
+
+        # Returns False if the watch limit was hit, in which case events
+        # under top will be missed
+        for path, dirs, files in os.walk(top):
+            try:
+                wd = check(libc.inotify_add_watch(
+                    self.fd, os.fsencode(path), self.MASK
+                ))
+                self.watches[wd] = path
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    logger.error(
+                        "Out of inotify watches, raise "
+                        "fs.inotify.max_user_watches"
+                    )
+                    return False
+                # Went away while walking
+        return True
+
+    # Yields batches of (path, walk) changes, where walk means everything
+    # below path is new too.  A path of None means events were lost.
+    def events(self):
+
+        while True:
+
+            buf = os.read(self.fd, 1024 * 1024)
+            batch = []
+            pos = 0
+
+            while pos < len(buf):
+
+                wd, mask, cookie, size = struct.unpack_from("iIII", buf, pos)
+                name = buf[pos + 16:pos + 16 + size].rstrip(b"\0")
+                pos += 16 + size
+
+                if mask & self.IN_Q_OVERFLOW:
+                    batch.append((None, False))
+                    continue
+
+                if mask & self.IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+
+                if wd not in self.watches:
+                    continue
+
+                path = os.path.join(self.watches[wd], os.fsdecode(name))
+
+                new_dir = (
+                    mask & self.IN_ISDIR and
+                    mask & (self.IN_CREATE | self.IN_MOVED_TO)
+                )
+
+                if new_dir and not self.add(path):
+                    # Events below here would be missed from now on, so
+                    # record the loss and stop.  Until the watcher is
+                    # restarted, backups do full scans.
+                    batch.append((None, False))
+                    yield batch
+                    raise RuntimeError("Out of inotify watches")
+
+                batch.append((path, bool(new_dir)))
+
+            yield batch
+
+class FanotifyWatcher:
+
+    FAN_CLOEXEC = 0x1
+    FAN_REPORT_DFID_NAME = 0xc00
+    FAN_MARK_ADD = 0x1
+    FAN_MARK_FILESYSTEM = 0x100
+
+    FAN_MODIFY = 0x2
+    FAN_ATTRIB = 0x4
+    FAN_CLOSE_WRITE = 0x8
+    FAN_MOVED_FROM = 0x40
+    FAN_MOVED_TO = 0x80
+    FAN_CREATE = 0x100
+    FAN_DELETE = 0x200
+    FAN_Q_OVERFLOW = 0x4000
+    FAN_ONDIR = 0x40000000
+
+    FAN_EVENT_INFO_TYPE_DFID_NAME = 2
+
+    MASK = (
+        FAN_MODIFY | FAN_ATTRIB | FAN_CLOSE_WRITE | FAN_MOVED_FROM |
+        FAN_MOVED_TO | FAN_CREATE | FAN_DELETE | FAN_ONDIR
+    )
+
+    def __init__(self, roots):
+
+        libc.fanotify_mark.argtypes = [
+            ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int,
+            ctypes.c_char_p
+        ]
+
+        # Needs CAP_SYS_ADMIN and Linux 5.9 for directory entry events
+        self.fd = check(libc.fanotify_init(
+            self.FAN_CLOEXEC | self.FAN_REPORT_DFID_NAME,
+            os.O_RDONLY | os.O_LARGEFILE
+        ))
+
+        # One mark per filesystem, and a descriptor on each to resolve
+        # file handles against
+        self.mounts = []
+        devices = set()
+
+        for root in roots:
+            dev = os.stat(root).st_dev
+            if dev in devices:
+                continue
+            devices.add(dev)
+            check(libc.fanotify_mark(
+                self.fd, self.FAN_MARK_ADD | self.FAN_MARK_FILESYSTEM,
+                self.MASK, -1, os.fsencode(root)
+            ))
+            self.mounts.append(os.open(root, os.O_RDONLY | os.O_DIRECTORY))
+
+    def resolve(self, handle):
+
+        for mount in self.mounts:
+            fd = libc.open_by_handle_at(mount, handle, os.O_PATH)
+            if fd >= 0:
+                try:
+                    return os.readlink(f"/proc/self/fd/{fd}")
+                finally:
+                    os.close(fd)
+
+        return None
+
+    def events(self):
+
+        while True:
+
+            buf = os.read(self.fd, 1024 * 1024)
+            batch = []
+            pos = 0
+
+            while pos < len(buf):
+
+                event_len, vers, _, metadata_len, mask, fd, pid = \
+                    struct.unpack_from("<IBBHQii", buf, pos)
+
+                if mask & self.FAN_Q_OVERFLOW:
+                    batch.append((None, False))
+                    pos += event_len
+                    continue
+
+                info = pos + metadata_len
+
+                while info < pos + event_len:
+
+                    info_type, _, info_len = struct.unpack_from(
+                        "<BBH", buf, info
+                    )
+
+                    if info_type == self.FAN_EVENT_INFO_TYPE_DFID_NAME:
+
+                        # Header, fsid, then struct file_handle and the
+                        # entry name
+                        handle_bytes, = struct.unpack_from(
+                            "<I", buf, info + 12
+                        )
+                        handle = buf[info + 12:info + 20 + handle_bytes]
+                        name = buf[
+                            info + 20 + handle_bytes:info + info_len
+                        ].split(b"\0")[0]
+
+                        parent = self.resolve(handle)
+
+                        if parent is None:
+                            # Can't say where it happened
+                            batch.append((None, False))
+                        else:
+                            path = os.path.join(parent, os.fsdecode(name))
+                            new_dir = (
+                                mask & self.FAN_ONDIR and
+                                mask & (self.FAN_CREATE | self.FAN_MOVED_TO)
+                            )
+                            batch.append((path, bool(new_dir)))
+
+                    info += info_len
+
+                pos += event_len
+
+            yield batch
+
+class Watcher:
+
+    @staticmethod
+    def run(directories, state):
+
+        roots = {
+            direc.key: os.path.realpath(direc.directory)
+            for direc in directories
+        }
+
+        journals = {}
+
+        for key in roots:
+            journals[key] = ChangeJournal(state, key)
+            journals[key].open()
+
+        try:
+            watcher = FanotifyWatcher(roots.values())
+            logger.info("Watching with fanotify")
+        except Exception as e:
+            logger.info(f"fanotify not available ({e}), using inotify")
+            watcher = InotifyWatcher(roots.values())
+
+        for batch in watcher.events():
+
+            touched = set()
+            seen = set()
+
+            for path, walk in batch:
+
+                # Writes come in many events each
+                if (path, walk) in seen:
+                    continue
+                seen.add((path, walk))
+
+                if path is None:
+                    for key in journals:
+                        journals[key].overflow()
+                        touched.add(key)
+                    continue
+
+                for key, root in roots.items():
+
+                    if path != root and not path.startswith(root + "/"):
+                        continue
+
+                    journal = journals[key]
+                    journal.record(os.path.relpath(path, root))
+                    touched.add(key)
+
+                    # The sync isn't recursive, so a directory which
+                    # appeared complete needs its contents listing
+                    if walk:
+                        for top, dirs, files in os.walk(path):
+                            for name in dirs + files:
+                                journal.record(os.path.relpath(
+                                    os.path.join(top, name), root
+                                ))
+
+            for key in touched:
+                journals[key].flush()
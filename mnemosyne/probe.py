@@ -0,0 +1,319 @@
+
+import logging
+import os
+import re
+import random
+import shutil
+import stat
+import subprocess
+import time
+
+from .subvolume import Subvolume
+from .sync import NativeSync
+
+logger = logging.getLogger("mnemosyne")
+
+# compsize summary line: TOTAL, ratio, on-disk, uncompressed, referenced
+COMPSIZE = re.compile(r"TOTAL\s+(\d+)%\s+(\S+)\s+(\S+)")
+
+class CompressionProbe:
+
+    # Writes a sample of the source data to the volume under each
+    # compression setting in turn, timing it and measuring the result
+
+    @staticmethod
+    def sample(directories, size):
+
+        # The first files of each directory, in walk order, up to an equal
+        # share of the sample size each
+        share = size // max(len(directories), 1)
+        files = []
+
+        for direc in directories:
+
+            total = 0
+
+            for path, dirs, names in os.walk(direc.directory):
+
+                dirs.sort()
+
+                for name in sorted(names):
+
+                    full = os.path.join(path, name)
+
+                    try:
+                        st = os.lstat(full)
+                    except OSError:
+                        continue
+
+                    if not stat.S_ISREG(st.st_mode):
+                        continue
+
+                    if total + st.st_size > share:
+                        continue
+
+                    files.append(full)
+                    total += st.st_size
+
+                if total >= share:
+                    break
+
+        return files
+
+    @staticmethod
+    def compsize(path):
+
+        if not shutil.which("compsize"):
+            return None
+
+        proc = subprocess.run(
+            [ "compsize", path ], capture_output=True, text=True
+        )
+
+        for line in proc.stdout.splitlines():
+            m = COMPSIZE.match(line)
+            if m:
+                return int(m.group(1)) / 100
+
+        return None
+
+    @staticmethod
+    def measure(vol, files, setting):
+
+        probe = vol.mount_point() + "/.probe"
+
+        if os.path.exists(probe):
+            Subvolume.delete(probe)
+
+        vol.remount([ "compress=" + ("no" if setting == "none" else setting) ])
+
+        Subvolume.create(probe)
+
+        try:
+
+            total = 0
+            start = time.time()
+
+            for i, src in enumerate(files):
+                NativeSync.copy_file(src, f"{probe}/{i}")
+                total += os.path.getsize(src)
+
+            # Compression happens at writeback, so that's included
+            os.sync()
+
+            elapsed = time.time() - start
+
+            return {
+                "setting": setting,
+                "bytes": total,
+                "seconds": round(elapsed, 3),
+                "mb_per_sec": round(total / max(elapsed, 1e-6) / 1e6, 1),
+                "ratio": CompressionProbe.compsize(probe),
+            }
+
+        finally:
+            Subvolume.delete(probe)
+
+    @staticmethod
+    def run(vol, directories, settings, size):
+
+        files = CompressionProbe.sample(directories, size)
+
+        if not files:
+            raise RuntimeError("No source files to sample")
+
+        logger.info(f"Sampled {len(files)} files")
+
+        if not shutil.which("compsize"):
+            logger.info("compsize not installed, ratios not measured")
+
+        results = []
+
+        try:
+            for setting in settings:
+                logger.info(f"Probing {setting}...")
+                results.append(
+                    CompressionProbe.measure(vol, files, setting)
+                )
+        finally:
+            # Back to the configured options
+            options = list(vol.options)
+            if not any(o.startswith("compress") for o in options):
+                options.insert(0, "compress=no")
+            vol.remount(options)
+
+        print(f"{'setting':<12} {'MB':>10} {'MB/s':>8} {'ratio':>6}")
+
+        for r in results:
+            ratio = "-" if r["ratio"] is None else f"{r['ratio']:.0%}"
+            print(
+                f"{r['setting']:<12} {r['bytes'] / 1e6:>10.1f} "
+                f"{r['mb_per_sec']:>8.1f} {ratio:>6}"
+            )
+
+        return results
+
+# Remote probe I/O sizes
+SEQUENTIAL_BLOCK = 1024 * 1024
+RANDOM_BLOCK = 4096
+RANDOM_OPS = 500
+
+class RemoteProbe:
+
+    # Reads go to the store file itself, which is never written; writes go
+    # to a scratch file next to it.  The store must not be open.
+
+    @staticmethod
+    def drop_cache(fd):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+    @staticmethod
+    def result(name, total, elapsed, latencies=None):
+
+        r = {
+            "test": name,
+            "bytes": total,
+            "seconds": round(elapsed, 3),
+            "mb_per_sec": round(total / max(elapsed, 1e-6) / 1e6, 1),
+        }
+
+        if latencies:
+            latencies = sorted(latencies)
+            r["p50_ms"] = round(latencies[len(latencies) // 2] * 1000, 2)
+            r["p99_ms"] = round(
+                latencies[int(len(latencies) * 0.99)] * 1000, 2
+            )
+
+        return r
+
+    @staticmethod
+    def sequential_write(path, size):
+
+        block = os.urandom(SEQUENTIAL_BLOCK)
+
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+        try:
+            start = time.time()
+            for i in range(size // SEQUENTIAL_BLOCK):
+                os.write(fd, block)
+            os.fsync(fd)
+            elapsed = time.time() - start
+        finally:
+            os.close(fd)
+
+        return RemoteProbe.result(
+            "seq-write", size // SEQUENTIAL_BLOCK * SEQUENTIAL_BLOCK, elapsed
+        )
+
+    @staticmethod
+    def sequential_read(path, size):
+
+        fd = os.open(path, os.O_RDONLY)
+
+        try:
+            RemoteProbe.drop_cache(fd)
+            total = 0
+            start = time.time()
+            while total < size:
+                data = os.read(fd, SEQUENTIAL_BLOCK)
+                if not data:
+                    break
+                total += len(data)
+            elapsed = time.time() - start
+        finally:
+            os.close(fd)
+
+        return RemoteProbe.result("seq-read", total, elapsed)
+
+    @staticmethod
+    def random_write(path, size, rng):
+
+        # Synchronous, so each write's latency is a round trip to the NAS
+        block = os.urandom(RANDOM_BLOCK)
+        blocks = max(size // RANDOM_BLOCK, 1)
+        latencies = []
+
+        fd = os.open(path, os.O_WRONLY | os.O_DSYNC)
+
+        try:
+            start = time.time()
+            for i in range(RANDOM_OPS):
+                t = time.time()
+                os.pwrite(fd, block, rng.randrange(blocks) * RANDOM_BLOCK)
+                latencies.append(time.time() - t)
+            elapsed = time.time() - start
+        finally:
+            os.close(fd)
+
+        return RemoteProbe.result(
+            "rand-write", RANDOM_OPS * RANDOM_BLOCK, elapsed, latencies
+        )
+
+    @staticmethod
+    def random_read(path, size, rng):
+
+        blocks = max(size // RANDOM_BLOCK, 1)
+        latencies = []
+
+        fd = os.open(path, os.O_RDONLY)
+
+        try:
+            RemoteProbe.drop_cache(fd)
+            start = time.time()
+            for i in range(RANDOM_OPS):
+                t = time.time()
+                os.pread(fd, RANDOM_BLOCK, rng.randrange(blocks) * RANDOM_BLOCK)
+                latencies.append(time.time() - t)
+            elapsed = time.time() - start
+        finally:
+            os.close(fd)
+
+        return RemoteProbe.result(
+            "rand-read", RANDOM_OPS * RANDOM_BLOCK, elapsed, latencies
+        )
+
+    @staticmethod
+    def run(mnt, store, size):
+
+        store = mnt + "/" + store
+        scratch = mnt + "/.mnemosyne-probe"
+
+        results = []
+
+        if os.path.exists(store):
+            # Random reads are spread over the whole store file
+            store_size = os.path.getsize(store)
+            logger.info("Reading from the store file...")
+            results.append(RemoteProbe.sequential_read(store, size))
+            results.append(
+                RemoteProbe.random_read(store, store_size, random.Random())
+            )
+        else:
+            logger.info(f"No store file at {store}, skipping reads")
+
+        try:
+            logger.info("Writing a scratch file...")
+            results.append(RemoteProbe.sequential_write(scratch, size))
+            results.append(
+                RemoteProbe.random_write(scratch, size, random.Random())
+            )
+        finally:
+            if os.path.exists(scratch):
+                os.remove(scratch)
+
+        print(
+            f"{'test':<12} {'MB':>10} {'MB/s':>8} {'p50 ms':>8} {'p99 ms':>8}"
+        )
+
+        for r in results:
+            print(
+                f"{r['test']:<12} {r['bytes'] / 1e6:>10.1f} "
+                f"{r['mb_per_sec']:>8.1f} {r.get('p50_ms', '-'):>8} "
+                f"{r.get('p99_ms', '-'):>8}"
+            )
+
+        return results
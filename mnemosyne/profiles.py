@@ -0,0 +1,219 @@
+
+import logging
+import os
+import stat
+import json
+import time
+import statistics
+
+from .types import Profile
+from .rsync import Rsync
+from .report import Report
+
+logger = logging.getLogger("mnemosyne")
+
+PROFILES = {
+    # rsync's own defaults
+    "default": Profile(),
+    # Lots of small files: working out deltas costs more than sending them
+    "small-files": Profile(whole_file=True),
+    # Big files changed in place, e.g. VM images and databases.  Only the
+    # changed blocks are rewritten, so snapshots go on sharing the rest.
+    "large-files": Profile(whole_file=False, inplace=True, sparse=True),
+    # Big files written once, e.g. media, kept contiguous on the volume
+    "archive": Profile(whole_file=True, preallocate=True),
+}
+
+# Files looked at when choosing a profile
+SAMPLE = 20000
+
+# Files at least this big count as large
+LARGE = 1024 * 1024 * 1024
+
+# Runs kept in the profile record
+RUNS = 20
+
+class TransferProfile:
+
+    # The rsync options for a directory, from a named profile, its own
+    # settings, or "auto", which picks a profile from the sizes of the
+    # files in the tree the first time and sticks with it.  What was
+    # chosen, and how fast each run went with it, is kept in key.profile
+    # on the volume.
+
+    @staticmethod
+    def options(profile):
+
+        options = []
+
+        if profile.whole_file is True:
+            options.append("--whole-file")
+        elif profile.whole_file is False:
+            options.append("--no-whole-file")
+
+        if profile.inplace:
+            options.append("--inplace")
+
+        # rsync before 3.1.3 refuses --sparse with --inplace
+        if profile.sparse:
+            if profile.inplace and Rsync.version() < (3, 1, 3):
+                logger.info(
+                    "rsync older than 3.1.3 can't combine --sparse with "
+                    "--inplace, leaving out --sparse"
+                )
+            else:
+                options.append("--sparse")
+
+        if profile.preallocate:
+            options.append("--preallocate")
+
+        if profile.checksum:
+            options.append("--checksum")
+
+        return options
+
+    @staticmethod
+    def sizes(path, recurse=True):
+
+        # Sizes of the regular files under path, in walk order
+        for top, dirs, names in os.walk(path):
+
+            for name in names:
+
+                try:
+                    st = os.lstat(os.path.join(top, name))
+                except OSError:
+                    continue
+
+                if stat.S_ISREG(st.st_mode):
+                    yield st.st_size
+
+            if not recurse:
+                break
+
+    @staticmethod
+    def sample(path):
+
+        # Taken a file at a time from each top-level subtree in turn, so
+        # that one subtree which happens to be walked first, e.g. a cache
+        # of small files, doesn't stand for the whole tree
+        sources = [ TransferProfile.sizes(path, recurse=False) ] + [
+            TransferProfile.sizes(os.path.join(path, name))
+            for name in sorted(os.listdir(path))
+            if os.path.isdir(os.path.join(path, name))
+            and not os.path.islink(os.path.join(path, name))
+        ]
+
+        sizes = []
+
+        while sources and len(sizes) < SAMPLE:
+            for source in list(sources):
+                size = next(source, None)
+                if size is None:
+                    sources.remove(source)
+                else:
+                    sizes.append(size)
+
+        total = sum(sizes)
+
+        return {
+            "files": len(sizes),
+            "bytes": total,
+            "median": statistics.median(sizes) if sizes else 0,
+            "large_share": round(
+                sum(s for s in sizes if s >= LARGE) / total, 3
+            ) if total else 0,
+        }
+
+    @staticmethod
+    def choose(sample):
+
+        # Mostly big files by volume, or mostly small files by count
+        if sample["large_share"] >= 0.5:
+            return "large-files"
+
+        if sample["files"] and sample["median"] < 256 * 1024:
+            return "small-files"
+
+        return "default"
+
+    @staticmethod
+    def load(path):
+        try:
+            return json.load(open(path))
+        except:
+            return {}
+
+    @staticmethod
+    def save(path, record):
+
+        tmp = path + ".tmp"
+
+        with open(tmp, "w") as f:
+            json.dump(record, f, indent=4)
+
+        os.replace(tmp, path)
+
+    @staticmethod
+    def resolve(direc, mnt):
+
+        # The profile name and rsync options for a directory
+        if direc.profile is None:
+            return None, []
+
+        if isinstance(direc.profile, dict):
+            return "custom", TransferProfile.options(Profile(**direc.profile))
+
+        if direc.profile != "auto":
+            return direc.profile, TransferProfile.options(
+                PROFILES[direc.profile]
+            )
+
+        path = mnt + "/" + direc.key + ".profile"
+        record = TransferProfile.load(path)
+
+        if record.get("auto") and record.get("profile") in PROFILES:
+            name = record["profile"]
+        else:
+
+            logger.info(f"Sampling {direc.directory} to choose a profile...")
+
+            with Report.span("profile.sample"):
+                sample = TransferProfile.sample(direc.directory)
+
+            name = TransferProfile.choose(sample)
+
+            logger.info(
+                f"{direc.key}: {sample['files']} files sampled, median "
+                f"{sample['median'] / 1024:.0f} KB, "
+                f"{sample['large_share']:.0%} of bytes in files of 1 GB or "
+                f"more, using the {name} profile"
+            )
+
+            TransferProfile.save(path, {
+                "profile": name, "auto": True, "chosen": int(time.time()),
+                "sample": sample, "runs": record.get("runs", []),
+            })
+
+        return name, TransferProfile.options(PROFILES[name])
+
+    @staticmethod
+    def record(direc, mnt, name, summary):
+
+        path = mnt + "/" + direc.key + ".profile"
+        record = TransferProfile.load(path)
+
+        record["profile"] = name
+        record["auto"] = direc.profile == "auto"
+
+        record["runs"] = (record.get("runs", []) + [ {
+            "time": int(time.time()),
+            "profile": name,
+            "files_transferred": summary["files_transferred"],
+            "bytes": summary["literal"] + summary["matched"],
+            "transfer_time": summary["transfer_time"],
+            "mb_per_sec": summary["mb_per_sec"],
+            "files_per_sec": summary["files_per_sec"],
+        } ])[-RUNS:]
+
+        TransferProfile.save(path, record)
@@ -3,45 +3,89 @@ import logging
 import subprocess
 import os
 import time
+import tempfile
+
+from .report import Report
 
 logger = logging.getLogger("mnemosyne")
 
 class RemoteFS:
     @staticmethod
-    def init(remote):
+    def init(remote, name=None):
         if remote.type == "cifs":
-            return RemoteCIFS(remote)
+            return RemoteCIFS(remote, name)
         elif remote.type == "block":
-            return RemoteBlock(remote)
+            return RemoteBlock(remote, name)
         else:
             raise RuntimeError(f"Don't know remote type {remote.type}")
 
 class RemoteCIFS:
 
-    def __init__(self, remote):
+    def __init__(self, remote, name=None):
         self.remote = remote
-        self.mnt = "/tmp/mnemosyne-remote"
+        self.mnt = "/tmp/mnemosyne-remote" + ("-" + name if name else "")
 
     def is_mounted(self):
         with open('/proc/mounts','r') as f:
             mount_points = [line.split()[1] for line in f.readlines()]
         return self.mnt in mount_points
 
+    def options(self):
+
+        r = self.remote
+        options = []
+
+        for name in [ "vers", "cache", "rsize", "wsize", "actimeo" ]:
+            if getattr(r, name) is not None:
+                options.append(f"{name}={getattr(r, name)}")
+
+        if r.multichannel:
+            options.append("multichannel")
+
+        if r.max_channels:
+            options.append(f"max_channels={r.max_channels}")
+
+        return options
+
+    def write_credentials(self):
+
+        # Only readable by us, and gone once the mount is done
+        fd, path = tempfile.mkstemp(prefix="mnemosyne-credentials-")
+
+        with os.fdopen(fd, "w") as f:
+            f.write(f"username={self.remote.username}\n")
+            f.write(f"password={self.remote.password}\n")
+
+        return path
+
+    @Report.timed("remote.mount")
     def mount(self):
 
         logger.info("Mounting remote FS...")
 
-        proc = subprocess.run(
-            [
-                "mount.cifs", self.remote.volume, self.mnt,
-                "-o", f"user={self.remote.username},pass={self.remote.password}"
+        # Credentials go in a file, so they don't show in the process list
+        if self.remote.credentials:
+            credentials = self.remote.credentials
+        else:
+            credentials = self.write_credentials()
 
-            ]
-        )
+        try:
+            proc = subprocess.run(
+                [
+                    "mount.cifs", self.remote.volume, self.mnt,
+                    "-o", ",".join(
+                        [ "credentials=" + credentials ] + self.options()
+                    )
+                ]
+            )
+        finally:
+            if credentials != self.remote.credentials:
+                os.remove(credentials)
         
         if proc.returncode != 0:
             raise RuntimeError("Remote FS mount failed")
 
+    @Report.timed("remote.unmount")
     def unmount(self):
 
         logger.info("Unmounting remote FS...")
@@ -76,10 +120,17 @@ class RemoteCIFS:
 
     def retry(self, fn, args=(), retries=5, delay=3):
 
+        attempt = 0
+
         while True:
 
+            attempt += 1
+
             try:
-                fn(*args)
+                with Report.span(
+                        "attempt", fn=fn.__name__, attempt=attempt
+                ):
+                    fn(*args)
             except Exception as e:
                 logger.info("Failed, retrying...")
                 time.sleep(delay)
@@ -104,15 +155,16 @@ class RemoteCIFS:
 
 class RemoteBlock:
 
-    def __init__(self, remote):
+    def __init__(self, remote, name=None):
         self.remote = remote
-        self.mnt = "/tmp/mnemosyne-remote"
+        self.mnt = "/tmp/mnemosyne-remote" + ("-" + name if name else "")
 
     def is_mounted(self):
         with open('/proc/mounts','r') as f:
             mount_points = [line.split()[1] for line in f.readlines()]
         return self.mnt in mount_points
 
+    @Report.timed("remote.mount")
     def mount(self):
 
         logger.info("Mounting block device...")
@@ -126,6 +178,7 @@ class RemoteBlock:
         if proc.returncode != 0:
             raise RuntimeError("Remote FS mount failed")
 
+    @Report.timed("remote.unmount")
     def unmount(self):
 
         logger.info("Unmounting remote FS...")
@@ -160,10 +213,17 @@ class RemoteBlock:
 
     def retry(self, fn, args=(), retries=5, delay=3):
 
+        attempt = 0
+
         while True:
 
+            attempt += 1
+
             try:
-                fn(*args)
+                with Report.span(
+                        "attempt", fn=fn.__name__, attempt=attempt
+                ):
+                    fn(*args)
             except Exception as e:
                 logger.info("Failed, retrying...")
                 time.sleep(delay)
@@ -0,0 +1,270 @@
+
+import logging
+import os
+import json
+import time
+import threading
+import contextvars
+import functools
+from contextlib import contextmanager
+
+logger = logging.getLogger("mnemosyne")
+
+# Innermost open span in this context
+current = contextvars.ContextVar("mnemosyne_span", default=None)
+
+class Span:
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.end = None
+        self.status = "ok"
+        self.error = None
+        self.children = []
+        self.lock = threading.Lock()
+
+    def add(self, child):
+        with self.lock:
+            self.children.append(child)
+
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def walk(self):
+        yield self
+        for child in list(self.children):
+            yield from child.walk()
+
+    def dict(self):
+
+        d = {
+            "name": self.name,
+            "start": self.start,
+            "duration": round(self.duration(), 3),
+            "status": self.status,
+        }
+
+        if self.attrs:
+            d["attrs"] = self.attrs
+
+        if self.error:
+            d["error"] = self.error
+
+        if self.children:
+            d["children"] = [ c.dict() for c in list(self.children) ]
+
+        return d
+
+class Report:
+
+    # Root span of the run in progress.  Spans opened in threads which
+    # weren't started through propagate() hang off this.
+    root = Span("idle", {})
+
+    @staticmethod
+    def begin(name):
+        Report.root = Span(name, {})
+        return Report.root
+
+    @staticmethod
+    @contextmanager
+    def span(name, **attrs):
+
+        parent = current.get() or Report.root
+
+        span = Span(name, attrs)
+        parent.add(span)
+
+        token = current.set(span)
+
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "error"
+            span.error = str(e)
+            raise
+        finally:
+            span.end = time.time()
+            current.reset(token)
+
+    @staticmethod
+    def timed(name):
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with Report.span(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+
+        return decorator
+
+    @staticmethod
+    def annotate(**attrs):
+        span = current.get() or Report.root
+        span.attrs.update(attrs)
+
+    @staticmethod
+    def event(name, **attrs):
+        with Report.span(name, **attrs):
+            pass
+
+    @staticmethod
+    def propagate(fn):
+
+        # For handing work to another thread, keeping it inside the
+        # caller's span
+        context = contextvars.copy_context()
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return context.copy().run(fn, *args, **kwargs)
+
+        return wrapper
+
+    @staticmethod
+    def finish(reporting, error=None):
+
+        root = Report.root
+        root.end = time.time()
+
+        if error:
+            root.status = "error"
+            root.error = str(error)
+
+        if reporting.file:
+            try:
+                Report.write_json(root, reporting.file)
+            except Exception as e:
+                logger.error(f"Writing run report failed: {e}")
+
+        if reporting.textfile:
+            try:
+                Report.write_textfile(root, reporting.textfile)
+            except Exception as e:
+                logger.error(f"Writing metrics failed: {e}")
+
+    @staticmethod
+    def write_json(root, path):
+
+        tmp = path + ".tmp"
+
+        with open(tmp, "w") as f:
+            json.dump(root.dict(), f, indent=4)
+
+        os.replace(tmp, path)
+
+    @staticmethod
+    def retries(span):
+        return sum(
+            1 for s in span.walk()
+            if s.name == "attempt" and s.attrs["attempt"] > 1
+        )
+
+    @staticmethod
+    def phases(root):
+
+        # Total time per span name below the root.  Nested phases are
+        # counted in their parents too.
+        phases = {}
+
+        for s in root.walk():
+            if s is not root and s.name != "attempt":
+                phases[s.name] = phases.get(s.name, 0) + s.duration()
+
+        return phases
+
+    @staticmethod
+    def metrics(root):
+
+        lines = []
+
+        def metric(name, help, samples):
+            lines.append(f"# HELP mnemosyne_{name} {help}")
+            lines.append(f"# TYPE mnemosyne_{name} gauge")
+            for labels, value in samples:
+                if labels:
+                    labels = ",".join(
+                        f'{k}="{v}"' for k, v in labels.items()
+                    )
+                    lines.append(f"mnemosyne_{name}{{{labels}}} {value}")
+                else:
+                    lines.append(f"mnemosyne_{name} {value}")
+
+        metric("run_duration_seconds", "Duration of the last run", [
+            ({}, round(root.duration(), 3))
+        ])
+        metric("run_success", "Whether the last run succeeded", [
+            ({}, int(root.status == "ok"))
+        ])
+        metric("run_timestamp_seconds", "When the last run finished", [
+            ({}, int(root.end or time.time()))
+        ])
+        metric("run_retries", "Retried operations in the last run", [
+            ({}, Report.retries(root))
+        ])
+
+        phases = Report.phases(root)
+
+        metric("phase_duration_seconds", "Total time spent in each phase", [
+            ({ "phase": name }, round(t, 3))
+            for name, t in sorted(phases.items())
+        ])
+
+        targets = [ s for s in root.walk() if s.name == "target" ]
+
+        if targets:
+            metric("target_success", "Whether a target backed up", [
+                ({ "target": s.attrs["target"] }, int(s.status == "ok"))
+                for s in targets
+            ])
+
+        keys = [ s for s in root.walk() if s.name == "directory" ]
+
+        # Keyed by target as well, where there are several
+        def labels(s):
+            return {
+                k: s.attrs[k] for k in [ "target", "key" ] if k in s.attrs
+            }
+
+        metric("directory_duration_seconds", "Time to back up a directory", [
+            (labels(s), round(s.duration(), 3)) for s in keys
+        ])
+        metric("directory_success", "Whether a directory backed up", [
+            (labels(s), int(s.status == "ok")) for s in keys
+        ])
+        metric("directory_retries", "Retried operations for a directory", [
+            (labels(s), Report.retries(s)) for s in keys
+        ])
+
+        # Transfer statistics, where the directory was synced with rsync
+        for attr, help in [
+                ("files", "Files scanned"),
+                ("files_transferred", "Files transferred"),
+                ("literal", "Literal bytes sent"),
+                ("matched", "Bytes matched against the existing copy"),
+                ("scan_time", "Seconds building the file list"),
+                ("transfer_time", "Seconds transferring"),
+                ("mb_per_sec", "Transfer throughput in MB/s"),
+                ("files_per_sec", "Files scanned per second"),
+        ]:
+            metric(f"directory_{attr}", help, [
+                (labels(s), s.attrs[attr])
+                for s in keys if attr in s.attrs
+            ])
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def write_textfile(root, path):
+
+        # Prometheus node exporter textfile collector format, replaced
+        # atomically so the collector never sees a partial file
+        tmp = path + ".tmp"
+
+        with open(tmp, "w") as f:
+            f.write(Report.metrics(root))
+
+        os.replace(tmp, path)
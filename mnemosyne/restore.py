@@ -0,0 +1,249 @@
+
+import logging
+import os
+import stat
+import time
+import fnmatch
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from .directory import DirectoryBackup
+from .sync import NativeSync, SIZE, MTIME, MODE
+from .subvolume import Subvolume
+from .report import Report
+
+logger = logging.getLogger("mnemosyne")
+
+# Files at least this big go to the large file pool
+LARGE = 8 * 1024 * 1024
+
+# Seconds between progress reports
+PROGRESS = 10
+
+class Restore:
+
+    @staticmethod
+    def parse_time(when):
+
+        # ISO format, local time unless it says otherwise
+        try:
+            return datetime.fromisoformat(when).timestamp()
+        except ValueError:
+            raise RuntimeError(f"Can't parse time '{when}'")
+
+    @staticmethod
+    def source(key, mnt, strategy, stage=None, at=None):
+
+        if at is None:
+            return mnt + "/" + key + "." + str(stage or 0)
+
+        at = Restore.parse_time(at)
+
+        # The newest copy which isn't newer than the time asked for.  key.0
+        # has been synced since the last rotation, so it only counts once
+        # that sync is no later than the time; otherwise the copy taken at
+        # the rotation is the newest.
+        synced = DirectoryBackup.last_sync(key, mnt)
+
+        if synced is not None and at >= synced:
+            return mnt + "/" + key + ".0"
+
+        if strategy.layout == "timestamp":
+
+            for name in DirectoryBackup.snapshots(key, mnt):
+                if Subvolume.parse_timestamp(name[len(key) + 2:]) <= at:
+                    return mnt + "/" + name
+
+        else:
+
+            # Stage N was current N-1 rotation periods before the last
+            # rotation, as for --migrate-layout
+            last = DirectoryBackup.last_rotation(key, mnt)
+
+            if last is not None:
+                for stage in range(1, strategy.stages):
+                    path = mnt + "/" + key + "." + str(stage)
+                    if not os.path.exists(path):
+                        break
+                    if last - (stage - 1) * strategy.rotate * 3600 <= at:
+                        return path
+
+        raise RuntimeError(f"No copy of {key} as old as {time.ctime(at)}")
+
+    @staticmethod
+    def selected(rel, patterns):
+
+        # A match on a directory takes everything below it
+        if not patterns:
+            return True
+
+        parts = rel.split("/")
+
+        for i in range(1, len(parts) + 1):
+            prefix = "/".join(parts[:i])
+            if any(fnmatch.fnmatchcase(prefix, p) for p in patterns):
+                return True
+
+        return False
+
+    @staticmethod
+    def scan(src, patterns):
+
+        entries = {}
+
+        for rel, cur in NativeSync.scan(src).items():
+            if Restore.selected(rel, patterns):
+                entries[rel] = cur
+
+        # Parent directories of anything selected, so it has somewhere to go
+        for rel in list(entries):
+            parent = os.path.dirname(rel)
+            while parent and parent not in entries:
+                entries[parent] = NativeSync.entry(
+                    os.lstat(os.path.join(src, parent))
+                )
+                parent = os.path.dirname(parent)
+
+        return entries
+
+    @staticmethod
+    def done(path, cur):
+
+        # Already restored by an earlier, interrupted run
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return False
+
+        return st.st_size == cur[SIZE] and st.st_mtime_ns == cur[MTIME]
+
+    @staticmethod
+    def run(src, dest, patterns=[], threads=16):
+
+        if not os.path.isdir(src):
+            raise RuntimeError(f"{src} does not exist")
+
+        logger.info(f"Scanning {src}...")
+
+        with Report.span("scan"):
+            entries = Restore.scan(src, patterns)
+
+        if not entries:
+            raise RuntimeError("Nothing matches")
+
+        os.makedirs(dest, exist_ok=True)
+
+        small = []
+        large = []
+        dirs = []
+        skipped = 0
+        errors = 0
+
+        # Parents sort before children
+        for rel in sorted(entries):
+
+            cur = entries[rel]
+            d = os.path.join(dest, rel)
+
+            try:
+                if stat.S_ISDIR(cur[MODE]):
+                    os.makedirs(d, exist_ok=True)
+                    dirs.append(rel)
+                elif Restore.done(d, cur):
+                    skipped += 1
+                elif stat.S_ISREG(cur[MODE]):
+                    if cur[SIZE] >= LARGE:
+                        large.append(rel)
+                    else:
+                        small.append(rel)
+                else:
+                    NativeSync.create_special(os.path.join(src, rel), d, cur)
+            except Exception as e:
+                logger.error(f"{rel}: {e}")
+                errors += 1
+
+        total = sum(entries[rel][SIZE] for rel in small + large)
+
+        logger.info(
+            f"Restoring {len(small) + len(large)} files, {total / 1e6:.1f} MB"
+            f" ({skipped} already restored)..."
+        )
+
+        lock = threading.Lock()
+        copied = { "files": 0, "bytes": 0 }
+        start = time.time()
+        stopping = threading.Event()
+
+        def copy(rel):
+            ok = NativeSync.copy(src, dest, rel, entries[rel])
+            if ok:
+                with lock:
+                    copied["files"] += 1
+                    copied["bytes"] += entries[rel][SIZE]
+            return ok
+
+        def progress():
+            while not stopping.wait(PROGRESS):
+                with lock:
+                    elapsed = time.time() - start
+                    logger.info(
+                        f"{copied['files']} files, "
+                        f"{copied['bytes'] / 1e6:.1f} of {total / 1e6:.1f} MB, "
+                        f"{copied['bytes'] / elapsed / 1e6:.1f} MB/s"
+                    )
+
+        reporter = threading.Thread(target=progress, daemon=True)
+        reporter.start()
+
+        # Small files are latency-bound, so many in flight; big ones are
+        # bandwidth-bound and only need a few streams
+        small_pool = ThreadPoolExecutor(max_workers=threads)
+        large_pool = ThreadPoolExecutor(max_workers=max(threads // 4, 1))
+
+        try:
+            with Report.span("copy"):
+
+                futures = [
+                    large_pool.submit(Report.propagate(copy), rel)
+                    for rel in large
+                ] + [
+                    small_pool.submit(Report.propagate(copy), rel)
+                    for rel in small
+                ]
+
+                for future in futures:
+                    if future.result() is False:
+                        errors += 1
+        finally:
+            small_pool.shutdown(cancel_futures=True)
+            large_pool.shutdown(cancel_futures=True)
+            stopping.set()
+            reporter.join()
+
+        # Directory times last, deepest first
+        for rel in reversed(dirs):
+            try:
+                NativeSync.set_metadata(os.path.join(dest, rel), entries[rel])
+            except Exception as e:
+                logger.error(f"{rel}: {e}")
+                errors += 1
+
+        elapsed = time.time() - start
+
+        Report.annotate(
+            files=copied["files"], bytes=copied["bytes"],
+            mb_per_sec=round(copied["bytes"] / max(elapsed, 1e-6) / 1e6, 2)
+        )
+
+        logger.info(
+            f"Restored {copied['files']} files, "
+            f"{copied['bytes'] / 1e6:.1f} MB in {elapsed:.1f}s, "
+            f"{copied['bytes'] / max(elapsed, 1e-6) / 1e6:.1f} MB/s, "
+            f"{copied['files'] / max(elapsed, 1e-6):.1f} files/s"
+        )
+
+        if errors:
+            raise RuntimeError(
+                f"{errors} files failed to restore, run again to retry"
+            )
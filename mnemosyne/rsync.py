@@ -0,0 +1,356 @@
+
+import logging
+import subprocess
+import re
+import sys
+import os
+import gzip
+import time
+import tempfile
+import threading
+from dataclasses import dataclass, asdict, fields
+
+from .report import Report
+from .governor import Governor
+
+logger = logging.getLogger("mnemosyne")
+
+# Lines of rsync --stats output, and the field each one fills
+STATS = [
+    (r"Number of files: ([\d,]+)", "files"),
+    (r"Number of regular files transferred: ([\d,]+)", "files_transferred"),
+    (r"Total file size: ([\d,]+)", "total_size"),
+    (r"Total transferred file size: ([\d,]+)", "transferred_size"),
+    (r"Literal data: ([\d,]+)", "literal"),
+    (r"Matched data: ([\d,]+)", "matched"),
+    (r"File list generation time: ([\d.]+)", "scan_time"),
+    (r"File list transfer time: ([\d.]+)", "list_time"),
+    (r"Total bytes sent: ([\d,]+)", "sent"),
+    (r"Total bytes received: ([\d,]+)", "received"),
+]
+
+# --info=progress2 lines: bytes, percent, rate, ETA and, once files have
+# been transferred, the transfer count and the files left to check
+PROGRESS = re.compile(
+    r"\s*([\d,]+)\s+(\d+)%\s+(\S+)/s\s+(\d+:\d\d:\d\d)"
+    r"(?:\s+\(xfr#(\d+), (?:to|ir)-chk=(\d+)/(\d+)\))?"
+)
+
+# Itemized change lines, from --out-format="%i %n%L"
+ITEMIZED = re.compile(r"([<>ch.][fdLDS][.+ ?a-zA-Z]{9}|\*deleting  ) (.+)")
+
+class ChangeList:
+
+    # Itemized changes for a key, gzipped.  Shards write to it from
+    # several threads, each with names relative to their own subtree.
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = gzip.open(path + ".tmp", "wt", compresslevel=1)
+        self.count = 0
+        # Whether everything that went away is listed too, which a full
+        # btrfs send can't say
+        self.complete = True
+
+    def add(self, item, name, prefix=""):
+
+        if prefix:
+            name = prefix + "/" + ("" if name == "./" else name)
+
+        with self.lock:
+            self.file.write(item + " " + name + "\n")
+            self.count += 1
+
+    def close(self):
+        self.file.close()
+        os.replace(self.path + ".tmp", self.path)
+        logger.info(f"{self.count} changes written to {self.path}")
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.path + ".tmp")
+
+@dataclass
+class RsyncOutput:
+
+    # How rsync output is handled.  Quiet drops the per-file listing in
+    # favour of a progress event every `progress` seconds.
+    quiet: bool = False
+    progress: float = 60
+    changes: ChangeList = None
+
+@dataclass
+class RsyncStats:
+    files: int = 0
+    files_transferred: int = 0
+    total_size: int = 0
+    transferred_size: int = 0
+    literal: int = 0
+    matched: int = 0
+    sent: int = 0
+    received: int = 0
+    scan_time: float = 0.0
+    list_time: float = 0.0
+    wall_time: float = 0.0
+
+    @staticmethod
+    def parse(output, wall_time=0.0):
+
+        stats = RsyncStats(wall_time=wall_time)
+
+        for line in output.splitlines():
+            for regex, field in STATS:
+                m = re.match(regex, line.strip())
+                if m:
+                    value = m.group(1).replace(",", "")
+                    setattr(stats, field, type(getattr(stats, field))(
+                        float(value)
+                    ))
+
+        return stats
+
+    def add(self, other):
+        for f in fields(self):
+            setattr(
+                self, f.name,
+                getattr(self, f.name) + getattr(other, f.name)
+            )
+        return self
+
+    # Derived figures.  Scan time is what rsync reports for building the
+    # file list; with incremental recursion that only covers the first
+    # chunk, so treat the split as a guide.
+
+    def transfer_time(self):
+        return max(self.wall_time - self.scan_time - self.list_time, 0.0)
+
+    def speedup(self):
+        return self.total_size / max(self.sent + self.received, 1)
+
+    def mb_per_sec(self):
+        t = self.transfer_time()
+        if t <= 0:
+            return 0.0
+        return (self.literal + self.matched) / t / 1e6
+
+    def files_per_sec(self):
+        if self.wall_time <= 0:
+            return 0.0
+        return self.files / self.wall_time
+
+    def bound(self):
+        # Where most of the time went
+        if self.scan_time + self.list_time >= self.transfer_time():
+            return "scan"
+        if self.literal == 0 and self.files_transferred == 0:
+            return "scan"
+        return "transfer"
+
+    def summary(self):
+
+        d = asdict(self)
+
+        d["transfer_time"] = round(self.transfer_time(), 3)
+        d["speedup"] = round(self.speedup(), 2)
+        d["mb_per_sec"] = round(self.mb_per_sec(), 2)
+        d["files_per_sec"] = round(self.files_per_sec(), 1)
+        d["bound"] = self.bound()
+
+        return d
+
+    @staticmethod
+    def total(span):
+
+        # Sum of all the rsyncs under a report span
+        total = RsyncStats()
+
+        for s in span.walk():
+            if s.name == "rsync" and "wall_time" in s.attrs:
+                total.add(RsyncStats(**{
+                    f.name: s.attrs[f.name] for f in fields(RsyncStats)
+                }))
+
+        return total
+
+class Rsync:
+
+    # The installed rsync's version, once asked for
+    installed = None
+
+    @staticmethod
+    def version():
+
+        if Rsync.installed is None:
+
+            try:
+                out = subprocess.run(
+                    [ "rsync", "--version" ], stdout=subprocess.PIPE,
+                    text=True
+                ).stdout
+                m = re.search(r"version v?(\d+)\.(\d+)\.(\d+)", out)
+                Rsync.installed = tuple(int(n) for n in m.groups())
+            except Exception:
+                Rsync.installed = (0, 0, 0)
+
+        return Rsync.installed
+
+    @staticmethod
+    def command(src, dest, delete=False, options=[]):
+
+        cmd = [ "rsync" ]
+
+        if delete:
+            cmd.append("--delete")
+
+        return cmd + options + [ src + "/", dest + "/" ]
+
+    @staticmethod
+    @Report.timed("rsync")
+    def run(
+            src, dest, delete=False, options=[], verbose=True, output=None,
+            prefix=""
+    ):
+
+        logger.info(f"Syncing directory {src}...")
+
+        output = output or RsyncOutput()
+        verbose = verbose and not output.quiet
+
+        if verbose:
+            options = [ "-av" ] + options
+        else:
+            options = [ "-a" ] + options
+
+        stats = Rsync.execute(
+            Rsync.command(src, dest, delete, options), verbose, output, prefix
+        )
+
+        logger.info("Sync complete")
+
+        return stats
+
+    @staticmethod
+    @Report.timed("rsync")
+    def files(src, dest, paths, output=None, options=[], delete=False):
+
+        # Just the listed paths, relative to src.  Listed paths which no
+        # longer exist in the source are deleted from the destination if
+        # delete is set, as a full run would, and otherwise skipped.
+        logger.info(f"Syncing {len(paths)} changed paths in {src}...")
+
+        with tempfile.NamedTemporaryFile("w") as f:
+
+            for path in sorted(paths):
+                f.write(path + "\0")
+            f.flush()
+
+            stats = Rsync.execute(
+                Rsync.command(
+                    src, dest, options=[
+                        "-a", "--from0", "--files-from=" + f.name,
+                    ] + (
+                        [ "--delete-missing-args", "--force" ] if delete
+                        else [ "--ignore-missing-args" ]
+                    ) + options
+                ),
+                verbose=False, output=output
+            )
+
+        logger.info("Sync complete")
+
+        return stats
+
+    @staticmethod
+    def execute(cmd, verbose, output=None, prefix=""):
+
+        # Runs with --stats, passing the output through when verbose, and
+        # records the statistics on the current report span
+        output = output or RsyncOutput()
+
+        flags = [ "--stats" ]
+
+        if output.quiet:
+            flags.append("--info=progress2")
+
+        if output.changes:
+            flags.append("--out-format=%i %n%L")
+
+        start = time.time()
+        last = start
+
+        # Universal newlines, so each \r-terminated progress update comes
+        # through as a line of its own
+        proc = subprocess.Popen(
+            Governor.command(cmd[:1] + flags + cmd[1:]),
+            stdout=subprocess.PIPE, text=True, errors="replace"
+        )
+
+        tail = []
+
+        for line in proc.stdout:
+
+            # Stats come last
+            if tail or line.startswith("Number of files:"):
+                tail.append(line)
+                continue
+
+            if output.quiet:
+                m = PROGRESS.match(line)
+                if m:
+                    if time.time() - last >= output.progress:
+                        Rsync.progress(cmd[-2], m)
+                        last = time.time()
+                    continue
+
+            if output.changes:
+                m = ITEMIZED.fullmatch(line.rstrip("\n"))
+                if m:
+                    output.changes.add(m.group(1), m.group(2), prefix)
+
+            if verbose:
+                sys.stdout.write(line)
+
+        proc.wait()
+
+        if proc.returncode != 0:
+            raise RuntimeError(
+                "Directory sync failed"
+            )
+
+        stats = RsyncStats.parse("".join(tail), time.time() - start)
+        summary = stats.summary()
+
+        Report.annotate(**summary)
+
+        logger.info(
+            f"{stats.files} files, {stats.files_transferred} transferred, "
+            f"{stats.literal} literal bytes, {stats.matched} matched, "
+            f"speedup {summary['speedup']}, {summary['mb_per_sec']} MB/s, "
+            f"{summary['files_per_sec']} files/s, {stats.bound()}-bound"
+        )
+
+        return stats
+
+    @staticmethod
+    def progress(src, m):
+
+        bytes, percent, rate, eta, xfr, left, total = m.groups()
+
+        progress = {
+            "src": src.rstrip("/"),
+            "bytes": int(bytes.replace(",", "")),
+            "percent": int(percent),
+            "rate": rate + "/s",
+            "eta": eta,
+            "files": int(xfr or 0),
+        }
+
+        if total:
+            progress["checked"] = int(total) - int(left)
+            progress["total"] = int(total)
+
+        logger.info(
+            " ".join(f"{k}={v}" for k, v in progress.items()),
+            extra={ "progress": progress }
+        )
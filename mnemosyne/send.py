@@ -0,0 +1,215 @@
+
+import logging
+import subprocess
+import os
+import json
+import re
+
+from .subvolume import Subvolume
+from .report import Report
+
+logger = logging.getLogger("mnemosyne")
+
+# Operations in a send stream which don't create or change a file
+SKIP = { "snapshot", "subvol", "mkdir" }
+
+ESCAPES = {
+    "a": "\a", "b": "\b", "e": "\x1b", "f": "\f", "n": "\n", "r": "\r",
+    "t": "\t", "v": "\v",
+}
+
+class SendReceive:
+
+    @staticmethod
+    def run(key, src, dest, mnt, snapshots=None, cleaner=None, target=None,
+            changes=None):
+
+        src = src.rstrip("/")
+
+        # Source snapshots have to live on the source filesystem, by
+        # default next to the source subvolume
+        if snapshots is None:
+            snapshots = os.path.dirname(src)
+
+        state_path = mnt + "/" + key + ".send"
+        received = mnt + "/.received/" + key
+
+        os.makedirs(received, exist_ok=True)
+
+        try:
+            parent = json.load(open(state_path))["parent"]
+        except:
+            parent = None
+
+        # Each target has its own snapshots, so that one target doesn't
+        # remove another's parent, or one it's still sending
+        prefix = ".mnemosyne-" + key + ("." + target if target else "") + ".@"
+
+        name = prefix + Subvolume.timestamp()
+        snap = snapshots + "/" + name
+
+        logger.info(f"Snapshotting {src}...")
+        Subvolume.snapshot(src, snap, readonly=True)
+
+        # Incremental needs the parent on both sides
+        if (
+                parent and
+                os.path.exists(snapshots + "/" + parent) and
+                os.path.exists(received + "/" + parent)
+        ):
+            logger.info(f"Sending {key} incrementally from {parent}...")
+            send = [ "btrfs", "send", "-p", snapshots + "/" + parent, snap ]
+        else:
+            logger.info(f"Sending {key} in full...")
+            send = [ "btrfs", "send", snap ]
+
+            # Lists what's there, not what's gone since the last copy
+            if changes:
+                changes.complete = False
+
+        try:
+            SendReceive.pipe(send, [ "btrfs", "receive", received ])
+        except:
+            Subvolume.delete(snap)
+            if os.path.exists(received + "/" + name):
+                Subvolume.delete(received + "/" + name)
+            raise
+
+        if changes:
+            try:
+                SendReceive.list_changes(send, received + "/" + name, changes)
+            except Exception as e:
+                logger.error(f"Listing changes for {key} failed: {e}")
+                changes.complete = False
+
+        # The received subvolume has to stay untouched to act as the next
+        # parent, so key.0 is a writable snapshot of it and rotates as usual
+        if os.path.exists(dest):
+            Subvolume.remove(dest, cleaner)
+
+        Subvolume.snapshot(received + "/" + name, dest)
+
+        with open(state_path, "w") as f:
+            json.dump({ "parent": name }, f)
+
+        # Only the newest pair is needed from here on
+        for old in os.listdir(received):
+            if old != name:
+                Subvolume.remove(received + "/" + old, cleaner)
+
+        for old in os.listdir(snapshots):
+            if old.startswith(prefix) and old != name:
+                Subvolume.delete(snapshots + "/" + old)
+
+        logger.info("Send complete")
+
+    @staticmethod
+    @Report.timed("send")
+    def pipe(send, receive):
+
+        sender = subprocess.Popen(send, stdout=subprocess.PIPE)
+
+        receiver = subprocess.run(receive, stdin=sender.stdout)
+
+        sender.stdout.close()
+        sender.wait()
+
+        if sender.returncode != 0:
+            raise RuntimeError("btrfs send failed")
+
+        if receiver.returncode != 0:
+            raise RuntimeError("btrfs receive failed")
+
+    @staticmethod
+    def parse_dump(lines):
+
+        # (operation, path, dest) from `btrfs receive --dump`.  Paths are
+        # escaped, and start with ./ and the subvolume name, as does a
+        # rename's dest; a link's dest is already relative.
+        def unescape(text):
+            return re.sub(
+                r"\\(.)", lambda m: ESCAPES.get(m.group(1), m.group(1)),
+                text
+            )
+
+        def relative(path):
+            return path.split("/", 2)[2] if path.count("/") >= 2 else ""
+
+        for line in lines:
+
+            op, _, rest = line.rstrip("\n").partition(" ")
+            rest = rest.lstrip(" ")
+
+            m = re.match(r"((?:\\.|[^\\ ])*) *(.*)", rest)
+            path, args = unescape(m.group(1)), m.group(2)
+
+            dest = None
+            m = re.match(r"dest=((?:\\.|[^\\ ])*)", args)
+            if m:
+                dest = unescape(m.group(1))
+                if op == "rename":
+                    dest = relative(dest)
+
+            yield op, relative(path), dest
+
+    @staticmethod
+    @Report.timed("send.changes")
+    def list_changes(send, root, changes):
+
+        # An itemized change list, as rsync writes, from a metadata-only
+        # copy of the stream just received
+        sender = subprocess.Popen(
+            send[:2] + [ "--no-data" ] + send[2:], stdout=subprocess.PIPE
+        )
+
+        dump = subprocess.run(
+            [ "btrfs", "receive", "--dump" ], stdin=sender.stdout,
+            stdout=subprocess.PIPE, text=True, errors="surrogateescape"
+        )
+
+        sender.stdout.close()
+        sender.wait()
+
+        if sender.returncode != 0 or dump.returncode != 0:
+            raise RuntimeError("btrfs send dump failed")
+
+        SendReceive.itemize(
+            SendReceive.parse_dump(dump.stdout.splitlines()), root, changes
+        )
+
+    @staticmethod
+    def itemize(events, root, changes):
+
+        # New inodes appear under temporary names and are renamed into
+        # place, so a rename lists everything which arrived with it
+        last = None
+
+        for op, path, dest in events:
+
+            if not path or op in SKIP:
+                continue
+
+            if op in ("unlink", "rmdir"):
+                changes.add(
+                    "*deleting  ", path + ("/" if op == "rmdir" else "")
+                )
+                last = None
+
+            elif op == "rename":
+
+                changes.add("*deleting  ", path)
+                changes.add(">f+++++++++", dest)
+
+                full = os.path.join(root, dest)
+
+                if os.path.isdir(full) and not os.path.islink(full):
+                    for top, dirs, names in os.walk(full):
+                        rel = os.path.relpath(top, root)
+                        for name in dirs + names:
+                            changes.add(">f+++++++++", rel + "/" + name)
+
+                last = None
+
+            elif path != last:
+                changes.add(">f.st......", path)
+                last = path
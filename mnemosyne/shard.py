@@ -0,0 +1,173 @@
+
+import logging
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .rsync import Rsync
+from .report import Report
+
+logger = logging.getLogger("mnemosyne")
+
+# How far down the tree a heavy directory may be split
+MAX_DEPTH = 3
+
+class ShardedSync:
+
+    @staticmethod
+    def run(key, src, dest, mnt, shards, delete=False, output=None,
+            options=[]):
+
+        stats_path = mnt + "/" + key + ".shards"
+
+        try:
+            previous = json.load(open(stats_path))
+        except:
+            previous = {}
+
+        containers, units = ShardedSync.plan(src, previous, shards)
+        partitions = ShardedSync.partition(units, shards)
+
+        logger.info(
+            f"Syncing {key} as {len(partitions)} shards over "
+            f"{len(units)} subtrees..."
+        )
+
+        # Containers are synced without recursion, parents first.  This
+        # copies their own files, creates the shard directories and, when
+        # deleting, removes subtrees which no longer exist in the source.
+        # Shards then sync inside their own subtree only, so a shard's
+        # --delete can't touch another shard's files.
+        for rel in containers:
+            Rsync.run(
+                os.path.join(src, rel), os.path.join(dest, rel),
+                delete=delete,
+                options=[ "--no-recursive", "--dirs" ] + options,
+                output=output, prefix=rel
+            )
+
+        with ThreadPoolExecutor(max_workers=len(partitions) or 1) as ex:
+            futures = [
+                ex.submit(
+                    Report.propagate(ShardedSync.sync), src, dest, partition,
+                    delete, output, options
+                )
+                for partition in partitions
+            ]
+
+        stats = {}
+        for future in futures:
+            stats.update(future.result())
+
+        # Subtrees which have gone away simply drop out here, and new ones
+        # are measured, so the next run re-balances
+        with open(stats_path, "w") as f:
+            json.dump(stats, f)
+
+        logger.info(f"Sharded sync of {key} complete")
+
+    @staticmethod
+    def sync(src, dest, units, delete, output=None, options=[]):
+
+        stats = {}
+
+        for rel in units:
+            s = Rsync.run(
+                os.path.join(src, rel), os.path.join(dest, rel), delete=delete,
+                options=options, verbose=False, output=output, prefix=rel
+            )
+            stats[rel] = { "files": s.files, "bytes": s.total_size }
+
+        return stats
+
+    @staticmethod
+    def subdirectories(src, rel):
+
+        path = os.path.join(src, rel)
+
+        return sorted([
+            os.path.join(rel, entry.name)
+            for entry in os.scandir(path)
+            if entry.is_dir(follow_symlinks=False)
+        ])
+
+    @staticmethod
+    def weights(previous):
+
+        # Weight is the share of files plus the share of bytes, so trees of
+        # small files and trees of large files both count
+        files = sum(v["files"] for v in previous.values()) or 1
+        size = sum(v["bytes"] for v in previous.values()) or 1
+
+        return {
+            rel: v["files"] / files + v["bytes"] / size
+            for rel, v in previous.items()
+        }
+
+    @staticmethod
+    def plan(src, previous, shards):
+
+        known = ShardedSync.weights(previous)
+
+        if known:
+            default = sum(known.values()) / len(known)
+        else:
+            default = 1.0
+
+        def weight(rel, fallback):
+            if rel in known:
+                return known[rel]
+            below = [
+                w for r, w in known.items() if r.startswith(rel + "/")
+            ]
+            if below:
+                return sum(below)
+            return fallback
+
+        units = {
+            rel: weight(rel, default)
+            for rel in ShardedSync.subdirectories(src, "")
+        }
+
+        containers = [ "" ]
+
+        # Split any subtree too heavy to fit in one shard into its
+        # children, until the work balances or the tree runs out
+        while units:
+
+            total = sum(units.values())
+            rel = max(units, key=units.get)
+
+            if units[rel] <= total / shards:
+                break
+
+            if rel.count("/") + 1 >= MAX_DEPTH:
+                break
+
+            children = ShardedSync.subdirectories(src, rel)
+
+            if not children:
+                break
+
+            parent = units.pop(rel)
+            containers.append(rel)
+
+            for child in children:
+                units[child] = weight(child, parent / len(children))
+
+        return containers, units
+
+    @staticmethod
+    def partition(units, shards):
+
+        # Longest-processing-time first: heaviest subtree goes to the
+        # lightest shard
+        partitions = [ [] for i in range(shards) ]
+        loads = [ 0.0 ] * shards
+
+        for rel in sorted(units, key=units.get, reverse=True):
+            i = loads.index(min(loads))
+            partitions[i].append(rel)
+            loads[i] += units[rel]
+
+        return [ p for p in partitions if p ]
@@ -0,0 +1,94 @@
+
+import logging
+import threading
+
+from .report import Report
+
+logger = logging.getLogger("mnemosyne")
+
+GB = 1024 * 1024 * 1024
+
+class SpaceMonitor:
+
+    # Grows the store image while it's attached, whenever free space on
+    # the volume drops below the threshold
+
+    def __init__(self, store, vol, grow_free, grow_step=10, grow_max=None,
+                 interval=60):
+        self.store = store
+        self.vol = vol
+        self.grow_free = grow_free
+        self.grow_step = grow_step
+        self.grow_max = grow_max
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def check(self):
+
+        free = self.vol.free()
+
+        if free >= self.grow_free * GB:
+            return
+
+        size = self.store.size()
+        step = self.grow_step * GB
+
+        if self.grow_max is not None:
+            step = min(step, self.grow_max * GB - size)
+
+        if step < GB:
+            logger.error(
+                f"Volume has {free / GB:.1f}G free and the store is at its "
+                f"maximum size"
+            )
+            return
+
+        step = int(step // GB)
+
+        logger.info(
+            f"Volume has {free / GB:.1f}G free, growing store from "
+            f"{size / GB:.0f}G by {step}G"
+        )
+
+        Report.event(
+            "store.grow.decision", free=free, size=size, step=step * GB
+        )
+
+        self.store.grow(step)
+        self.vol.resize()
+
+        logger.info(f"Volume now has {self.vol.free() / GB:.1f}G free")
+
+    def run(self):
+
+        while not self.stopping.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"Growing store failed: {e}")
+
+    def __enter__(self):
+
+        if not self.grow_free:
+            return self
+
+        if not self.store.growable():
+            logger.info("Store is a device, not growing it")
+            return self
+
+        try:
+            self.check()
+        except Exception as e:
+            logger.error(f"Growing store failed: {e}")
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+        return self
+
+    def __exit__(self, *args):
+
+        if self.thread:
+            self.stopping.set()
+            self.thread.join()
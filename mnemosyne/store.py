@@ -2,51 +2,203 @@
 import logging
 import subprocess
 import os
+import re
+import shutil
 import time
 
+from .report import Report
+
 logger = logging.getLogger("mnemosyne")
 
+# Lines of cryptsetup benchmark output for ciphers: algorithm, key bits and
+# encryption and decryption speed
+BENCHMARK = re.compile(
+    r"\s*(\S+)\s+(\d+)b\s+([\d.]+) MiB/s\s+([\d.]+) MiB/s"
+)
+
+# Flags which bypass the dm-crypt read and write workqueues
+PERF_FLAGS = [ "--perf-no_read_workqueue", "--perf-no_write_workqueue" ]
+
 class EncryptedStore:
 
-    def __init__(self, file, keyfile):
+    def __init__(self, file, keyfile, no_workqueue=True, discard=False,
+                 name=None):
         self.file = file
-        self.volume = "mnemosyne-volume"
+        self.volume = "mnemosyne-volume" + ("-" + name if name else "")
         self.device = "/dev/mapper/" + self.volume
         self.keyfile = keyfile
+        self.no_workqueue = no_workqueue
+        self.discard = discard
 
     def device_path(self):
         return self.device
 
     @staticmethod
-    def init(file, size, keyfile):
+    def benchmark():
 
-        logger.info("Create encrypted store file...")
+        # Fastest cipher usable for a disk, at the longest key offered for
+        # it.  Speed is the slower of encryption and decryption.
+        logger.info("Benchmarking ciphers...")
 
         proc = subprocess.run(
-            [
-                "truncate", "-s", f"{size}G", file
-            ]
+            [ "cryptsetup", "benchmark" ], capture_output=True, text=True
         )
-        
+
         if proc.returncode != 0:
-            raise RuntimeError("Backup store creation failed")
+            raise RuntimeError("cryptsetup benchmark failed")
+
+        best = {}
+
+        for line in proc.stdout.splitlines():
+
+            m = BENCHMARK.match(line)
+            if not m:
+                continue
+
+            algorithm, bits = m.group(1), int(m.group(2))
+            speed = min(float(m.group(3)), float(m.group(4)))
+
+            if not (algorithm.endswith("-xts") or "adiantum" in algorithm):
+                continue
+
+            if algorithm not in best or bits > best[algorithm][0]:
+                best[algorithm] = (bits, speed)
+
+        if not best:
+            raise RuntimeError("cryptsetup benchmark found no disk ciphers")
+
+        algorithm = max(best, key=lambda a: best[a][1])
+        bits, speed = best[algorithm]
+
+        logger.info(
+            f"Using {algorithm} with {bits}-bit key, {speed:.0f} MiB/s"
+        )
+
+        return algorithm + "-plain64", bits
+
+    @staticmethod
+    def perf_supported():
+
+        # Needs cryptsetup 2.3.4 and Linux 5.9
+        try:
+            release = os.uname().release.split("-")[0].split(".")
+            if tuple(int(v) for v in release[:2]) < (5, 9):
+                return False
+            proc = subprocess.run(
+                [ "cryptsetup", "--help" ], capture_output=True, text=True
+            )
+        except:
+            return False
+
+        return "perf-no_read_workqueue" in proc.stdout
+
+    @staticmethod
+    def init(
+            file, size, keyfile, cipher=None, key_size=None, sector_size=4096,
+            pbkdf="pbkdf2", pbkdf_iterations=1000
+    ):
+
+        # No size for a raw device, which is used whole
+        if size:
+
+            logger.info("Create encrypted store file...")
+
+            proc = subprocess.run(
+                [
+                    "truncate", "-s", f"{size}G", file
+                ]
+            )
+        
+            if proc.returncode != 0:
+                raise RuntimeError("Backup store creation failed")
 
         logger.info("Setup encryption key...")
 
+        # The key is a random keyfile, so a slow, memory-hard KDF adds
+        # nothing but time on every open
+        options = [ "--type", "luks2" ]
+
+        if cipher == "auto":
+            cipher, key_size = EncryptedStore.benchmark()
+
+        if cipher:
+            options += [ "--cipher", cipher ]
+
+        if key_size:
+            options += [ "--key-size", str(key_size) ]
+
+        if sector_size:
+            options += [ "--sector-size", str(sector_size) ]
+
+        if pbkdf:
+            options += [ "--pbkdf", pbkdf ]
+            if pbkdf == "pbkdf2" and pbkdf_iterations:
+                options += [
+                    "--pbkdf-force-iterations", str(pbkdf_iterations)
+                ]
+
         proc = subprocess.run(
             [
                 "cryptsetup", "--batch-mode",
-                "luksFormat", file, keyfile
-            ]
+                "luksFormat"
+            ] + options + [ file, keyfile ]
         )
         
         if proc.returncode != 0:
             raise RuntimeError("Backup store creation failed")
 
+    @staticmethod
+    def in_use(device):
+
+        # LUKS already, or any other signature blkid recognises
+        proc = subprocess.run(
+            [ "cryptsetup", "isLuks", device ], capture_output=True
+        )
+
+        if proc.returncode == 0:
+            return True
+
+        if shutil.which("blkid"):
+            proc = subprocess.run(
+                [ "blkid", "-p", device ], capture_output=True
+            )
+            if proc.returncode == 0:
+                return True
+
+        return False
+
+    @staticmethod
+    def convert_key(file, keyfile, pbkdf="pbkdf2", pbkdf_iterations=1000):
+
+        logger.info(f"Converting key slot to {pbkdf}...")
+
+        options = [ "--pbkdf", pbkdf ]
+
+        if pbkdf == "pbkdf2" and pbkdf_iterations:
+            options += [ "--pbkdf-force-iterations", str(pbkdf_iterations) ]
+
+        proc = subprocess.run(
+            [
+                "cryptsetup", "--batch-mode", "luksConvertKey", file,
+                "--key-file", keyfile
+            ] + options
+        )
+
+        if proc.returncode != 0:
+            raise RuntimeError("Key slot conversion failed")
+
+    def perf_flags(self):
+
+        if self.no_workqueue and EncryptedStore.perf_supported():
+            return PERF_FLAGS
+
+        return []
+
     def is_open(self):
 
         return os.path.exists(self.device)
 
+    @Report.timed("store.open")
     def open(self):
 
         logger.info("Opening encrypted store...")
@@ -55,12 +207,84 @@ class EncryptedStore:
             [
                 "cryptsetup", "open", self.file, self.volume,
                 "--key-file", self.keyfile
-            ]
+            ] + self.perf_flags() +
+            ([ "--allow-discards" ] if self.discard else [])
         )
         
         if proc.returncode != 0:
             raise RuntimeError("Encrypted store access failed")
 
+    def refresh(self):
+
+        # Stores the open-time flags in the LUKS2 header, so that they
+        # apply however the store is opened in future
+        flags = self.perf_flags()
+
+        if self.discard:
+            flags = flags + [ "--allow-discards" ]
+
+        if not flags:
+            logger.info("No open-time flags to store")
+            return
+
+        logger.info("Storing performance flags in the LUKS header...")
+
+        proc = subprocess.run(
+            [
+                "cryptsetup", "refresh", self.volume, "--key-file",
+                self.keyfile, "--persistent"
+            ] + flags
+        )
+
+        if proc.returncode != 0:
+            raise RuntimeError("Encrypted store refresh failed")
+
+    def size(self):
+        return os.path.getsize(self.file)
+
+    def growable(self):
+        # An image file, not a raw device
+        return os.path.isfile(self.file)
+
+    def loop_device(self):
+
+        proc = subprocess.run(
+            [ "losetup", "-j", self.file ], capture_output=True, text=True
+        )
+
+        if proc.returncode != 0 or not proc.stdout.strip():
+            raise RuntimeError("No loop device for the store")
+
+        return proc.stdout.split(":")[0]
+
+    @Report.timed("store.grow")
+    def grow(self, step):
+
+        # The file, then the loop device over it, then the mapping
+        logger.info(f"Growing encrypted store by {step}G...")
+
+        for cmd, error in [
+                (
+                    [ "truncate", "-s", f"+{step}G", self.file ],
+                    "Growing store file failed"
+                ),
+                (
+                    [ "losetup", "-c", self.loop_device() ],
+                    "Loop device resize failed"
+                ),
+                (
+                    [
+                        "cryptsetup", "resize", self.volume, "--key-file",
+                        self.keyfile
+                    ],
+                    "Encrypted store resize failed"
+                ),
+        ]:
+            proc = subprocess.run(cmd)
+            if proc.returncode != 0:
+                raise RuntimeError(error)
+
+    @Report.timed("store.close")
     def close(self):
 
         logger.info("Closing encrypted store...")
@@ -90,10 +314,17 @@ class EncryptedStore:
 
     def retry(self, fn, args=(), retries=5, delay=3):
 
+        attempt = 0
+
         while True:
 
+            attempt += 1
+
             try:
-                fn(*args)
+                with Report.span(
+                        "attempt", fn=fn.__name__, attempt=attempt
+                ):
+                    fn(*args)
             except Exception as e:
                 logger.info("Failed, retrying...")
                 time.sleep(delay)
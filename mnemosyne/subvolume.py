@@ -0,0 +1,165 @@
+
+import logging
+import subprocess
+import calendar
+import time
+
+from .report import Report
+
+logger = logging.getLogger("mnemosyne")
+
+# Names of timestamped snapshots, key.@<time>.  Sorts in time order.
+TIMESTAMP_FORMAT = "%Y%m%dT%H%M%SZ"
+
+class Subvolume:
+
+    @staticmethod
+    def timestamp(when=None):
+        return time.strftime(TIMESTAMP_FORMAT, time.gmtime(when))
+
+    @staticmethod
+    def parse_timestamp(timestamp):
+        return calendar.timegm(time.strptime(timestamp, TIMESTAMP_FORMAT))
+
+    @staticmethod
+    def remove(subvol, cleaner=None):
+
+        # Queued with the background cleaner where there is one
+        if cleaner:
+            cleaner.delete(subvol)
+        else:
+            Subvolume.delete(subvol)
+
+    @staticmethod
+    @Report.timed("subvolume.delete")
+    def delete(subvol):
+
+        proc = subprocess.run(
+            [
+                "btrfs", "subvolume", "delete", subvol,
+            ]
+        )
+
+        if proc.returncode != 0:
+            raise RuntimeError(
+                "Removal of subvolume"
+            )
+
+    @staticmethod
+    @Report.timed("subvolume.snapshot")
+    def snapshot(src, dest, readonly=False):
+
+        if readonly:
+            cmd = [ "btrfs", "subvolume", "snapshot", "-r", src, dest ]
+        else:
+            cmd = [ "btrfs", "subvolume", "snapshot", src, dest ]
+
+        proc = subprocess.run(cmd)
+
+        if proc.returncode != 0:
+            raise RuntimeError(
+                "Subvolume snapshot"
+            )
+
+    @staticmethod
+    def set_readonly(subvol):
+
+        proc = subprocess.run(
+            [
+                "btrfs", "property", "set", "-ts", subvol, "ro", "true",
+            ]
+        )
+
+        if proc.returncode != 0:
+            raise RuntimeError(
+                "Setting subvolume read-only"
+            )
+
+    @staticmethod
+    @Report.timed("subvolume.create")
+    def create(subvol, compression=None):
+
+        proc = subprocess.run(
+            [
+                "btrfs", "subvolume", "create", subvol,
+            ]
+        )
+
+        if proc.returncode != 0:
+            raise RuntimeError(
+                "Creation of subvolume"
+            )
+
+        # Inherited by files created in it, and by its snapshots
+        if compression:
+            Subvolume.set_compression(subvol, compression)
+
+    @staticmethod
+    def set_compression(subvol, compression):
+
+        proc = subprocess.run(
+            [
+                "btrfs", "property", "set", subvol, "compression", compression,
+            ]
+        )
+
+        if proc.returncode != 0:
+            raise RuntimeError(
+                "Setting subvolume compression"
+            )
+
+    @staticmethod
+    def uuid(subvol):
+
+        proc = subprocess.run(
+            [
+                "btrfs", "subvolume", "show", subvol
+            ],
+            stdout=subprocess.PIPE, text=True
+        )
+
+        if proc.returncode != 0:
+            raise RuntimeError(
+                "Subvolume show"
+            )
+
+        for line in proc.stdout.splitlines():
+            line = line.strip()
+            if line.startswith("UUID:"):
+                return line.split()[1]
+
+        raise RuntimeError("Subvolume has no UUID")
+
+    @staticmethod
+    def find_new(subvol, generation=None):
+
+        # Files with data written since a generation, and the current one.
+        # Without a generation, just the current one.
+        if generation is None:
+            generation = 2**63 - 1
+
+        proc = subprocess.run(
+            [
+                "btrfs", "subvolume", "find-new", subvol, str(generation)
+            ],
+            stdout=subprocess.PIPE, text=True
+        )
+
+        if proc.returncode != 0:
+            raise RuntimeError(
+                "Subvolume find-new"
+            )
+
+        paths = set()
+        latest = None
+
+        for line in proc.stdout.splitlines():
+            if line.startswith("transid marker was "):
+                latest = int(line.split()[-1])
+            elif line.startswith("inode "):
+                paths.add(line.split(" ", 16)[16])
+
+        if latest is None:
+            raise RuntimeError("Subvolume find-new gave no generation")
+
+        return paths, latest
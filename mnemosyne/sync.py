@@ -0,0 +1,400 @@
+
+import logging
+import os
+import stat
+import gzip
+import json
+import shutil
+import errno
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from .rsync import Rsync
+from .governor import Governor
+from .cache import PageCache
+from .subvolume import Subvolume
+from .report import Report
+
+logger = logging.getLogger("mnemosyne")
+
+# Copy chunk for copy_file_range/sendfile
+CHUNK = 64 * 1024 * 1024
+
+# Manifest entry fields
+SIZE, MTIME, INO, MODE, UID, GID = range(6)
+
+class SharedScan:
+
+    # Source scans for a cycle which backs up to several targets.  The
+    # first target to get to a key scans it, and the others wait for that
+    # result instead of reading the tree again.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.futures = {}
+
+    def get(self, key, src):
+
+        with self.lock:
+            future = self.futures.get(key)
+            owner = future is None
+            if owner:
+                future = self.futures[key] = Future()
+
+        if not owner:
+            return future.result()
+
+        try:
+            logger.info(f"Scanning {src}...")
+            with Report.span("scan"):
+                future.set_result(NativeSync.scan(src))
+        except Exception as e:
+            future.set_exception(e)
+
+        return future.result()
+
+class NativeSync:
+
+    @staticmethod
+    def run(key, src, dest, mnt, delete=False, threads=8, output=None,
+            scans=None):
+
+        manifest_path = mnt + "/" + key + ".manifest"
+
+        # Taken before anything is copied, so anything which changes during
+        # the transfer looks changed next time
+        try:
+            if scans:
+                scan = scans.get(key, src)
+            else:
+                logger.info(f"Scanning {src}...")
+                with Report.span("scan"):
+                    scan = NativeSync.scan(src)
+        except OSError as e:
+            logger.error(f"Scan of {key} failed: {e}")
+            logger.info("Falling back to rsync")
+            NativeSync.remove_manifest(mnt, key)
+            Rsync.run(src, dest, delete=delete, output=output)
+            return
+
+        uuid = Subvolume.uuid(dest)
+        manifest = NativeSync.load(manifest_path, uuid)
+
+        if manifest is None:
+            logger.info(f"No manifest for {key}, falling back to rsync")
+            Rsync.run(src, dest, delete=delete, output=output)
+            NativeSync.save(manifest_path, uuid, scan)
+            return
+
+        try:
+            with Report.span("copy"):
+                entries = NativeSync.apply(
+                    src, dest, scan, manifest, delete, threads,
+                    output.changes if output else None
+                )
+        except Exception as e:
+            logger.error(f"Native sync of {key} failed: {e}")
+            logger.info("Falling back to rsync")
+            NativeSync.remove_manifest(mnt, key)
+            Rsync.run(src, dest, delete=delete, output=output)
+            NativeSync.save(manifest_path, uuid, scan)
+            return
+
+        NativeSync.save(manifest_path, uuid, entries)
+
+        logger.info("Sync complete")
+
+    @staticmethod
+    def remove_manifest(mnt, key):
+
+        # The manifest only stays valid while nothing else writes to key.0
+        manifest_path = mnt + "/" + key + ".manifest"
+
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+    @staticmethod
+    def scan(src):
+
+        entries = {}
+
+        # Entries which go away or can't be read while the tree is walked
+        # are left out, and picked up by a later run
+        def walk(path, rel):
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    name = rel + entry.name
+                    entries[name] = NativeSync.entry(st)
+                    if stat.S_ISDIR(st.st_mode):
+                        try:
+                            walk(entry.path, name + "/")
+                        except OSError as e:
+                            logger.error(f"{name}: {e}")
+
+        walk(src, "")
+
+        return entries
+
+    @staticmethod
+    def entry(st):
+        return [
+            st.st_size, st.st_mtime_ns, st.st_ino, st.st_mode, st.st_uid,
+            st.st_gid
+        ]
+
+    @staticmethod
+    def load(path, uuid):
+
+        try:
+            with gzip.open(path, "rt") as f:
+                manifest = json.load(f)
+        except:
+            return None
+
+        # Written against a different key.0, e.g. it was re-created
+        if manifest.get("uuid") != uuid:
+            return None
+
+        return manifest["entries"]
+
+    @staticmethod
+    def save(path, uuid, entries):
+
+        tmp = path + ".tmp"
+
+        with gzip.open(tmp, "wt", compresslevel=1) as f:
+            json.dump({ "uuid": uuid, "entries": entries }, f)
+
+        os.replace(tmp, path)
+
+    @staticmethod
+    def apply(src, dest, scan, manifest, delete, threads, changes=None):
+
+        entries = {}
+        copies = []
+        dirs = []
+        errors = 0
+
+        # Removals, children before parents.  Without delete, they stay in
+        # the manifest so that a later deleting run still sees them.
+        for rel in sorted(manifest.keys() - scan.keys(), reverse=True):
+            if delete:
+                NativeSync.remove(os.path.join(dest, rel))
+                if changes:
+                    changes.add(
+                        "*deleting  ",
+                        rel + ("/" if stat.S_ISDIR(manifest[rel][MODE]) else "")
+                    )
+            else:
+                entries[rel] = manifest[rel]
+
+        # Parents sort before children, so directories exist in time
+        for rel in sorted(scan):
+
+            cur = scan[rel]
+            prev = manifest.get(rel)
+            s = os.path.join(src, rel)
+            d = os.path.join(dest, rel)
+
+            try:
+
+                if prev and stat.S_IFMT(prev[MODE]) != stat.S_IFMT(cur[MODE]):
+                    NativeSync.remove(d)
+                    prev = None
+
+                if stat.S_ISREG(cur[MODE]):
+                    if (
+                            prev is None or prev[SIZE] != cur[SIZE] or
+                            prev[MTIME] != cur[MTIME] or prev[INO] != cur[INO]
+                    ):
+                        copies.append(rel)
+                        continue
+
+                elif stat.S_ISDIR(cur[MODE]):
+                    if prev is None:
+                        os.mkdir(d, 0o700)
+                        if changes:
+                            changes.add("cd+++++++++", rel + "/")
+                    if prev != cur:
+                        dirs.append(rel)
+                    entries[rel] = cur
+                    continue
+
+                elif prev is None or prev[MTIME] != cur[MTIME]:
+                    NativeSync.create_special(s, d, cur)
+                    if changes:
+                        changes.add(
+                            "cL+++++++++" if stat.S_ISLNK(cur[MODE])
+                            else "cD+++++++++",
+                            rel
+                        )
+                    entries[rel] = cur
+                    continue
+
+                if prev != cur:
+                    NativeSync.set_metadata(d, cur)
+
+                entries[rel] = cur
+
+            except FileNotFoundError:
+                # Went away since the scan
+                continue
+            except Exception as e:
+                logger.error(f"{rel}: {e}")
+                errors += 1
+
+        logger.info(
+            f"Copying {len(copies)} files, updating {len(dirs)} directories..."
+        )
+
+        with ThreadPoolExecutor(max_workers=threads) as ex:
+            results = ex.map(
+                Report.propagate(
+                    lambda rel: NativeSync.copy(src, dest, rel, scan[rel])
+                ),
+                copies
+            )
+            for rel, ok in zip(copies, results):
+                if ok:
+                    entries[rel] = scan[rel]
+                    if changes:
+                        changes.add(
+                            ">f+++++++++" if rel not in manifest
+                            else ">f.st......",
+                            rel
+                        )
+                elif ok is False:
+                    errors += 1
+
+        # Directory times last, deepest first, as creating entries inside
+        # a directory moves its mtime
+        for rel in reversed(dirs):
+            try:
+                NativeSync.set_metadata(os.path.join(dest, rel), scan[rel])
+            except FileNotFoundError:
+                pass
+
+        if errors:
+            raise RuntimeError(f"{errors} files failed to sync")
+
+        return entries
+
+    @staticmethod
+    def copy(src, dest, rel, cur):
+
+        s = os.path.join(src, rel)
+        d = os.path.join(dest, rel)
+        tmp = os.path.join(
+            os.path.dirname(d), "." + os.path.basename(d) + ".mnemosyne-tmp"
+        )
+
+        try:
+            NativeSync.copy_file(s, tmp)
+            NativeSync.set_metadata(tmp, cur)
+            os.replace(tmp, d)
+            return True
+        except FileNotFoundError:
+            # Source went away since the scan
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return None
+        except Exception as e:
+            logger.error(f"{rel}: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+
+    @staticmethod
+    def copy_file(src, dst):
+
+        with open(src, "rb") as fin, open(dst, "wb") as fout:
+
+            # Drop-behind, so a backup doesn't push everything else out of
+            # the page cache.  The copy is only ever read back by a restore,
+            # so it always goes.  A source which was already partly cached
+            # is in use by something else, and left alone.
+            drop_out = Governor.drop_behind()
+            drop_in = (
+                drop_out and PageCache.resident(fin.fileno())[0] == 0
+            )
+
+            try:
+                NativeSync.copy_data(fin, fout, drop_in, drop_out)
+            finally:
+                if drop_in:
+                    PageCache.drop(fin.fileno())
+                if drop_out:
+                    PageCache.drop(fout.fileno())
+
+    @staticmethod
+    def copy_data(fin, fout, drop_in=False, drop_out=False):
+
+        # In-kernel copy, falling back to sendfile and then plain reads
+        # where the filesystems don't support it.  Some, e.g. FUSE and
+        # network mounts, don't fail but copy nothing, so a copy which
+        # ends at once short of the size falls back too.
+        size = os.fstat(fin.fileno()).st_size
+
+        for fn in [ os.copy_file_range, os.sendfile ]:
+            try:
+                offset = 0
+                while True:
+                    if fn == os.sendfile:
+                        n = fn(fout.fileno(), fin.fileno(), None, CHUNK)
+                    else:
+                        n = fn(fin.fileno(), fout.fileno(), CHUNK)
+                    if n == 0:
+                        break
+                    if drop_in:
+                        PageCache.drop(fin.fileno(), offset, n)
+                    if drop_out:
+                        PageCache.drop(fout.fileno(), offset, n)
+                    offset += n
+                if offset > 0 or size == 0:
+                    return
+            except OSError as e:
+                if e.errno not in (
+                        errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                        errno.EOPNOTSUPP
+                ):
+                    raise
+            fin.seek(0)
+            fout.seek(0)
+            fout.truncate()
+
+        shutil.copyfileobj(fin, fout, CHUNK)
+
+    @staticmethod
+    def create_special(src, dst, cur):
+
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+        if stat.S_ISLNK(cur[MODE]):
+            os.symlink(os.readlink(src), dst)
+        else:
+            os.mknod(dst, cur[MODE], os.lstat(src).st_rdev)
+
+        NativeSync.set_metadata(dst, cur)
+
+    @staticmethod
+    def set_metadata(path, cur):
+
+        os.chown(path, cur[UID], cur[GID], follow_symlinks=False)
+
+        if not stat.S_ISLNK(cur[MODE]):
+            os.chmod(path, stat.S_IMODE(cur[MODE]))
+
+        os.utime(path, ns=(cur[MTIME], cur[MTIME]), follow_symlinks=False)
+
+    @staticmethod
+    def remove(path):
+
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
@@ -17,29 +17,113 @@ class Remote:
 class CifsRemote:
     type: str
     volume: str
-    username: str
-    password: str
+    username: str = None
+    password: str = None
+    credentials: str = None
+    vers: str = None
+    cache: str = None
+    rsize: int = None
+    wsize: int = None
+    multichannel: bool = False
+    max_channels: int = None
+    actimeo: int = None
 
 @dataclass
 class BlockRemote:
     type: str
     device: str
+    mode: str = "filesystem"
 
 @dataclass
 class Store:
     name: str
     size: int
     keyfile: str
+    cipher: str = None
+    key_size: int = None
+    sector_size: int = 4096
+    pbkdf: str = "pbkdf2"
+    pbkdf_iterations: int = 1000
+    no_workqueue: bool = True
+    compress: str = None
+    noatime: bool = True
+    space_cache: str = None
+    commit: int = None
+    autodefrag: bool = False
+    discard: bool = False
+    grow_free: float = None
+    grow_step: float = 10
+    grow_max: float = None
 
 @dataclass
 class Strategy:
     stages: int
     rotate: int
+    parallelism: int = 1
+    layout: str = "chain"
+    cleanup_timeout: int = 600
+    state: str = "/var/lib/mnemosyne"
+    interval: float = 24
+    idle: float = 10
+    output: str = "verbose"
+    progress: float = 60
+    itemize: bool = False
+    catalog: bool = False
+    verify_rate: float = None
 
 @dataclass
 class Directory:
     key: int
     directory: int
+    shards: int = 1
+    engine: str = "rsync"
+    threads: int = 8
+    snapshots: str = None
+    journal: bool = False
+    full_scan: float = 24
+    interval: float = None
+    compression: str = None
+    profile: object = None
+
+@dataclass
+class Profile:
+    whole_file: bool = None
+    inplace: bool = False
+    sparse: bool = False
+    preallocate: bool = False
+    checksum: bool = False
+
+@dataclass
+class Target:
+    name: str
+    remote: object
+    store: Store
+
+    @staticmethod
+    def parse(target):
+        return Target(
+            target["name"], Remote.parse(target["remote"]),
+            Store(**target["store"])
+        )
+
+@dataclass
+class Limits:
+    rate: float = None
+    cpu: float = None
+    pressure_high: float = 20
+    pressure_low: float = 5
+    floor: float = 0.1
+    interval: float = 10
+    slice: str = "mnemosyne"
+    nice: int = 19
+    ionice: int = 3
+    memory_high: float = None
+    drop_cache: bool = False
+
+@dataclass
+class Reporting:
+    file: str = None
+    textfile: str = None
 
 @dataclass
 class Local:
@@ -0,0 +1,238 @@
+
+import logging
+import os
+import stat
+import gzip
+import json
+import mmap
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .directory import DirectoryBackup
+from .subvolume import Subvolume
+from .sync import NativeSync, SIZE, MTIME, MODE
+from .report import Report
+
+logger = logging.getLogger("mnemosyne")
+
+# Hashed a chunk at a time, so throttling is smooth
+CHUNK = 8 * 1024 * 1024
+
+class Throttle:
+
+    # Holds readers shared between threads to an overall rate
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.total = 0
+
+    def wait(self, n):
+
+        if not self.rate:
+            return
+
+        with self.lock:
+            self.total += n
+            due = self.start + self.total / self.rate
+
+        delay = due - time.time()
+
+        if delay > 0:
+            time.sleep(delay)
+
+class Verifier:
+
+    # Checksums of a key's files, kept in key.checksums.gz on the volume:
+    # for each path, the versions seen in any stage as size, mtime and
+    # blake2b.  A normal run hashes what btrfs has written to key.0 since
+    # the last one; a full run re-reads every file of every stage.
+
+    @staticmethod
+    def load(path):
+
+        try:
+            with gzip.open(path, "rt") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return { "generation": None, "files": {} }
+
+    @staticmethod
+    def save(path, manifest):
+
+        tmp = path + ".tmp"
+
+        with gzip.open(tmp, "wt", compresslevel=1) as f:
+            json.dump(manifest, f)
+
+        os.replace(tmp, path)
+
+    @staticmethod
+    def hash(path, size, throttle=None):
+
+        h = hashlib.blake2b()
+
+        if size == 0:
+            return h.hexdigest()
+
+        with open(path, "rb") as f:
+
+            # Changed since it was listed, e.g. emptied, which mmap can't
+            # map.  Picked up by the next run.
+            if os.fstat(f.fileno()).st_size != size:
+                return None
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                m.madvise(mmap.MADV_SEQUENTIAL)
+                for offset in range(0, len(m), CHUNK):
+                    if throttle:
+                        throttle.wait(min(CHUNK, len(m) - offset))
+                    h.update(m[offset:offset + CHUNK])
+
+        return h.hexdigest()
+
+    @staticmethod
+    def files(root, paths=None):
+
+        # Regular files under a stage, or just the given ones
+        if paths is None:
+            entries = NativeSync.scan(root)
+        else:
+            entries = {}
+            for rel in paths:
+                try:
+                    entries[rel] = NativeSync.entry(
+                        os.lstat(os.path.join(root, rel))
+                    )
+                except FileNotFoundError:
+                    pass
+
+        return {
+            rel: cur for rel, cur in entries.items()
+            if stat.S_ISREG(cur[MODE])
+        }
+
+    @staticmethod
+    def run(key, mnt, strategy, full=False, threads=16, rate=None):
+
+        path = mnt + "/" + key + ".checksums.gz"
+        manifest = Verifier.load(path)
+        versions = manifest["files"]
+
+        stages = DirectoryBackup.stages(key, mnt, strategy)
+
+        if not stages:
+            raise RuntimeError(f"No backup of {key} to verify")
+
+        current = stages[-1]
+
+        # The generation is read first, so anything written while hashing
+        # is picked up next time
+        if full or manifest["generation"] is None:
+            changed = None
+            _, generation = Subvolume.find_new(current)
+        else:
+            changed, generation = Subvolume.find_new(
+                current, manifest["generation"]
+            )
+
+        work = []
+
+        if full:
+            # Every stage, newest first, as stage N
+            for stage, root in enumerate(reversed(stages)):
+                for rel, cur in Verifier.files(root).items():
+                    work.append((stage, root, rel, cur))
+        else:
+            for rel, cur in Verifier.files(current, changed).items():
+                known = versions.get(rel, [])
+                if not any(v[:2] == [cur[SIZE], cur[MTIME]] for v in known):
+                    work.append((0, current, rel, cur))
+
+        total = sum(cur[SIZE] for _, _, _, cur in work)
+
+        logger.info(
+            f"Verifying {len(work)} files of {key}, {total / 1e6:.1f} MB..."
+        )
+
+        throttle = Throttle(rate * 1e6) if full and rate else None
+        lock = threading.Lock()
+        seen = {}
+        mismatches = []
+        errors = []
+
+        def check(item):
+
+            stage, root, rel, cur = item
+
+            try:
+                digest = Verifier.hash(
+                    os.path.join(root, rel), cur[SIZE], throttle
+                )
+            except FileNotFoundError:
+                return
+            except (OSError, ValueError) as e:
+                logger.error(f"{key}.{stage}: {rel}: {e}")
+                with lock:
+                    seen.setdefault(rel, []).append(
+                        [ cur[SIZE], cur[MTIME], None ]
+                    )
+                    errors.append((stage, rel))
+                return
+
+            if digest is None:
+                return
+
+            version = [ cur[SIZE], cur[MTIME], digest ]
+
+            with lock:
+
+                seen.setdefault(rel, []).append(version)
+
+                for v in versions.get(rel, []):
+                    if v[:2] == version[:2] and v[2] != digest:
+                        logger.error(f"{key}.{stage}: {rel}: checksum mismatch")
+                        mismatches.append((stage, rel))
+                        return
+
+                if version not in versions.setdefault(rel, []):
+                    versions[rel].append(version)
+
+        start = time.time()
+
+        with ThreadPoolExecutor(max_workers=threads) as ex:
+            list(ex.map(Report.propagate(check), work))
+
+        elapsed = time.time() - start
+
+        # A full run saw every stage, so versions no longer held anywhere
+        # are dropped, keeping those which failed for the next run
+        if full:
+            for rel in list(versions):
+                if rel not in seen:
+                    del versions[rel]
+                else:
+                    versions[rel] = [
+                        v for v in versions[rel]
+                        if any(v[:2] == s[:2] for s in seen[rel])
+                    ]
+
+        manifest["generation"] = generation
+        Verifier.save(path, manifest)
+
+        Report.annotate(
+            files=len(work), bytes=total, mismatches=len(mismatches),
+            errors=len(errors),
+            mb_per_sec=round(total / max(elapsed, 1e-6) / 1e6, 2)
+        )
+
+        logger.info(
+            f"Verified {len(work)} files of {key}, {total / 1e6:.1f} MB in "
+            f"{elapsed:.1f}s, {total / max(elapsed, 1e-6) / 1e6:.1f} MB/s, "
+            f"{len(mismatches)} mismatches, {len(errors)} unreadable"
+        )
+
+        return mismatches + errors
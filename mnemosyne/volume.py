@@ -5,13 +5,47 @@ import os
 import time
 import sys
 
+from .cleaner import SubvolumeCleaner
+from .report import Report
+
 logger = logging.getLogger("mnemosyne")
 
 class Volume:
 
-    def __init__(self, device):
+    def __init__(self, device, cleanup_timeout=600, options=[], trim=False,
+                 name=None):
         self.device = device
-        self.mnt = "/tmp/mnemosyne-volume"
+        self.mnt = "/tmp/mnemosyne-volume" + ("-" + name if name else "")
+        self.cleanup_timeout = cleanup_timeout
+        self.options = options
+        self.trim = trim
+        self.cleaner = None
+
+    @staticmethod
+    def mount_options(store):
+
+        options = []
+
+        if store.compress:
+            options.append("compress=" + store.compress)
+
+        if store.noatime:
+            options.append("noatime")
+
+        if store.space_cache:
+            options.append("space_cache=" + store.space_cache)
+
+        if store.commit:
+            options.append(f"commit={store.commit}")
+
+        if store.autodefrag:
+            options.append("autodefrag")
+
+        # Freed extents are discarded in the background, in batches
+        if store.discard:
+            options.append("discard=async")
+
+        return options
 
     @staticmethod
     def init(file):
@@ -32,19 +66,79 @@ class Volume:
             mount_points = [line.split()[1] for line in f.readlines()]
         return self.mnt in mount_points
 
+    @Report.timed("volume.mount")
     def mount(self):
 
         logger.info("Mounting volume...")
 
+        cmd = [ "mount", self.device, self.mnt ]
+
+        if self.options:
+            cmd += [ "-o", ",".join(self.options) ]
+
+        proc = subprocess.run(cmd)
+        
+        if proc.returncode != 0:
+            raise RuntimeError("Remote FS mount failed")
+
+    def free(self):
+        st = os.statvfs(self.mnt)
+        return st.f_bavail * st.f_frsize
+
+    @Report.timed("volume.resize")
+    def resize(self):
+
         proc = subprocess.run(
             [
-                "mount", self.device, self.mnt,
+                "btrfs", "filesystem", "resize", "max", self.mnt
             ]
         )
-        
+
         if proc.returncode != 0:
-            raise RuntimeError("Remote FS mount failed")
+            raise RuntimeError("Volume resize failed")
+
+    @Report.timed("volume.trim")
+    def fstrim(self):
+
+        logger.info("Trimming volume...")
 
+        proc = subprocess.run(
+            [
+                "fstrim", self.mnt
+            ]
+        )
+
+        # Not fatal, the blocks are still there to trim next time
+        if proc.returncode != 0:
+            logger.error("Volume trim failed")
+
+    @Report.timed("volume.scrub")
+    def scrub(self):
+
+        # Reads and checks every block, repairing where there's a good copy
+        logger.info("Scrubbing volume...")
+
+        proc = subprocess.run(
+            [
+                "btrfs", "scrub", "start", "-B", "-d", self.mnt
+            ]
+        )
+
+        if proc.returncode != 0:
+            raise RuntimeError("Volume scrub found errors")
+
+    def remount(self, options):
+
+        proc = subprocess.run(
+            [
+                "mount", "-o", ",".join([ "remount" ] + options), self.mnt
+            ]
+        )
+
+        if proc.returncode != 0:
+            raise RuntimeError("Volume remount failed")
+
+    @Report.timed("volume.unmount")
     def unmount(self):
 
         logger.info("Unmounting volume...")
@@ -75,14 +169,24 @@ class Volume:
 
         self.mount()
 
+        self.cleaner = SubvolumeCleaner(self.mnt)
+        self.cleaner.start()
+
         return self
 
     def retry(self, fn, args=(), retries=5, delay=3):
 
+        attempt = 0
+
         while True:
 
+            attempt += 1
+
             try:
-                fn(*args)
+                with Report.span(
+                        "attempt", fn=fn.__name__, attempt=attempt
+                ):
+                    fn(*args)
             except Exception as e:
                 logger.info("Failed, retrying...")
                 time.sleep(delay)
@@ -101,6 +205,14 @@ class Volume:
         return self.mnt
 
     def __exit__(self, *args):
+
+        if self.cleaner:
+            with Report.span("cleanup.drain"):
+                self.cleaner.drain(self.cleanup_timeout)
+
+        # Hands space freed by rotation back to the store's backing storage
+        if self.trim:
+            self.fstrim()
     
         self.retry(self.unmount)
         logger.info("Remote FS unmounted successfully")
@@ -0,0 +1,98 @@
+
+import pytest
+
+from mnemosyne.catalog import Catalog
+
+KEY = "home"
+
+TREE = [ "a", "a/b", "a/c/d", "a-b", "a.txt", "a0", "ab", "b/a" ]
+
+def entry(size, mtime=1):
+    return ( size, mtime, 0, 0o100644, 0, 0 )
+
+@pytest.fixture
+def catalog(tmp_path):
+
+    catalog = Catalog(str(tmp_path / "catalog.db"))
+    db = catalog.connect()
+
+    # Everything in TREE was there at epoch 0
+    current = {}
+    with db:
+        catalog.apply(
+            db, KEY, current, [ (p, entry(1)) for p in TREE ], 0
+        )
+
+    yield catalog, db, current
+
+    db.close()
+
+@pytest.mark.parametrize("changes, closed, count", [
+
+    # A directory takes everything under it, but not its siblings which
+    # share its prefix
+    ( [ ("a", None) ], [ "a", "a/b", "a/c/d" ], 3 ),
+
+    ( [ ("a/c", None) ], [ "a/c/d" ], 1 ),
+
+    ( [ ("a/b", None) ], [ "a/b" ], 1 ),
+
+    ( [ ("b", None) ], [ "b/a" ], 1 ),
+
+    ( [ ("c", None) ], [], 0 ),
+
+    # A deletion after the path has gone already counts once
+    ( [ ("a/c/d", None), ("a", None) ], [ "a", "a/b", "a/c/d" ], 3 ),
+
+])
+def test_apply_deletions(catalog, changes, closed, count):
+
+    catalog, db, current = catalog
+
+    with db:
+        assert catalog.apply(db, KEY, current, changes, 1) == count
+
+    assert sorted(set(TREE) - set(current)) == closed
+    assert catalog.open_versions(db, KEY) == current
+
+    for path in closed:
+        row = db.execute(
+            "SELECT first, last FROM versions WHERE key = ? AND path = ?",
+            (KEY, path)
+        ).fetchone()
+        assert (row["first"], row["last"]) == (0, 0)
+
+def test_apply_replaced_directory(catalog):
+
+    catalog, db, current = catalog
+
+    # A directory replaced within one update: the new files open fresh
+    # versions and the old ones under it are closed
+    with db:
+        catalog.apply(db, KEY, current, [
+            ("a", None), ("a/b", entry(2)), ("a/e", entry(3)),
+        ], 1)
+
+    assert current["a/b"] == (2, 1)
+    assert current["a/e"] == (3, 1)
+    assert "a" not in current
+    assert "a/c/d" not in current
+
+    # And a later deletion finds the paths added since
+    with db:
+        assert catalog.apply(db, KEY, current, [ ("a", None) ], 2) == 2
+
+    assert sorted(current) == [ "a-b", "a.txt", "a0", "ab", "b/a" ]
+
+def test_apply_same_epoch(catalog):
+
+    catalog, db, current = catalog
+
+    # A version which was never in a snapshot is dropped, not closed
+    with db:
+        catalog.apply(db, KEY, current, [ ("x", entry(1)) ], 1)
+        catalog.apply(db, KEY, current, [ ("x", None) ], 1)
+
+    assert db.execute(
+        "SELECT COUNT(*) FROM versions WHERE path = 'x'"
+    ).fetchone()[0] == 0
@@ -0,0 +1,133 @@
+
+import pytest
+
+from mnemosyne import journal
+from mnemosyne.journal import ChangeJournal
+
+@pytest.fixture
+def watcher(tmp_path):
+
+    watcher = ChangeJournal(str(tmp_path), "home")
+    watcher.open()
+
+    yield watcher
+
+    watcher.file.close()
+
+def consumer(watcher, target=None):
+
+    # A consumer which has caught up with a full scan
+    consumer = ChangeJournal(
+        watcher.path.rsplit("/journal/", 1)[0], "home", target
+    )
+    paths, state = consumer.pending(24)
+    assert paths is None
+    consumer.commit(state, full=True)
+
+    return consumer
+
+def test_pending(watcher):
+
+    reader = consumer(watcher)
+
+    watcher.record("a")
+    watcher.record("b/c")
+    watcher.record("a")
+    watcher.flush()
+
+    paths, state = reader.pending(24)
+    assert paths == { "a", "b/c" }
+    reader.commit(state)
+
+    # Only what's new since the commit
+    watcher.record("d")
+    watcher.flush()
+
+    paths, state = reader.pending(24)
+    assert paths == { "d" }
+
+    # Uncommitted, so seen again
+    paths, state = reader.pending(24)
+    assert paths == { "d" }
+
+def test_pending_partial_write(watcher):
+
+    reader = consumer(watcher)
+
+    watcher.record("a")
+    watcher.file.write('["P", "b"')
+    watcher.flush()
+
+    paths, state = reader.pending(24)
+    assert paths == { "a" }
+    reader.commit(state)
+
+    watcher.file.write("]\n")
+    watcher.flush()
+
+    paths, state = reader.pending(24)
+    assert paths == { "b" }
+
+def test_pending_targets(watcher):
+
+    # Each target keeps its own place in the journal
+    first = consumer(watcher, "first")
+    watcher.record("a")
+    watcher.flush()
+    second = consumer(watcher, "second")
+    watcher.record("b")
+    watcher.flush()
+
+    assert first.pending(24)[0] == { "a", "b" }
+    assert second.pending(24)[0] == { "b" }
+
+def overflow(watcher):
+    watcher.overflow()
+    watcher.flush()
+
+def restart(watcher):
+    watcher.restart()
+
+def grow(watcher):
+
+    # Past the limit, the watcher starts a new session
+    limit = journal.MAX_JOURNAL
+    journal.MAX_JOURNAL = watcher.file.tell() - 1
+    try:
+        watcher.flush()
+    finally:
+        journal.MAX_JOURNAL = limit
+
+def stop(watcher):
+    watcher.file.close()
+
+@pytest.mark.parametrize("event, full_scan", [
+    (overflow, 24),
+    (restart, 24),
+    (grow, 24),
+    (stop, 24),
+    (None, 0),
+])
+def test_pending_full_scan(watcher, event, full_scan):
+
+    reader = consumer(watcher)
+
+    watcher.record("a")
+    watcher.flush()
+
+    if event:
+        event(watcher)
+
+    paths, state = reader.pending(full_scan)
+    assert paths is None
+
+    # Once the full scan is committed, the journal is trusted again
+    reader.commit(state, full=True)
+
+    if event is stop:
+        watcher.open()
+    watcher.record("b")
+    watcher.flush()
+
+    paths, state = reader.pending(24)
+    assert paths == (None if event is stop else { "b" })
@@ -0,0 +1,54 @@
+
+import pytest
+
+from mnemosyne.rsync import RsyncStats
+
+# rsync 3.2 --stats output
+STATS = """
+Number of files: 1,234,567 (reg: 1,200,000, dir: 34,567)
+Number of created files: 12 (reg: 12)
+Number of deleted files: 0
+Number of regular files transferred: 1,024
+Total file size: 98,765,432,100 bytes
+Total transferred file size: 1,048,576 bytes
+Literal data: 524,288 bytes
+Matched data: 524,288 bytes
+File list size: 65,536
+File list generation time: 12.345 seconds
+File list transfer time: 0.001 seconds
+Total bytes sent: 2,000,000
+Total bytes received: 30,000
+
+sent 2,000,000 bytes  received 30,000 bytes  100,000.00 bytes/sec
+total size is 98,765,432,100  speedup is 48,653.91
+"""
+
+@pytest.mark.parametrize("field, value", [
+    ("files", 1234567),
+    ("files_transferred", 1024),
+    ("total_size", 98765432100),
+    ("transferred_size", 1048576),
+    ("literal", 524288),
+    ("matched", 524288),
+    ("scan_time", 12.345),
+    ("list_time", 0.001),
+    ("sent", 2000000),
+    ("received", 30000),
+])
+def test_parse(field, value):
+    stats = RsyncStats.parse(STATS, wall_time=20.0)
+    assert getattr(stats, field) == pytest.approx(value)
+    assert type(getattr(stats, field)) is type(value)
+
+def test_parse_plain_numbers():
+
+    # Older rsync doesn't group digits
+    stats = RsyncStats.parse(
+        "Number of files: 42\nTotal file size: 4096 bytes\n"
+    )
+
+    assert stats.files == 42
+    assert stats.total_size == 4096
+
+def test_parse_nothing():
+    assert RsyncStats.parse("", wall_time=1.5) == RsyncStats(wall_time=1.5)
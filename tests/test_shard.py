@@ -0,0 +1,87 @@
+
+import os
+
+import pytest
+
+from mnemosyne.shard import ShardedSync
+
+def make_tree(root, dirs):
+    for rel in dirs:
+        os.makedirs(os.path.join(root, rel), exist_ok=True)
+
+def stats(files, size):
+    return { "files": files, "bytes": size }
+
+@pytest.mark.parametrize("dirs, previous, shards, containers, units", [
+
+    # Nothing known yet: every top-level subtree weighs the same
+    (
+        [ "a", "b", "c" ], {}, 2,
+        [ "" ], { "a": 1.0, "b": 1.0, "c": 1.0 },
+    ),
+
+    # Balanced enough already
+    (
+        [ "a", "b" ], { "a": stats(10, 100), "b": stats(10, 100) }, 2,
+        [ "" ], { "a": 1.0, "b": 1.0 },
+    ),
+
+    # One heavy subtree is split into its children, which share its weight
+    (
+        [ "a/x", "a/y", "b" ],
+        { "a": stats(90, 900), "b": stats(10, 100) }, 2,
+        [ "", "a" ], { "a/x": 0.9, "a/y": 0.9, "b": 0.2 },
+    ),
+
+    # Weights recorded for children are used, and a subtree with only its
+    # children known weighs their sum
+    (
+        [ "a/x", "a/y", "b" ],
+        {
+            "a/x": stats(60, 600), "a/y": stats(20, 200),
+            "b": stats(20, 200),
+        }, 2,
+        [ "", "a" ], { "a/x": 1.2, "a/y": 0.4, "b": 0.4 },
+    ),
+
+    # A heavy subtree with no children can't be split
+    (
+        [ "a", "b" ], { "a": stats(99, 990), "b": stats(1, 10) }, 4,
+        [ "" ], { "a": 1.98, "b": 0.02 },
+    ),
+
+    # Splitting stops at MAX_DEPTH
+    (
+        [ "a/b/c/d", "e" ],
+        { "a": stats(99, 990), "e": stats(1, 10) }, 2,
+        [ "", "a", "a/b" ], { "a/b/c": 1.98, "e": 0.02 },
+    ),
+
+])
+def test_plan(tmp_path, dirs, previous, shards, containers, units):
+
+    make_tree(tmp_path, dirs)
+
+    got_containers, got_units = ShardedSync.plan(
+        str(tmp_path), previous, shards
+    )
+
+    assert got_containers == containers
+    assert got_units == pytest.approx(units)
+
+@pytest.mark.parametrize("units, shards, partitions", [
+
+    # Heaviest first, each to the lightest shard
+    (
+        { "a": 5, "b": 4, "c": 3, "d": 2, "e": 1 }, 2,
+        [ [ "a", "d", "e" ], [ "b", "c" ] ],
+    ),
+
+    # More shards than units leaves no empty partitions
+    ( { "a": 1, "b": 1 }, 4, [ [ "a" ], [ "b" ] ] ),
+
+    ( {}, 3, [] ),
+
+])
+def test_partition(units, shards, partitions):
+    assert ShardedSync.partition(units, shards) == partitions